@@ -11,6 +11,8 @@ from . import iucn
 from . import sgcn
 from . import gbif
 from . import utils
+from . import aio
+from . import runner
 
 __version__ = pkg_resources.require("pysppin")[0].version
 
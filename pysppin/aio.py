@@ -0,0 +1,187 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from . import utils
+from . import itis
+from . import worms
+from . import gbif
+from . import iucn
+from . import natureserve
+from . import sgcn
+from . import ecos
+
+common_utils = utils.Utils()
+
+# Each source is run through its existing search function; the lambdas take care of the differences in what each
+# search expects as its first argument, whether it tracks a name source and whether it uses a negative cache
+source_searches = {
+    "itis": lambda t, key, name_source, nc=None: itis.ItisApi(transport=t, negative_cache=nc).search(
+        key, name_source=name_source
+    ),
+    "worms": lambda t, key, name_source, nc=None: worms.Worms(transport=t, negative_cache=nc).search(
+        key, name_source=name_source
+    ),
+    "gbif": lambda t, key, name_source, nc=None: gbif.Gbif(transport=t).summarize_us_species(
+        key, name_source=name_source
+    ),
+    "iucn": lambda t, key, name_source, nc=None: iucn.Iucn(transport=t, negative_cache=nc).search_species(
+        key, name_source=name_source
+    ),
+    "natureserve": lambda t, key, name_source, nc=None: natureserve.Natureserve(
+        transport=t, negative_cache=nc
+    ).search(key, name_source=name_source),
+    "sgcn": lambda t, key, name_source, nc=None: sgcn.Search(transport=t).search(
+        key.split(":")[1], name_source=name_source
+    ),
+    "tess": lambda t, key, name_source, nc=None: ecos.Tess(transport=t).search(key)
+}
+
+
+def source_error(sppin_key, status_message):
+    result = common_utils.processing_metadata()
+    result["sppin_key"] = sppin_key
+    result["date_processed"] = result["processing_metadata"]["date_processed"]
+    result["processing_metadata"]["status"] = "error"
+    result["processing_metadata"]["status_message"] = status_message
+    return result
+
+
+async def search_source(source, sppin_key, name_source=None, timeout=60, semaphore=None, transport=None,
+                        negative_cache=None, source_cache=None, stale_while_revalidate=False, executor=None):
+    '''
+    Runs one source search in a worker thread so that it can be awaited alongside other searches.
+
+    A search that times out cannot be cancelled; it keeps running in its worker thread until its HTTP call returns,
+    which the transport timeout bounds. The semaphore slot is released on timeout, but the worker is not, so the
+    executor's max_workers is the hard limit on threads in use.
+
+    :param source: Key from source_searches
+    :param sppin_key: Search key in the form "Scientific Name:<name>"
+    :param name_source: String indicating where the scientific name was sourced for tracking purposes
+    :param timeout: Seconds to wait for the source before giving up on it
+    :param semaphore: asyncio.Semaphore shared by all searches that should count against the same concurrency limit
+    :param transport: utils.Transport passed to the source class
+    :param negative_cache: utils.NegativeCache passed to the sources that use one
+    :param source_cache: utils.SourceCache to answer from before searching the source
+    :param stale_while_revalidate: Passed to source_cache.search
+    :param executor: concurrent.futures.ThreadPoolExecutor to run the search in; a single use executor is created if
+    not provided
+    :return: The source's usual result structure, or a processing_metadata error stub on timeout or exception
+    '''
+    loop = asyncio.get_running_loop()
+    search = functools.partial(source_searches[source], transport, sppin_key, name_source, negative_cache)
+    if source_cache is not None:
+        search = functools.partial(
+            source_cache.search, source, sppin_key, search, stale_while_revalidate=stale_while_revalidate
+        )
+
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(1)
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=1)
+
+    try:
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(loop.run_in_executor(executor, search), timeout)
+            except asyncio.TimeoutError:
+                return source_error(sppin_key, f"Source search timed out after {timeout} seconds")
+            except Exception as e:
+                return source_error(sppin_key, f"Source search failed: {e}")
+    finally:
+        if own_executor:
+            executor.shutdown(wait=False)
+
+
+async def gather_species(sppin_key, name_source=None, sources=None, timeout=60, timeouts=None, max_concurrency=8,
+                         semaphore=None, transport=None, negative_cache=None, source_cache=None,
+                         stale_while_revalidate=False, executor=None):
+    '''
+    Searches all sources for a single name concurrently, so that the time taken is that of the slowest source rather
+    than the sum of all of them.
+
+    :param sppin_key: Search key in the form "Scientific Name:<name>"
+    :param name_source: String indicating where the scientific name was sourced for tracking purposes
+    :param sources: List of source names to search; defaults to all source_searches
+    :param timeout: Default per-source timeout in seconds
+    :param timeouts: Dictionary of per-source timeouts overriding the default
+    :param max_concurrency: Maximum number of source searches in flight, used when no semaphore or executor is
+    provided
+    :param semaphore: asyncio.Semaphore to share a concurrency limit across many gather_species calls
+    :param transport: utils.Transport passed to all source classes
+    :param negative_cache: utils.NegativeCache passed to the sources that use one
+    :param source_cache: utils.SourceCache to answer from before searching each source
+    :param stale_while_revalidate: Return expired cached results immediately and refresh them in the background
+    :param executor: ThreadPoolExecutor to share worker threads across many gather_species calls
+    :return: Dictionary of source name to that source's result structure
+    '''
+    if sources is None:
+        sources = list(source_searches.keys())
+
+    if timeouts is None:
+        timeouts = dict()
+
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    try:
+        results = await asyncio.gather(*[
+            search_source(
+                source,
+                sppin_key,
+                name_source=name_source,
+                timeout=timeouts.get(source, timeout),
+                semaphore=semaphore,
+                transport=transport,
+                negative_cache=negative_cache,
+                source_cache=source_cache,
+                stale_while_revalidate=stale_while_revalidate,
+                executor=executor
+            ) for source in sources
+        ])
+    finally:
+        # Searches that timed out are left to finish in their threads rather than holding up the caller
+        if own_executor:
+            executor.shutdown(wait=False)
+
+    return dict(zip(sources, results))
+
+
+async def gather_species_list(sppin_keys, name_source=None, sources=None, timeout=60, timeouts=None,
+                              max_concurrency=16, transport=None, negative_cache=None, source_cache=None,
+                              stale_while_revalidate=False):
+    '''
+    Runs gather_species for a list of names with one concurrency limit, and one pool of max_concurrency worker
+    threads, across every source search for every name.
+
+    :return: Dictionary of sppin_key to the gather_species result for that key
+    '''
+    semaphore = asyncio.Semaphore(max_concurrency)
+    executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    try:
+        results = await asyncio.gather(*[
+            gather_species(
+                sppin_key,
+                name_source=name_source,
+                sources=sources,
+                timeout=timeout,
+                timeouts=timeouts,
+                semaphore=semaphore,
+                transport=transport,
+                negative_cache=negative_cache,
+                source_cache=source_cache,
+                stale_while_revalidate=stale_while_revalidate,
+                executor=executor
+            ) for sppin_key in sppin_keys
+        ])
+    finally:
+        executor.shutdown(wait=False)
+
+    return dict(zip(sppin_keys, results))
@@ -1,4 +1,3 @@
-import requests
 import xmltodict
 from bs4 import BeautifulSoup
 from . import utils
@@ -8,8 +7,9 @@ common_utils = utils.Utils()
 
 
 class Tess:
-    def __init__(self):
+    def __init__(self, transport=None):
         self.description = 'Set of functions for working with the USFWS Threatened and Endangered Species System'
+        self.transport = transport if transport is not None else utils.default_transport
         self.tess_api_base = "https://ecos.fws.gov/ecp0/TessQuery?request=query&xquery=/SPECIES_DETAIL"
 
     def search(self, sppin_key):
@@ -28,7 +28,7 @@ class Tess:
         print(result["processing_metadata"]["api"])
 
         # Query the TESS XQuery service
-        tess_response = requests.get(result["processing_metadata"]["api"])
+        tess_response = self.transport.get(result["processing_metadata"]["api"])
 
         if tess_response.status_code != 200:
             result["processing_metadata"]["status"] = "error"
@@ -49,7 +49,8 @@ class Tess:
 
 
 class Ecos:
-    def __init__(self):
+    def __init__(self, transport=None):
+        self.transport = transport if transport is not None else utils.default_transport
         self.property_registry = [
             {
                 'Properties': ['Status', 'Date Listed', 'Lead Region', 'Where Listed'],
@@ -98,7 +99,7 @@ class Ecos:
         extracted_data = common_utils.processing_metadata()
         extracted_data["processing_metadata"]["api"] = ecos_url
 
-        page = requests.get(ecos_url)
+        page = self.transport.get(ecos_url)
         soup = BeautifulSoup(page.content, "html.parser")
 
         if not soup:
@@ -1,13 +1,63 @@
 import requests
 import json
+import os
+import sqlite3
+import tempfile
+from io import BytesIO
 import geopandas as gpd
-from shapely.geometry import box
+from shapely.geometry import box, Point
+from shapely.ops import unary_union
+from shapely import wkt
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
 from . import utils
 
 common_utils = utils.Utils()
 
+# GeoServer gs:Bounds WPS request over the features of one species, formatted with layer and sppcode
+wps_bounds_request = """<?xml version="1.0" encoding="UTF-8"?>
+<wps:Execute version="1.0.0" service="WPS" xmlns:wps="http://www.opengis.net/wps/1.0.0"
+    xmlns:ows="http://www.opengis.net/ows/1.1" xmlns:wfs="http://www.opengis.net/wfs"
+    xmlns:ogc="http://www.opengis.net/ogc" xmlns:xlink="http://www.w3.org/1999/xlink">
+  <ows:Identifier>gs:Bounds</ows:Identifier>
+  <wps:DataInputs>
+    <wps:Input>
+      <ows:Identifier>features</ows:Identifier>
+      <wps:Reference mimeType="text/xml" xlink:href="http://geoserver/wfs" method="POST">
+        <wps:Body>
+          <wfs:GetFeature service="WFS" version="1.0.0" outputFormat="GML2">
+            <wfs:Query typeName="{layer}">
+              <ogc:Filter>
+                <ogc:PropertyIsEqualTo>
+                  <ogc:PropertyName>SppCode</ogc:PropertyName>
+                  <ogc:Literal>{sppcode}</ogc:Literal>
+                </ogc:PropertyIsEqualTo>
+              </ogc:Filter>
+            </wfs:Query>
+          </wfs:GetFeature>
+        </wps:Body>
+      </wps:Reference>
+    </wps:Input>
+  </wps:DataInputs>
+  <wps:ResponseForm>
+    <wps:RawDataOutput>
+      <ows:Identifier>bounds</ows:Identifier>
+    </wps:RawDataOutput>
+  </wps:ResponseForm>
+</wps:Execute>"""
+
 class Gap:
-    def __init__(self):
+    def __init__(self, transport=None, cache_location=os.getenv("DATA_CACHE")):
+        self.transport = transport if transport is not None else utils.default_transport
+        self.cache_location = cache_location
+        self.range_bbox_filename = "GAP_range_bbox.sqlite"
+        self.range_layer = "CONUS_Range_2001v1:Species_CONUS_Range_2001v1"
+        self._range_bbox_con = None
+        self._range_geometry_property = None
+        self._wps_available = True
+        # Default gap_spp_range_bbox mode when there is no precomputed table; "features" reproduces the exact bounding
+        # box of the full geometry at the cost of downloading all of it
+        self.range_bbox_mode = "bounds"
         self.gap_species_collection = "527d0a83e4b0850ea0518326"
         self.sb_api_root = "https://www.sciencebase.gov/catalog/items"
         self.sb_geoserver = "https://www.sciencebase.gov/geoserver/CONUS_Range_2001v1/ows"
@@ -44,7 +94,7 @@ class Gap:
             f"&format=json&fields=identifiers,files,webLinks,distributionLinks,dates" \
             f"&filter=itemIdentifier%3D{identifier_param}"
 
-        sb_result = requests.get(gap_result["processing_metadata"]["api"]).json()
+        sb_result = self.transport.get(gap_result["processing_metadata"]["api"]).json()
 
         if sb_result["total"] == 1:
             gap_result["data"] = self.package_gap_species(self.package_habmap_item(sb_result["items"][0]))
@@ -85,7 +135,7 @@ class Gap:
         return item
 
     def package_rangemap_item(self, sppcode, rangemap_url):
-        sb_range_map_item = requests.get(
+        sb_range_map_item = self.transport.get(
             f"{rangemap_url}?format=json&fields=distributionLinks"
         ).json()
 
@@ -94,7 +144,7 @@ class Gap:
             l["uri"] for l in sb_range_map_item["distributionLinks"] if l["title"] == "External WMS Service"
         ), None)
 
-        rangemap_package["Range Bounding Box"] = self.gap_spp_range_bbox(sppcode)
+        rangemap_package["Range Bounding Box"] = self.range_bbox(sppcode)
 
         return rangemap_package
 
@@ -108,39 +158,324 @@ class Gap:
 
         if hab_map_package["GAP Modeling Database Parameters URL"] is not None:
             hab_map_package["GAP Modeling Database Parameters"] = json.loads(
-                requests.get(
+                self.transport.get(
                     hab_map_package["GAP Modeling Database Parameters URL"]
                 ).text
             )
 
         if hab_map_package["GAP ITIS Information URL"] is not None:
             hab_map_package["GAP ITIS Information"] = json.loads(
-                requests.get(
+                self.transport.get(
                     hab_map_package["GAP ITIS Information URL"]
                 ).text
             )
 
         return hab_map_package
 
-    def gap_spp_range_bbox(self, sppcode):
+    def range_bbox(self, sppcode):
+        '''
+        Returns the total bounding box for a species range from the precomputed table built by build_range_bbox_table,
+        falling back to gap_spp_range_bbox in range_bbox_mode when there is no table or the species is not in it.
+
+        :param sppcode: GAP Species Code
+        :return: Simple bounding box in a list in EPSG:4326
+        '''
+        row = self.range_bbox_record(sppcode)
+        if row is not None:
+            return [row["minx"], row["miny"], row["maxx"], row["maxy"]]
+
+        return self.gap_spp_range_bbox(sppcode)
+
+    def range_bbox_record(self, sppcode):
+        '''
+        Looks up a species in the precomputed range table.
+
+        :param sppcode: GAP Species Code
+        :return: Dictionary with SppCode, minx, miny, maxx, maxy and hull (simplified convex hull as WKT), or None
+        '''
+        if self._range_bbox_con is None:
+            if self.cache_location is None or \
+                    not os.path.isfile(f"{self.cache_location}/{self.range_bbox_filename}"):
+                return None
+            self._range_bbox_con = sqlite3.connect(
+                f"{self.cache_location}/{self.range_bbox_filename}", check_same_thread=False
+            )
+            self._range_bbox_con.row_factory = sqlite3.Row
+
+        row = self._range_bbox_con.execute("SELECT * FROM range_bbox WHERE SppCode = ?", [sppcode]).fetchone()
+
+        return dict(row) if row is not None else None
+
+    def build_range_bbox_table(self, page_size=50, hull_tolerance=0.01):
+        '''
+        Pages through every feature in the GAP range layer and writes the total bounding box (all seasons) and a
+        simplified convex hull for each species to GAP_range_bbox.sqlite in the cache location. Only one page of
+        features is held in memory at a time. The bounding boxes are computed the same way gap_spp_range_bbox
+        computes them, so the table can stand in for the WFS.
+
+        :param page_size: Number of features requested per WFS page
+        :param hull_tolerance: Simplification tolerance for the hulls, in degrees
+        :return: Status message
+        '''
+        if self.cache_location is None:
+            return "A cache location must be provided. Defaults to 'DATA_CACHE' environment variable."
+
+        bounds = dict()
+        hulls = dict()
+        for page in self.iter_range_pages(page_size=page_size):
+            page = page.to_crs({"init": "epsg:4326"})
+            for sppcode, geometry in zip(page["SppCode"], page.geometry):
+                if geometry is None or geometry.is_empty:
+                    continue
+                minx, miny, maxx, maxy = geometry.bounds
+                if sppcode in bounds:
+                    b = bounds[sppcode]
+                    bounds[sppcode] = [min(b[0], minx), min(b[1], miny), max(b[2], maxx), max(b[3], maxy)]
+                    hulls[sppcode] = unary_union([hulls[sppcode], geometry.convex_hull]).convex_hull
+                else:
+                    bounds[sppcode] = [minx, miny, maxx, maxy]
+                    hulls[sppcode] = geometry.convex_hull
+
+        db_fd, db_path = tempfile.mkstemp(dir=self.cache_location, suffix=".sqlite")
+        os.close(db_fd)
+        try:
+            con = sqlite3.connect(db_path)
+            con.execute(
+                "CREATE TABLE range_bbox (SppCode TEXT PRIMARY KEY, minx REAL, miny REAL, maxx REAL, maxy REAL, "
+                "hull TEXT)"
+            )
+            con.executemany(
+                "INSERT INTO range_bbox VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    [sppcode] + b + [hulls[sppcode].simplify(hull_tolerance).wkt]
+                    for sppcode, b in bounds.items()
+                )
+            )
+            con.commit()
+            con.close()
+
+            if self._range_bbox_con is not None:
+                self._range_bbox_con.close()
+                self._range_bbox_con = None
+            os.replace(db_path, f"{self.cache_location}/{self.range_bbox_filename}")
+        finally:
+            if os.path.exists(db_path):
+                os.remove(db_path)
+
+        return f"Range bounding boxes for {len(bounds)} species written to " \
+               f"{self.cache_location}/{self.range_bbox_filename}"
+
+    def range_hull(self, sppcode):
+        '''
+        Simplified convex hull of a species range from the precomputed table.
+
+        :param sppcode: GAP Species Code
+        :return: Shapely geometry in EPSG:4326, or None if the species is not in the table
+        '''
+        row = self.range_bbox_record(sppcode)
+        if row is None or row["hull"] is None:
+            return None
+
+        return wkt.loads(row["hull"])
+
+    def range_geometry_property(self):
+        '''
+        Name of the geometry attribute of the range layer, read once from DescribeFeatureType so that feature requests
+        can leave out every other attribute. None if it cannot be determined, in which case all attributes are
+        requested.
+        '''
+        if self._range_geometry_property is not None:
+            return self._range_geometry_property or None
+
+        params = dict(
+            service="WFS",
+            version="2.0.0",
+            request="DescribeFeatureType",
+            typeNames=self.range_layer,
+            outputFormat="application/json"
+        )
+        q = requests.Request("GET", self.sb_geoserver, params=params).prepare().url
+
+        try:
+            r = self.transport.get(q)
+        except Exception:
+            return None
+
+        if r.status_code in [400, 404]:
+            self._range_geometry_property = ""
+            return None
+        if r.status_code != 200:
+            # Possibly transient; ask again next time
+            return None
+
+        try:
+            feature_type = r.json()["featureTypes"][0]
+            self._range_geometry_property = next(
+                (p["name"] for p in feature_type["properties"] if p["type"].startswith("gml:")), ""
+            )
+        except Exception:
+            self._range_geometry_property = ""
+
+        return self._range_geometry_property or None
+
+    def iter_range_pages(self, sppcode=None, page_size=50, geometry_only=False):
+        '''
+        Generator over the features of the range layer one WFS 2.0 page at a time, in the server's natural order.
+
+        :param sppcode: Limit to one species
+        :param page_size: Number of features per page
+        :param geometry_only: Request only the geometry attribute (propertyName); otherwise SppCode is included
+        :return: Yields a GeoDataFrame per page in the layer's native CRS
+        '''
+        params = dict(
+            service="WFS",
+            version="2.0.0",
+            request="GetFeature",
+            typeNames=self.range_layer,
+            outputFormat="json",
+            count=page_size
+        )
+
+        if sppcode is not None:
+            params["CQL_FILTER"] = f"SppCode='{sppcode}'"
+
+        geometry_property = self.range_geometry_property()
+        if geometry_property is not None:
+            params["propertyName"] = geometry_property if geometry_only else f"SppCode,{geometry_property}"
+
+        start_index = 0
+        while True:
+            params["startIndex"] = start_index
+            q = requests.Request("GET", self.sb_geoserver, params=params).prepare().url
+
+            page = gpd.read_file(BytesIO(self.transport.get(q).content))
+            if len(page) == 0:
+                return
+
+            yield page
+
+            if len(page) < page_size:
+                return
+            start_index += page_size
+
+    def bounds_to_4326(self, bounds, crs, densify_points=21):
+        '''
+        Reprojects a bounding box rather than the geometry it came from. Points along each edge are reprojected along
+        with the corners, since the edges of a projected box are curves in EPSG:4326.
+
+        :param bounds: [minx, miny, maxx, maxy] in crs
+        :param crs: CRS of the bounds
+        :param densify_points: Number of points reprojected along each edge
+        :return: Simple bounding box in a list in EPSG:4326
+        '''
+        minx, miny, maxx, maxy = bounds
+        steps = [i / (densify_points - 1) for i in range(densify_points)]
+        edge_points = [Point(minx + (maxx - minx) * t, y) for t in steps for y in [miny, maxy]] + \
+                      [Point(x, miny + (maxy - miny) * t) for t in steps for x in [minx, maxx]]
+
+        edges = gpd.GeoSeries(edge_points, crs=crs).to_crs({"init": "epsg:4326"})
+
+        return edges.total_bounds.tolist()
+
+    def wps_range_bounds(self, sppcode):
+        '''
+        Runs the GeoServer gs:Bounds process on the features of a species, so that only the bounding box comes back
+        from the server.
+
+        :param sppcode: GAP Species Code
+        :return: Tuple of [minx, miny, maxx, maxy] and the CRS they are in, or None if the process is not available
+        '''
+        if not self._wps_available:
+            return None
+
+        execute = wps_bounds_request.format(layer=self.range_layer, sppcode=escape(sppcode))
+
+        try:
+            r = self.transport.post(self.sb_geoserver, params={"service": "WPS"}, data=execute.encode("utf-8"),
+                                    headers={"Content-Type": "text/xml"})
+        except Exception:
+            return None
+
+        if r.status_code in [400, 404]:
+            self._wps_available = False
+            return None
+        if r.status_code != 200:
+            # Possibly transient; try the process again for the next species
+            return None
+
+        try:
+            bbox = ET.fromstring(r.content)
+            if bbox.tag.split("}")[-1] == "ExceptionReport":
+                # GeoServer reports a missing WPS or gs:Bounds process as an ExceptionReport
+                self._wps_available = False
+                return None
+            if bbox.tag.split("}")[-1] != "BoundingBox" or not bbox.get("crs"):
+                return None
+            corners = {e.tag.split("}")[-1]: [float(v) for v in e.text.split()] for e in bbox}
+            return corners["LowerCorner"] + corners["UpperCorner"], bbox.get("crs")
+        except Exception:
+            return None
+
+    def gap_spp_range_bbox(self, sppcode, mode=None, page_size=10):
         '''
         Queries the WFS for a given GAP species range and returns the total bounding box (all seasons) for the species.
 
+        Modes:
+            "bounds" - asks the server for the bounds with the gs:Bounds WPS process, falling back to "paged" if the
+            process is not available
+            "paged" - pages through the species' features with only the geometry attribute, keeping a running bounding
+            box in the native CRS
+            "features" - downloads every feature at once and reprojects all of it before taking the bounds
+
+        The first two only reproject the bounding box, so they return a box enclosing the one "features" returns,
+        somewhat larger where the range does not reach the corners of its projected bounding box. Pass "features" (or
+        set range_bbox_mode to it) when that exact box is needed.
+
         :param sppcode: GAP Species Code
+        :param mode: One of the modes above; defaults to range_bbox_mode
+        :param page_size: Features per page in "paged" mode
         :return: Simple bounding box in a list in EPSG:4326
         '''
+        mode = self.range_bbox_mode if mode is None else mode
+
+        if mode == "bounds":
+            wps_bounds = self.wps_range_bounds(sppcode)
+            if wps_bounds is not None:
+                try:
+                    return self.bounds_to_4326(*wps_bounds)
+                except Exception:
+                    # The server's CRS could not be resolved here; paged bounds use the CRS the features come with
+                    pass
+            mode = "paged"
+
+        if mode == "paged":
+            bounds = None
+            crs = None
+            for page in self.iter_range_pages(sppcode=sppcode, page_size=page_size, geometry_only=True):
+                crs = page.crs
+                minx, miny, maxx, maxy = page.total_bounds
+                if bounds is None:
+                    bounds = [minx, miny, maxx, maxy]
+                else:
+                    bounds = [min(bounds[0], minx), min(bounds[1], miny), max(bounds[2], maxx), max(bounds[3], maxy)]
+
+            if bounds is None:
+                return [float("nan")] * 4
+
+            return self.bounds_to_4326(bounds, crs)
+
         params = dict(
             service="WFS",
             version="1.0.0",
             request="GetFeature",
-            typeName="CONUS_Range_2001v1:Species_CONUS_Range_2001v1",
+            typeName=self.range_layer,
             outputFormat="json",
             CQL_FILTER=f"SppCode='{sppcode}'"
         )
 
         q = requests.Request("GET", self.sb_geoserver, params=params).prepare().url
 
-        spp_range = gpd.read_file(q)
+        spp_range = gpd.read_file(BytesIO(self.transport.get(q).content))
         spp_range = spp_range.to_crs({"init": "epsg:4326"})
 
         return spp_range.total_bounds.tolist()
@@ -157,7 +492,7 @@ class Gap:
         spp_bbox = spp_bbox.to_crs(us_states.crs)
         intersections = gpd.overlay(spp_bbox, us_states, how='intersection')
         for fips_code in intersections["STATEFP"]:
-            state_gap_metrics = requests.get(f"{self.bis_api_gap_state_metrics}{fips_code}").json()
+            state_gap_metrics = self.transport.get(f"{self.bis_api_gap_state_metrics}{fips_code}").json()
             species_state_metrics = [i for i in state_gap_metrics["result"] if
                                      i["sppcode"] == GAP_SpeciesCode]
             if len(species_state_metrics) > 0:
@@ -1,11 +1,11 @@
-import requests
 from . import utils
 
 common_utils = utils.Utils()
 
 
 class Gbif:
-    def __init__(self):
+    def __init__(self, transport=None):
+        self.transport = transport if transport is not None else utils.default_transport
         self.gbif_spp_occ_summary_api = "https://api.gbif.org/v1/occurrence/search?country=US&limit=0&facet=institutionCode&facet=year&facet=basisOfRecord&{}={}"
         self.gbif_species_suggest_stub = "https://api.gbif.org/v1/species/suggest?q={}"
         self.gbif_species_api_root = "http://api.gbif.org/v1/species/"
@@ -36,7 +36,7 @@ class Gbif:
         ]
         result["processing_metadata"]["name_source"] = name_source
 
-        gbif_spp_search_results = requests.get(self.gbif_species_suggest_stub.format(sppin_key_parts[1])).json()
+        gbif_spp_search_results = self.transport.get(self.gbif_species_suggest_stub.format(sppin_key_parts[1])).json()
 
         if len(gbif_spp_search_results) == 0:
             result["processing_metadata"]["status"] = "failure"
@@ -68,7 +68,7 @@ class Gbif:
                 )
             )
 
-        gbif_occ_results = requests.get(
+        gbif_occ_results = self.transport.get(
             result["processing_metadata"]["api"][-1]
         ).json()
 
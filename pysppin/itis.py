@@ -1,22 +1,22 @@
-import requests
 from . import utils
 import re
 import os
 import hashlib
 from zipfile import ZipFile
-from io import BytesIO
-import sys
+import tempfile
+import shutil
 import sqlite3
-import pandas as pd
-import datetime
+import numpy as np
+import json
+from urllib.parse import quote, unquote
 
 common_utils = utils.Utils()
 
 
 class ItisDb:
-    def __init__(self):
+    def __init__(self, transport=None):
+        self.transport = transport if transport is not None else utils.default_transport
         self.description = "Set of functions for interacting with ITIS as a cached Sqlite database"
-        self.reference_digest = "72cf56150493e8b0865c9145ffc93dcf"
         self.itis_download_sqlite = "https://www.itis.gov/downloads/itisSqlite.zip"
         self.itis_sqlite_filename = "ITIS.sqlite"
 
@@ -28,30 +28,108 @@ class ItisDb:
         return hash_md5.hexdigest()
 
     def cache_itis_db(self, cache_location=os.getenv("DATA_CACHE")):
+        '''
+        Downloads the ITIS Sqlite database to the cache location if it has changed. The request is conditional on the
+        ETag/Last-Modified of the last download, so an unchanged file is not downloaded at all. Otherwise the zip is
+        streamed to a temporary file, the database is decompressed straight to disk while its MD5 is computed, and the
+        new file is moved into place with an atomic rename only if the digest differs from the cached file. What was
+        recorded about the last download is only trusted while the cached file's size and modification time still
+        match it; otherwise the file is downloaded unconditionally and re-hashed.
+
+        :param cache_location: Folder to cache ITIS.sqlite in. Defaults to 'DATA_CACHE' environment variable.
+        :return: Status message
+        '''
         if cache_location is None:
             return "A cache location must be provided. Defaults to 'DATA_CACHE' environment variable."
 
-        if os.path.isfile(f"{cache_location}/{self.itis_sqlite_filename}"):
-            current_itis_hash_digest = self.get_md5(f"{cache_location}/{self.itis_sqlite_filename}")
-        else:
-            current_itis_hash_digest = self.reference_digest
+        itis_file = f"{cache_location}/{self.itis_sqlite_filename}"
+        download_meta = self.download_meta(cache_location) if os.path.isfile(itis_file) else dict()
+        if not self.download_meta_current(itis_file, download_meta):
+            download_meta = dict()
+
+        headers = dict()
+        if "etag" in download_meta:
+            headers["If-None-Match"] = download_meta["etag"]
+        if "last_modified" in download_meta:
+            headers["If-Modified-Since"] = download_meta["last_modified"]
 
-        r = requests.get(self.itis_download_sqlite)
-        itis_sqlite_zip = ZipFile(BytesIO(r.content))
-        db_file_name = next((f for f in itis_sqlite_zip.namelist() if f.split(".")[-1] == "sqlite"), None)
-        sqlite_file = itis_sqlite_zip.open(db_file_name).read()
-        online_itis_hash_digest = hashlib.md5(sqlite_file).hexdigest()
+        r = self.transport.get(self.itis_download_sqlite, headers=headers, stream=True)
 
-        if current_itis_hash_digest == online_itis_hash_digest:
-            return f"Cached file and online file are equivalent (current size of file: {sys.getsizeof(sqlite_file)})"
+        if r.status_code == 304:
+            r.close()
+            return f"Cached file is current, not modified online (current size of file: {os.path.getsize(itis_file)})"
 
+        r.raise_for_status()
+
+        if os.path.isfile(itis_file):
+            current_itis_hash_digest = download_meta.get("md5") or self.get_md5(itis_file)
         else:
-            with open(f"{cache_location}/{self.itis_sqlite_filename}", "wb") as f:
-                f.write(sqlite_file)
-                f.close()
+            current_itis_hash_digest = None
+
+        zip_fd, zip_path = tempfile.mkstemp(dir=cache_location, suffix=".zip")
+        sqlite_fd, sqlite_path = tempfile.mkstemp(dir=cache_location, suffix=".sqlite")
+        os.close(zip_fd)
+        os.close(sqlite_fd)
+        try:
+            with open(zip_path, "wb") as f:
+                for chunk in r.iter_content(chunk_size=1024 * 1024):
+                    f.write(chunk)
+            r.close()
+
+            hash_md5 = hashlib.md5()
+            with ZipFile(zip_path) as itis_sqlite_zip:
+                db_file_name = next((f for f in itis_sqlite_zip.namelist() if f.split(".")[-1] == "sqlite"), None)
+                with itis_sqlite_zip.open(db_file_name) as src, open(sqlite_path, "wb") as dst:
+                    for chunk in iter(lambda: src.read(1024 * 1024), b""):
+                        hash_md5.update(chunk)
+                        dst.write(chunk)
+            online_itis_hash_digest = hash_md5.hexdigest()
+
+            download_meta = {
+                "etag": r.headers.get("ETag"),
+                "last_modified": r.headers.get("Last-Modified"),
+                "md5": online_itis_hash_digest
+            }
+
+            if current_itis_hash_digest == online_itis_hash_digest:
+                self.write_download_meta(cache_location, itis_file, download_meta)
+                return f"Cached file and online file are equivalent " \
+                       f"(current size of file: {os.path.getsize(itis_file)})"
+
+            os.replace(sqlite_path, itis_file)
+            self.write_download_meta(cache_location, itis_file, download_meta)
+        finally:
+            for temp_path in [zip_path, sqlite_path]:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+        return f"File written to {itis_file} (current size of file: {os.path.getsize(itis_file)})"
+
+    def download_meta(self, cache_location):
+        meta_file = f"{cache_location}/{self.itis_sqlite_filename}.download.json"
+        if not os.path.isfile(meta_file):
+            return dict()
+
+        with open(meta_file, "r") as f:
+            return {k: v for k, v in json.loads(f.read()).items() if v is not None}
+
+    def write_download_meta(self, cache_location, itis_file, download_meta):
+        stat = os.stat(itis_file)
+        download_meta = dict(download_meta, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+        with open(f"{cache_location}/{self.itis_sqlite_filename}.download.json", "w") as f:
+            f.write(json.dumps(download_meta))
+
+    def download_meta_current(self, itis_file, download_meta):
+        '''
+        Checks that the cached file is still the one described by the download metadata, i.e. it has not been
+        replaced or modified since, by comparing its size and modification time.
+        '''
+        if "size" not in download_meta or "mtime_ns" not in download_meta:
+            return False
 
-        return f"File written to {cache_location}/{self.itis_sqlite_filename} " \
-               f"(current size of file: {sys.getsizeof(sqlite_file)})"
+        stat = os.stat(itis_file)
+        return stat.st_size == download_meta["size"] and stat.st_mtime_ns == download_meta["mtime_ns"]
 
     def itis_db(self, cache_location=os.getenv("DATA_CACHE"), return_type="connection"):
         if not os.path.isfile(f"{cache_location}/{self.itis_sqlite_filename}"):
@@ -64,11 +142,279 @@ class ItisDb:
         else:
             return con
 
+    def hierarchy_index(self, cache_location=os.getenv("DATA_CACHE")):
+        '''
+        Returns the memory-mapped taxonomic hierarchy index for the cached ITIS database, building it first if it does
+        not exist or the database has changed since it was built.
+
+        :param cache_location: Folder containing ITIS.sqlite
+        :return: ItisHierarchy
+        '''
+        return ItisHierarchy(cache_location=cache_location, transport=self.transport).load()
+
+
+class ItisHierarchy:
+    def __init__(self, cache_location=os.getenv("DATA_CACHE"), transport=None):
+        '''
+        Compact parent-pointer index of every TSN in the cached ITIS database, stored as numpy arrays in an
+        ITIS_hierarchy folder next to ITIS.sqlite and memory-mapped when loaded. Taxa are addressed by their position
+        in the sorted TSN array. A depth-first preorder with subtree sizes makes all descendants of a taxon one
+        contiguous slice; lineages and common ancestors are walks up the parent array.
+
+        :param cache_location: Folder containing ITIS.sqlite
+        :param transport: utils.Transport used if the database needs to be downloaded
+        '''
+        self.description = "Memory-mapped index of the ITIS taxonomic hierarchy"
+        self.cache_location = cache_location
+        self.transport = transport
+        self.index_location = f"{cache_location}/ITIS_hierarchy"
+        self.arrays = ["tsn", "parent", "rank_id", "kingdom_id", "valid", "depth", "preorder", "preorder_index",
+                       "subtree_size", "name_offsets", "names"]
+        self.meta = None
+
+    def source_signature(self):
+        itis_file = f"{self.cache_location}/{ItisDb().itis_sqlite_filename}"
+        if not os.path.isfile(itis_file):
+            ItisDb(transport=self.transport).cache_itis_db(cache_location=self.cache_location)
+        stat = os.stat(itis_file)
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+    def build(self):
+        '''
+        Reads every taxonomic unit from ITIS.sqlite and writes the index arrays. The index is written to a temporary
+        folder that is moved into place once complete, so an interrupted build never leaves a partial index for load
+        to pick up.
+
+        :return: Number of taxa indexed
+        '''
+        signature = self.source_signature()
+        con = ItisDb(transport=self.transport).itis_db(cache_location=self.cache_location)
+
+        rows = con.execute("""
+            SELECT tu.tsn, tu.parent_tsn, tu.rank_id, tu.kingdom_id, tu.name_usage, tu.complete_name
+            FROM taxonomic_units tu
+            ORDER BY tu.tsn
+        """).fetchall()
+        rank_names = {
+            f"{r[0]}:{r[1]}": r[2].strip() for r in
+            con.execute("SELECT kingdom_id, rank_id, rank_name FROM taxon_unit_types").fetchall()
+        }
+        con.close()
+
+        n = len(rows)
+        tsn = np.array([r[0] for r in rows], dtype=np.int64)
+        parent_tsn = np.array([r[1] if r[1] is not None else 0 for r in rows], dtype=np.int64)
+        rank_id = np.array([r[2] for r in rows], dtype=np.int16)
+        kingdom_id = np.array([r[3] for r in rows], dtype=np.int16)
+        valid = np.array([r[4].strip() in ["valid", "accepted"] for r in rows], dtype=np.uint8)
+
+        encoded_names = [" ".join(r[5].split()).encode("utf-8") for r in rows]
+        name_offsets = np.zeros(n + 1, dtype=np.int64)
+        name_offsets[1:] = np.cumsum([len(b) for b in encoded_names])
+        names = np.frombuffer(b"".join(encoded_names), dtype=np.uint8)
+
+        parent = np.searchsorted(tsn, parent_tsn).astype(np.int32)
+        parent[parent >= n] = n - 1
+        parent[(tsn[parent] != parent_tsn) | (parent_tsn == tsn)] = -1
+
+        # Children in CSR form to drive an iterative depth-first walk from every root
+        child_order = np.argsort(parent, kind="stable")
+        child_start = np.searchsorted(parent[child_order], np.arange(-1, n + 1))
+
+        depth = np.zeros(n, dtype=np.int16)
+        subtree_size = np.ones(n, dtype=np.int32)
+        preorder = np.empty(n, dtype=np.int32)
+        visited = np.zeros(n, dtype=bool)
+        next_slot = 0
+
+        roots = child_order[child_start[0]:child_start[1]]
+        for root in roots:
+            stack = [int(root)]
+            while stack:
+                node = stack.pop()
+                if node >= 0:
+                    visited[node] = True
+                    preorder[next_slot] = node
+                    next_slot += 1
+                    # Marker to total up the subtree size once all children are done
+                    stack.append(-node - 1)
+                    for child in child_order[child_start[node + 1]:child_start[node + 2]][::-1]:
+                        if not visited[child]:
+                            depth[child] = depth[node] + 1
+                            stack.append(int(child))
+                else:
+                    node = -node - 1
+                    p = parent[node]
+                    if p >= 0:
+                        subtree_size[p] += subtree_size[node]
+
+        # Anything in a parent cycle is not reachable from a root; index it as its own root
+        for node in np.nonzero(~visited)[0]:
+            parent[node] = -1
+            preorder[next_slot] = node
+            next_slot += 1
+
+        preorder_index = np.empty(n, dtype=np.int32)
+        preorder_index[preorder] = np.arange(n, dtype=np.int32)
+
+        arrays = {
+            "tsn": tsn, "parent": parent, "rank_id": rank_id, "kingdom_id": kingdom_id, "valid": valid,
+            "depth": depth, "preorder": preorder, "preorder_index": preorder_index, "subtree_size": subtree_size,
+            "name_offsets": name_offsets, "names": names
+        }
+        build_location = tempfile.mkdtemp(dir=self.cache_location, prefix="ITIS_hierarchy.")
+        try:
+            for name, array in arrays.items():
+                np.save(f"{build_location}/{name}.npy", array)
+
+            with open(f"{build_location}/meta.json", "w") as f:
+                f.write(json.dumps({"source_signature": signature, "rank_names": rank_names, "count": n}))
+
+            # A folder can only be renamed over an empty one, so the old index is moved aside first
+            if os.path.isdir(self.index_location):
+                old_location = tempfile.mkdtemp(dir=self.cache_location, prefix="ITIS_hierarchy.")
+                os.replace(self.index_location, old_location)
+                shutil.rmtree(old_location, ignore_errors=True)
+            os.replace(build_location, self.index_location)
+        finally:
+            if os.path.isdir(build_location):
+                shutil.rmtree(build_location, ignore_errors=True)
+
+        return n
+
+    def load(self):
+        '''
+        Memory-maps the index arrays, building or rebuilding the index first if needed.
+
+        :return: self
+        '''
+        meta_file = f"{self.index_location}/meta.json"
+        meta = None
+        if os.path.isfile(meta_file):
+            with open(meta_file, "r") as f:
+                meta = json.loads(f.read())
+
+        if meta is None or meta["source_signature"] != self.source_signature():
+            self.build()
+            with open(meta_file, "r") as f:
+                meta = json.loads(f.read())
+
+        self.meta = meta
+        for name in self.arrays:
+            setattr(self, name, np.load(f"{self.index_location}/{name}.npy", mmap_mode="r"))
+
+        return self
+
+    def position(self, tsn):
+        if self.meta is None:
+            self.load()
+
+        i = int(np.searchsorted(self.tsn, int(tsn)))
+        if i >= len(self.tsn) or self.tsn[i] != int(tsn):
+            return None
+
+        return i
+
+    def name(self, position):
+        return bytes(self.names[self.name_offsets[position]:self.name_offsets[position + 1]]).decode("utf-8")
+
+    def rank(self, position):
+        return self.meta["rank_names"].get(f"{self.kingdom_id[position]}:{self.rank_id[position]}")
+
+    def lineage(self, tsn):
+        '''
+        Full lineage for a TSN from the root of its kingdom down to the taxon itself, in the same form as the
+        biological_taxonomy property with the TSN of each rank added.
+
+        :param tsn: ITIS TSN
+        :return: List of dictionaries with rank, name and tsn, or None if the TSN is not in the index
+        '''
+        i = self.position(tsn)
+        if i is None:
+            return None
+
+        lineage = list()
+        while i >= 0:
+            lineage.append({"rank": self.rank(i), "name": self.name(i), "tsn": int(self.tsn[i])})
+            i = int(self.parent[i])
+        lineage.reverse()
+
+        return lineage
+
+    def descendants(self, tsn, valid_only=True, rank_id=None):
+        '''
+        All taxa below a TSN in the hierarchy.
+
+        :param tsn: ITIS TSN
+        :param valid_only: Only return valid/accepted taxa
+        :param rank_id: Only return taxa of this ITIS rank_id (e.g. 220 for species)
+        :return: numpy array of TSNs, or None if the TSN is not in the index
+        '''
+        i = self.position(tsn)
+        if i is None:
+            return None
+
+        start = self.preorder_index[i] + 1
+        positions = self.preorder[start:start + self.subtree_size[i] - 1]
+
+        if valid_only:
+            positions = positions[self.valid[positions] == 1]
+        if rank_id is not None:
+            positions = positions[self.rank_id[positions] == rank_id]
+
+        return np.asarray(self.tsn[np.sort(positions)])
+
+    def lowest_common_ancestor(self, *tsns):
+        '''
+        Lowest taxon that all of the given TSNs fall under.
+
+        :return: TSN of the common ancestor, or None if any TSN is missing or they share no ancestor
+        '''
+        positions = [self.position(t) for t in tsns]
+        if len(positions) == 0 or any(p is None for p in positions):
+            return None
+
+        ancestor = positions[0]
+        for other in positions[1:]:
+            a, b = ancestor, other
+            while self.depth[a] > self.depth[b]:
+                a = int(self.parent[a])
+            while self.depth[b] > self.depth[a]:
+                b = int(self.parent[b])
+            while a != b:
+                a, b = int(self.parent[a]), int(self.parent[b])
+                if a < 0 or b < 0:
+                    return None
+            ancestor = a
+
+        return int(self.tsn[ancestor])
+
 
 class ItisApi:
-    def __init__(self):
+    def __init__(self, transport=None, negative_cache=None, identifier_cache=None):
+        self.transport = transport if transport is not None else utils.default_transport
+        self.negative_cache = negative_cache
+        self.identifier_cache = identifier_cache if identifier_cache is not None else utils.default_identifier_cache
+        # Sources that records and misses are cached under, kept apart per backend since their results can differ
+        self.identifier_source = "itis"
+        self.negative_source = "itis"
         self.description = "Set of functions for interacting with ITIS Solr API and repackaging results for usability"
         self.itis_url_base = "https://www.itis.gov/servlet/SingleRpt/SingleRpt?search_topic=TSN&search_value="
+        self.itis_solr_api = "https://services.itis.gov/?wt=json"
+        # Field names for the "$" delimited values in ITIS list properties, in the order they occur. None skips a
+        # position, and a final name ending in "*" is the prefix for any remaining non-empty values
+        self.itis_list_fields = {
+            "geographicDivision": ["geographic_value", "update_date"],
+            "jurisdiction": ["jurisdiction_value", "origin", "update_date"],
+            "expert": ["reference_type", "expert_id", "expert_name", "expert_comment", "create_date", "update_date"],
+            "publication": ["reference_type", "reference_id", "author", None, "title", "other_variable_*"],
+            "otherSource": ["reference_type", "source_id", "source_type", "source_name", "version",
+                            "acquisition_date", "source_comment", "create_date", "update_date"],
+            "comment": ["comment_id", "commentator", "comment_text", "create_date", "update_date"]
+        }
+        # Fields package_itis_json needs in every document, always added to the field list of an export
+        self.itis_export_required_fields = ["tsn", "createDate", "updateDate", "hierarchySoFar",
+                                            "hierarchySoFarWRanks"]
 
     def package_itis_json(self, itisDoc):
         itis_data = {}
@@ -84,135 +430,79 @@ class ItisApi:
             itisDoc["date_created"] = itisDoc.pop("createDate")
             itisDoc["date_modified"] = itisDoc.pop("updateDate")
 
-            # Parse geographicDivision and jurisdiction into a more useful format
-            list_geographicDivision = itisDoc.pop("geographicDivision", None)
-            list_jurisdiction = itisDoc.pop("jurisdiction", None)
-
-            if list_geographicDivision is not None:
-                itisDoc["geographicDivision"] = list()
-                for geodiv in list_geographicDivision:
-                    itisDoc["geographicDivision"].append({
-                        "geographic_value": geodiv.split("$")[1],
-                        "update_date": geodiv.split("$")[2]
-                    })
-
-            if list_jurisdiction is not None:
-                itisDoc["jurisdiction"] = list()
-                for jur in list_jurisdiction:
-                    itisDoc["jurisdiction"].append({
-                        "jurisdiction_value": jur.split("$")[1],
-                        "origin": jur.split("$")[2],
-                        "update_date": jur.split("$")[3]
-                    })
+            # Parse the "$" delimited list properties into a more useful format
+            for list_property, field_names in self.itis_list_fields.items():
+                list_values = itisDoc.pop(list_property, None)
+                if list_values is not None:
+                    itisDoc[list_property] = [self.parse_itis_list_value(list_property, field_names, v)
+                                              for v in list_values]
 
-            # Parse expert(s) into a more useful format
-            list_expert = itisDoc.pop("expert", None)
-
-            if list_expert is not None:
-                itisDoc["expert"] = list()
-                for exp in list_expert:
-                    itisDoc["expert"].append({
-                        "reference_type": exp.split("$")[1],
-                        "expert_id": exp.split("$")[2],
-                        "expert_name": exp.split("$")[3],
-                        "expert_comment": exp.split("$")[4],
-                        "create_date": exp.split("$")[5],
-                        "update_date": exp.split("$")[6]
-                    })
-
-            # Parse publications(s) into a more useful format
-            list_publication = itisDoc.pop("publication", None)
-
-            if list_publication is not None:
-                itisDoc["publication"] = list()
-                for pub in list_publication:
-                    pub_doc = {
-                        "reference_type": pub.split("$")[1],
-                        "reference_id": pub.split("$")[2],
-                        "author": pub.split("$")[3],
-                        "title": pub.split("$")[5],
-                    }
-                    for index, var in enumerate(pub.split("$")[6:]):
-                        if len(var) > 0:
-                            pub_doc[f"other_variable_{index}"] = var
-                    itisDoc["publication"].append(pub_doc)
-
-            # Parse otherSource into a more useful format
-            list_other_source = itisDoc.pop("otherSource", None)
-
-            if list_other_source is not None:
-                itisDoc["otherSource"] = list()
-                for src in list_other_source:
-                    try:
-                        itisDoc["otherSource"].append({
-                            "reference_type": src.split("$")[1],
-                            "source_id": src.split("$")[2],
-                            "source_type": src.split("$")[3],
-                            "source_name": src.split("$")[4],
-                            "version": src.split("$")[5],
-                            "acquisition_date": src.split("$")[6],
-                            "source_comment": src.split("$")[7],
-                            "create_date": src.split("$")[8],
-                            "update_date": src.split("$")[9]
-                        })
-                    except:
-                        itisDoc["otherSource"].append({
-                            "raw_text": src
-                        })
-
-            # Parse comment into a more useful format
-            list_comment = itisDoc.pop("comment", None)
-
-            if list_comment is not None:
-                itisDoc["comment"] = list()
-                for comment in list_comment:
-                    try:
-                        itisDoc["comment"].append({
-                            "comment_id": comment.split("$")[1],
-                            "commentator": comment.split("$")[2],
-                            "comment_text": comment.split("$")[3],
-                            "create_date": comment.split("$")[4],
-                            "update_date": comment.split("$")[5]
-                        })
-                    except:
-                        itisDoc["comment"].append({
-                            "raw_text": comment
-                        })
-
-            # Make a clean structure of the taxonomic hierarchy
             # Make a clean structure of the taxonomic hierarchy
+            hierarchy_w_ranks = itisDoc.pop("hierarchySoFarWRanks")[0]
             itisDoc["biological_taxonomy"] = []
-            for rank in itisDoc['hierarchySoFarWRanks'][0][itisDoc['hierarchySoFarWRanks'][0].find(':$') + 2:-1].split(
-                    "$"):
-                thisRankName = {}
-                thisRankName["rank"] = rank.split(":")[0]
-                thisRankName["name"] = rank.split(":")[1]
-                itisDoc["biological_taxonomy"].append(thisRankName)
-            itisDoc.pop("hierarchySoFarWRanks", None)
+            for rank in hierarchy_w_ranks[hierarchy_w_ranks.find(':$') + 2:-1].split("$"):
+                rank_parts = rank.split(":")
+                itisDoc["biological_taxonomy"].append({
+                    "rank": rank_parts[0],
+                    "name": rank_parts[1]
+                })
 
             # Make a clean, usable list of the hierarchy so far for display or listing
-            itisDoc["hierarchy"] = itisDoc["hierarchySoFar"][0].split(":")[1][1:-1].split("$")
-            itisDoc.pop("hierarchySoFar", None)
+            itisDoc["hierarchy"] = itisDoc.pop("hierarchySoFar")[0].split(":")[1][1:-1].split("$")
 
             # Make a clean structure of common names
             if "vernacular" in itisDoc:
                 itisDoc["commonnames"] = []
-                for commonName in itisDoc['vernacular']:
-                    thisCommonName = {}
-                    thisCommonName["name"] = commonName.split('$')[1]
-                    thisCommonName["language"] = commonName.split('$')[2]
-                    itisDoc["commonnames"].append(thisCommonName)
-                itisDoc.pop("vernacular", None)
+                for commonName in itisDoc.pop("vernacular"):
+                    name_parts = commonName.split('$')
+                    itisDoc["commonnames"].append({
+                        "name": name_parts[1],
+                        "language": name_parts[2]
+                    })
 
             # Add the new ITIS doc to the ITIS data structure and return
             itis_data.update(itisDoc)
 
         return itis_data
 
+    def package_itis_docs(self, itisDocs):
+        '''
+        Runs package_itis_json over a list of ITIS Solr documents, e.g. a full export.
+
+        :param itisDocs: List of ITIS Solr documents
+        :return: List of packaged documents
+        '''
+        return [self.package_itis_json(d) for d in itisDocs]
+
+    def parse_itis_list_value(self, list_property, field_names, value):
+        '''
+        Splits one "$" delimited value from an ITIS list property into named fields using its itis_list_fields entry.
+        Field names map to positions 1..n of the split string; positions named None are skipped, and a trailing
+        "<prefix>*" name keeps any non-empty values after the named positions as <prefix>0, <prefix>1, ... Values with
+        too few parts to fill every position are kept as raw_text.
+        '''
+        parts = value.split("$")
+
+        extra_prefix = None
+        if field_names[-1] is not None and field_names[-1].endswith("*"):
+            field_names, extra_prefix = field_names[:-1], field_names[-1][:-1]
+
+        if len(parts) <= len(field_names):
+            return {"raw_text": value}
+
+        list_doc = {field_name: part for field_name, part in zip(field_names, parts[1:]) if field_name is not None}
+
+        if extra_prefix is not None:
+            for index, var in enumerate(parts[len(field_names) + 1:]):
+                if len(var) > 0:
+                    list_doc[f"{extra_prefix}{index}"] = var
+
+        return list_doc
+
     def get_itis_search_url(self, searchstr, fuzzy=False, validAccepted=True):
         fuzzyLevel = "~0.8"
 
-        api_stub = "https://services.itis.gov/?wt=json&rows=10&q="
+        api_stub = f"{self.itis_solr_api}&rows=10&q="
         search_term = "nameWOInd"
         searchstr = str(searchstr)
 
@@ -233,7 +523,95 @@ class ItisApi:
 
         return api
 
-    def search(self, sppin_key, name_source=None, source_date=None):
+    def get_itis_batch_search_url(self, searchstrs, rows, start=0):
+        '''
+        Builds a single ITIS Solr query that ORs together the exact match queries get_itis_search_url builds for each
+        of a list of names.
+
+        :param searchstrs: List of scientific names or TSNs
+        :param rows: Number of documents to return per page
+        :param start: Offset of the first document to return
+        :return: ITIS Solr query URL
+        '''
+        queries = [self.get_itis_search_url(s, False, False).split("&q=", 1)[1] for s in searchstrs]
+
+        return f"{self.itis_solr_api}&rows={rows}&start={start}&q={'%20OR%20'.join(queries)}"
+
+    def run_itis_batch_query(self, searchstrs, rows):
+        '''
+        Pages through a batch name query until every matching document has been retrieved.
+
+        :param searchstrs: List of scientific names or TSNs
+        :param rows: Number of documents to request per page
+        :return: List of all ITIS Solr documents matching any of the names
+        '''
+        docs = list()
+        start = 0
+        while True:
+            r_batch = self.run_itis_query(self.get_itis_batch_search_url(searchstrs, rows, start))
+            docs.extend(r_batch["response"]["docs"])
+            start += rows
+            if start >= r_batch["response"]["numFound"]:
+                return docs
+
+    def get_itis_export_url(self, query, fields, page_size, cursor_mark, sort):
+        '''
+        Builds one page of a cursorMark export query.
+
+        :param query: Solr query string, encoded the same way as the queries get_itis_search_url builds
+        :param fields: List of fields to return, or None for all fields
+        :param page_size: Number of documents per page
+        :param cursor_mark: Cursor returned by the previous page, "*" for the first page
+        :param sort: Solr sort clause, which must include the uniqueKey field for cursorMark paging
+        :return: ITIS Solr query URL
+        '''
+        api = f"{self.itis_solr_api}&rows={page_size}&sort={quote(sort)}&cursorMark={quote(cursor_mark, safe='')}"
+
+        if fields is not None:
+            api = f"{api}&fl={','.join(fields)}"
+
+        return f"{api}&q={query}"
+
+    def export(self, query, fields=None, page_size=1000, sort="tsn asc", package=True):
+        '''
+        Generator that pages through every document matching a Solr query using cursorMark, e.g. every valid TSN
+        under a family with query="hierarchyTSN:<family tsn>%20AND%20(usage:accepted%20OR%20usage:valid)". Unlike
+        start/rows paging, cursorMark paging does not slow down as the offset grows.
+
+        :param query: Solr query string, encoded the same way as the queries get_itis_search_url builds
+        :param fields: List of fields to return; the fields package_itis_json needs are added when packaging
+        :param page_size: Number of documents requested per page
+        :param sort: Solr sort clause; must include the uniqueKey field
+        :param package: Run each document through package_itis_json before yielding it
+        :return: Yields one ITIS document at a time
+        '''
+        if fields is not None and package:
+            fields = list(fields) + [f for f in self.itis_export_required_fields if f not in fields]
+
+        cursor_mark = "*"
+        while True:
+            r_page = self.run_itis_query(self.get_itis_export_url(query, fields, page_size, cursor_mark, sort))
+
+            for doc in r_page["response"]["docs"]:
+                yield self.package_itis_json(doc) if package else doc
+
+            # Solr returns the cursor it was given once there are no more documents
+            next_cursor_mark = r_page.get("nextCursorMark")
+            if next_cursor_mark is None or next_cursor_mark == cursor_mark:
+                return
+            cursor_mark = next_cursor_mark
+
+    def run_itis_query(self, query):
+        '''
+        Executes a query built by get_itis_search_url and returns the Solr response as a dictionary. Subclasses that
+        resolve names from somewhere other than the ITIS Solr service override this along with get_itis_search_url.
+
+        :param query: ITIS Solr query URL
+        :return: Dictionary in the Solr JSON response structure
+        '''
+        return self.transport.get(query).json()
+
+    def search_result_stub(self, sppin_key, name_source=None, source_date=None):
         itis_result = common_utils.processing_metadata()
         itis_result["sppin_key"] = sppin_key
         itis_result["date_processed"] = itis_result["processing_metadata"]["date_processed"]
@@ -248,18 +626,109 @@ class ItisApi:
         if source_date is not None:
             itis_result["processing_metadata"]["source_date"] = source_date
 
+        return itis_result
+
+    def search(self, sppin_key, name_source=None, source_date=None):
+        if self.negative_cache is not None:
+            known_miss = self.negative_cache.get(self.negative_source, sppin_key)
+            if known_miss is not None:
+                return known_miss
+
+        itis_result = self.search_result_stub(sppin_key, name_source=name_source, source_date=source_date)
+
         # Set up the primary search method for an exact match on scientific name
         url_exactMatch = self.get_itis_search_url(sppin_key.split(":")[1], False, False)
 
         # We have to try the main search queries because the ITIS service does not return an elegant error
         try:
-            r_exactMatch = requests.get(url_exactMatch).json()
+            r_exactMatch = self.run_itis_query(url_exactMatch)
         except:
             itis_result["processing_metadata"]["details"].append({"Hard Fail Query": url_exactMatch})
             itis_result["processing_metadata"]["status_message"] = "Hard Fail Query"
             itis_result["processing_metadata"]["status"] = "error"
             return itis_result
 
+        return self.resolve_exact_match(itis_result, url_exactMatch, r_exactMatch)
+
+    def search_batch(self, sppin_keys, batch_size=25, name_source=None, source_date=None):
+        '''
+        Runs the search process for a list of names, retrieving the exact match results for a whole batch of names
+        with one ITIS Solr query and splitting the documents back out to each name. Only names without an exact match
+        go on to individual fuzzy match queries. If the combined query fails, each name in that batch falls back to its
+        own exact match query.
+
+        :param sppin_keys: List of search keys in the form "Scientific Name:<name>" or "TSN:<tsn>"
+        :param batch_size: Number of names to combine in a single query
+        :param name_source: String indicating where the scientific names were sourced for tracking purposes
+        :param source_date: Date of the name source
+        :return: List of ITIS results in the order of sppin_keys, each the same as search returns for that key
+        '''
+        itis_results = list()
+
+        for i in range(0, len(sppin_keys), batch_size):
+            batch = sppin_keys[i:i + batch_size]
+            known_misses = dict()
+            if self.negative_cache is not None:
+                for sppin_key in batch:
+                    known_miss = self.negative_cache.get(self.negative_source, sppin_key)
+                    if known_miss is not None:
+                        known_misses[sppin_key] = known_miss
+            searchstrs = [k.split(":")[1] for k in batch if k not in known_misses]
+
+            batch_docs = list()
+            if len(searchstrs) > 0:
+                try:
+                    batch_docs = self.run_itis_batch_query(searchstrs, rows=len(searchstrs) * 2)
+                except Exception:
+                    batch_docs = None
+
+            for sppin_key in batch:
+                if sppin_key in known_misses:
+                    itis_results.append(known_misses[sppin_key])
+                    continue
+
+                searchstr = sppin_key.split(":")[1]
+                itis_result = self.search_result_stub(sppin_key, name_source=name_source, source_date=source_date)
+                url_exactMatch = self.get_itis_search_url(searchstr, False, False)
+
+                if batch_docs is None:
+                    # The combined query failed, so each name gets the single name query search would have run
+                    try:
+                        r_exactMatch = self.run_itis_query(url_exactMatch)
+                    except Exception:
+                        itis_result["processing_metadata"]["details"].append({"Hard Fail Query": url_exactMatch})
+                        itis_result["processing_metadata"]["status_message"] = "Hard Fail Query"
+                        itis_result["processing_metadata"]["status"] = "error"
+                        itis_results.append(itis_result)
+                        continue
+                    itis_results.append(self.resolve_exact_match(itis_result, url_exactMatch, r_exactMatch))
+                    continue
+
+                # Match documents back to the name using the same field the single name query searched on
+                search_term, search_value = url_exactMatch.split("&q=", 1)[1].split(":", 1)
+                search_value = " ".join(search_value.replace("\\%20", " ").split()).lower()
+                matched_docs = [
+                    dict(d) for d in batch_docs
+                    if " ".join(str(d.get(search_term, "")).split()).lower() == search_value
+                ]
+
+                r_exactMatch = {"response": {"numFound": len(matched_docs), "docs": matched_docs[:10]}}
+                itis_results.append(self.resolve_exact_match(itis_result, url_exactMatch, r_exactMatch))
+
+        return itis_results
+
+    def resolve_exact_match(self, itis_result, url_exactMatch, r_exactMatch):
+        '''
+        Works through the rest of the search process from the response to an exact match query: falls back to a fuzzy
+        match when nothing was found, follows accepted TSNs for invalid records, and builds the summary.
+
+        :param itis_result: Result stub from search_result_stub
+        :param url_exactMatch: Exact match query recorded in processing details
+        :param r_exactMatch: Solr response to the exact match query
+        :return: Completed ITIS result
+        '''
+        sppin_key = itis_result["sppin_key"]
+
         if r_exactMatch["response"]["numFound"] == 0:
 
             itis_result["processing_metadata"]["details"].append({"Exact Match Fail": url_exactMatch})
@@ -268,7 +737,7 @@ class ItisApi:
             url_fuzzyMatch = self.get_itis_search_url(sppin_key.split(":")[1], True, False)
 
             try:
-                r_fuzzyMatch = requests.get(url_fuzzyMatch).json()
+                r_fuzzyMatch = self.run_itis_query(url_fuzzyMatch)
             except:
                 itis_result["processing_metadata"]["details"].append({"Hard Fail Query": url_fuzzyMatch})
                 itis_result["processing_metadata"]["status_message"] = "Hard Fail Query"
@@ -278,6 +747,8 @@ class ItisApi:
             if r_fuzzyMatch["response"]["numFound"] == 0:
                 # If we still get no results then provide the specific detailed result
                 itis_result["processing_metadata"]["details"].append({"Fuzzy Match Fail": url_fuzzyMatch})
+                if self.negative_cache is not None:
+                    self.negative_cache.put(self.negative_source, itis_result)
                 return itis_result
 
             elif r_fuzzyMatch["response"]["numFound"] > 0:
@@ -287,11 +758,10 @@ class ItisApi:
                 # We need to check to see if the discovered ITIS record is accepted for use. If not, we need to follow
                 # the accepted TSN in that document
                 if r_fuzzyMatch["response"]["docs"][0]["usage"] in ["invalid", "not accepted"]:
-                    url_tsnSearch = self.get_itis_search_url(
-                        r_fuzzyMatch["response"]["docs"][0]["acceptedTSN"][0], False, False
+                    url_tsnSearch, accepted_doc = self.accepted_tsn_doc(
+                        r_fuzzyMatch["response"]["docs"][0]["acceptedTSN"][0]
                     )
-                    r_tsnSearch = requests.get(url_tsnSearch).json()
-                    itis_result["data"].append(self.package_itis_json(r_tsnSearch["response"]["docs"][0]))
+                    itis_result["data"].append(accepted_doc)
                     itis_result["processing_metadata"]["status"] = "success"
                     itis_result["processing_metadata"]["status_message"] = "Followed Accepted TSN"
                     itis_result["processing_metadata"]["details"].append({"TSN Search": url_tsnSearch})
@@ -312,11 +782,10 @@ class ItisApi:
             # We need to check to see if the discovered ITIS record is accepted for use. If not, we need to follow
             # the accepted TSN in that document
             if r_exactMatch["response"]["docs"][0]["usage"] in ["invalid", "not accepted"]:
-                url_tsnSearch = self.get_itis_search_url(
-                    r_exactMatch["response"]["docs"][0]["acceptedTSN"][0], False, False
+                url_tsnSearch, accepted_doc = self.accepted_tsn_doc(
+                    r_exactMatch["response"]["docs"][0]["acceptedTSN"][0]
                 )
-                r_tsnSearch = requests.get(url_tsnSearch).json()
-                itis_result["data"].append(self.package_itis_json(r_tsnSearch["response"]["docs"][0]))
+                itis_result["data"].append(accepted_doc)
                 itis_result["processing_metadata"]["status"] = "success"
                 itis_result["processing_metadata"]["status_message"] = "Followed Accepted TSN"
                 itis_result["processing_metadata"]["details"].append({"TSN Search": url_tsnSearch})
@@ -354,29 +823,397 @@ class ItisApi:
 
         return itis_result
 
-    def check_cache(self, mq_list, operation="processable", cache_threshold=30):
-        df_itis_cache = ItisCache().get_itis_cache()
-        search_key_list = [i["search_key"] for i in mq_list]
-        start_date = datetime.datetime.now() + datetime.timedelta(-cache_threshold)
-
-        if operation == "processable":
-            not_processable = df_itis_cache[
-                (df_itis_cache["processing_metadata.search_key"].isin(search_key_list))
-                &
-                (pd.to_datetime(df_itis_cache["processing_metadata.date_processed"]) > pd.to_datetime(start_date))
-                ]["processing_metadata.search_key"].tolist()
+    def accepted_tsn_doc(self, tsn):
+        '''
+        Retrieves and packages the ITIS document for an accepted TSN, reusing the identifier cache so that an accepted
+        record many names resolve to is only queried once.
+
+        :param tsn: Accepted TSN
+        :return: Tuple of the TSN query recorded in processing details and the packaged document
+        '''
+        url_tsnSearch = self.get_itis_search_url(tsn, False, False)
+
+        accepted_doc = self.identifier_cache.get(self.identifier_source, tsn)
+        if accepted_doc is None:
+            r_tsnSearch = self.run_itis_query(url_tsnSearch)
+            accepted_doc = self.package_itis_json(r_tsnSearch["response"]["docs"][0])
+            self.identifier_cache.put(self.identifier_source, tsn, accepted_doc)
+
+        return url_tsnSearch, accepted_doc
+
+    def check_cache(self, mq_list, operation="processable", cache_threshold=30,
+                    cache_location=os.getenv("DATA_CACHE"), db_name="sppin"):
+        '''
+        Checks a message queue list against the ITIS results in the Sql cache.
+
+        :param mq_list: List of message queue items with a search_key
+        :param operation: "processable" drops items with a result newer than cache_threshold; "flagged" sets in_cache
+        on every item
+        :param cache_threshold: Days a cached result is current
+        :param cache_location: Folder holding the Sql cache databases
+        :param db_name: Sql cache database name
+        :return: Filtered or flagged list
+        '''
+        source_cache = utils.SourceCache(cache_location=cache_location, db_name=db_name, ttls={"itis": cache_threshold})
+
+        return source_cache.filter_mq_list(mq_list, "itis", operation=operation)
+
+
+class ItisLocal(ItisApi):
+    def __init__(self, cache_location=os.getenv("DATA_CACHE"), fuzzy_prefix_length=1, transport=None,
+                 negative_cache=None, identifier_cache=None):
+        '''
+        Resolves names against the cached ITIS Sqlite database instead of the ITIS Solr service. The search workflow
+        (exact match, fuzzy match, following accepted TSNs, summary) is inherited from ItisApi; this class only swaps
+        out how queries are built and executed. Documents are assembled into the same structure the Solr service
+        returns so that they run through the same package_itis_json routine.
+
+        :param cache_location: Folder containing (or to receive) ITIS.sqlite. Defaults to 'DATA_CACHE' environment
+        variable.
+        :param fuzzy_prefix_length: Number of leading characters that must match exactly for a fuzzy match candidate.
+        The Solr service uses 0; 1 keeps the candidate scan small without losing the typical misspelled epithet.
+        :param transport: utils.Transport used if the database needs to be downloaded
+        :param negative_cache: utils.NegativeCache of names known not to resolve
+        :param identifier_cache: utils.IdentifierCache for accepted TSN documents
+        '''
+        super().__init__(transport=transport, negative_cache=negative_cache, identifier_cache=identifier_cache)
+        self.description = "Set of functions for resolving names against the cached ITIS Sqlite database"
+        self.identifier_source = "itis_local"
+        self.negative_source = "itis_local"
+        self.cache_location = cache_location
+        self.fuzzy_prefix_length = fuzzy_prefix_length
+        self.fuzzy_similarity = 0.8
+        self.max_rows = 10
+        self.name_fields = ["nameWOInd", "nameWInd"]
+        self._con = None
+        self._taxa = None
+        self._name_index = None
+        self._fuzzy_index = None
+
+    def search_batch(self, sppin_keys, batch_size=25, name_source=None, source_date=None):
+        '''
+        Names are resolved one at a time against the local database; there is no round trip to save by batching.
+        batch_size is accepted for compatibility with ItisApi.search_batch.
+        '''
+        return [self.search(k, name_source=name_source, source_date=source_date) for k in sppin_keys]
+
+    @property
+    def con(self):
+        if self._con is None:
+            self._con = ItisDb(transport=self.transport).itis_db(cache_location=self.cache_location)
+            self._con.row_factory = sqlite3.Row
+        return self._con
+
+    def load_name_index(self):
+        '''
+        Reads the name, parent and rank of every taxonomic unit into memory once. Everything needed to match names and
+        assemble hierarchies is answered from these dictionaries; only the documents actually returned hit the
+        database again.
+        '''
+        if self._taxa is not None:
+            return
+
+        self._taxa = dict()
+        self._name_index = {k: dict() for k in self.name_fields}
+        self._fuzzy_index = {k: dict() for k in self.name_fields}
+
+        sql = """
+            SELECT tu.tsn, tu.parent_tsn, tu.complete_name, tu.unit_name1, tu.unit_name2, tu.unit_name3,
+            tu.unit_name4, tut.rank_name
+            FROM taxonomic_units tu
+            JOIN taxon_unit_types tut ON tut.kingdom_id = tu.kingdom_id AND tut.rank_id = tu.rank_id
+            ORDER BY tu.tsn
+        """
+        for row in self.con.execute(sql):
+            name_w_ind = " ".join(row["complete_name"].split())
+            name_wo_ind = " ".join(
+                n.strip() for n in [row["unit_name1"], row["unit_name2"], row["unit_name3"], row["unit_name4"]]
+                if n is not None and len(n.strip()) > 0
+            )
+            self._taxa[row["tsn"]] = (row["parent_tsn"], row["rank_name"].strip(), name_w_ind)
+
+            for field, name in zip(self.name_fields, [name_wo_ind, name_w_ind]):
+                name = name.lower()
+                self._name_index[field].setdefault(name, list()).append(row["tsn"])
+                bucket = (name[:self.fuzzy_prefix_length], len(name))
+                if len(self._name_index[field][name]) == 1:
+                    self._fuzzy_index[field].setdefault(bucket, list()).append(name)
 
-            new_list = [i for i in mq_list if i["search_key"] not in not_processable]
-
-            return new_list
+    def get_itis_search_url(self, searchstr, fuzzy=False, validAccepted=True):
+        '''
+        Builds the local equivalent of the ITIS Solr query, e.g. "nameWOInd:Canis lupus~0.8". The string is what is
+        recorded in processing_metadata details in place of the service URL.
+        '''
+        search_term = "nameWOInd"
+        searchstr = " ".join(str(searchstr).split())
 
-        elif operation == "flagged":
-            in_cache_list = df_itis_cache[df_itis_cache["processing_metadata.search_key"].isin(search_key_list)][
-                "processing_metadata.search_key"].tolist()
-            flagged_list = [dict(item, **{'in_cache': False}) for item in mq_list]
-            flagged_list = [dict(item, **{'in_cache': True}) for item in flagged_list if
-                           item["search_key"] in in_cache_list]
+        if searchstr.isdigit():
+            search_term = "tsn"
+        elif searchstr.find("var.") > 0 or searchstr.find("ssp.") > 0 or searchstr.find(" x ") > 0:
+            search_term = "nameWInd"
 
-            return flagged_list
+        query = f"{search_term}:{searchstr}"
 
+        if fuzzy:
+            query = f"{query}~{self.fuzzy_similarity}"
 
+        if validAccepted:
+            query = f"{query} AND (usage:accepted OR usage:valid)"
+
+        return query
+
+    def run_itis_query(self, query):
+        '''
+        Executes a query built by get_itis_search_url against the cached ITIS database.
+
+        :param query: Local query string
+        :return: Dictionary in the Solr JSON response structure
+        '''
+        tsns, valid_accepted = self.query_tsns(query)
+
+        docs = list()
+        num_found = 0
+        for tsn in tsns:
+            if valid_accepted or len(docs) < self.max_rows:
+                doc = self.build_itis_doc(tsn)
+                if valid_accepted and doc["usage"] not in ["accepted", "valid"]:
+                    continue
+                num_found += 1
+                if len(docs) < self.max_rows:
+                    docs.append(doc)
+            else:
+                num_found += 1
+
+        return {"response": {"numFound": num_found, "start": 0, "docs": docs}}
+
+    def query_tsns(self, query):
+        '''
+        Resolves a local query string to the TSNs it matches. Handles the queries get_itis_search_url builds, plus
+        "hierarchyTSN:<tsn>" for a taxon and everything below it and "*:*" for every taxon.
+
+        :param query: Local query string
+        :return: Tuple of the list of TSNs and whether only valid/accepted records were asked for
+        '''
+        self.load_name_index()
+
+        valid_accepted = query.endswith(" AND (usage:accepted OR usage:valid)")
+        if valid_accepted:
+            query = query[:-len(" AND (usage:accepted OR usage:valid)")]
+
+        if query == "*:*":
+            return list(self._taxa.keys()), valid_accepted
+
+        search_term, searchstr = query.split(":", 1)
+
+        if search_term == "tsn":
+            tsns = [int(searchstr)] if int(searchstr) in self._taxa else list()
+        elif search_term == "hierarchyTSN":
+            descendants = ItisHierarchy(cache_location=self.cache_location, transport=self.transport).load() \
+                .descendants(int(searchstr), valid_only=False)
+            tsns = list() if descendants is None else [int(searchstr)] + [int(t) for t in descendants]
+        elif search_term not in self.name_fields:
+            raise ValueError(f"Unsupported field for a local ITIS query: {search_term}")
+        elif searchstr.endswith(f"~{self.fuzzy_similarity}"):
+            tsns = self.fuzzy_tsns(search_term, searchstr[:-len(f"~{self.fuzzy_similarity}")])
+        else:
+            tsns = self._name_index[search_term].get(searchstr.lower(), list())
+
+        return tsns, valid_accepted
+
+    def export(self, query, fields=None, page_size=1000, sort="tsn asc", package=True):
+        '''
+        Local equivalent of ItisApi.export, generating every document matching a query from the cached database.
+        Takes the same Solr style queries (URL encoded or not) for the fields query_tsns handles, e.g.
+        "hierarchyTSN:<family tsn>%20AND%20(usage:accepted%20OR%20usage:valid)". page_size is accepted for
+        compatibility; there are no pages to request locally.
+
+        :param query: Query string
+        :param fields: List of fields to return; the fields package_itis_json needs are added when packaging
+        :param page_size: Not used
+        :param sort: "tsn asc" or "tsn desc"
+        :param package: Run each document through package_itis_json before yielding it
+        :return: Yields one ITIS document at a time
+        '''
+        if sort not in ["tsn asc", "tsn desc"]:
+            raise ValueError("Local ITIS exports can only be sorted on tsn")
+
+        if fields is not None and package:
+            fields = list(fields) + [f for f in self.itis_export_required_fields if f not in fields]
+
+        tsns, valid_accepted = self.query_tsns(unquote(query).replace("\\ ", " "))
+
+        for tsn in sorted(set(tsns), reverse=sort == "tsn desc"):
+            doc = self.build_itis_doc(tsn)
+            if valid_accepted and doc["usage"] not in ["accepted", "valid"]:
+                continue
+            if fields is not None:
+                doc = {k: v for k, v in doc.items() if k in fields}
+            yield self.package_itis_json(doc) if package else doc
+
+    def fuzzy_tsns(self, search_term, searchstr):
+        '''
+        Approximates the Solr fuzzy query: a candidate matches when its edit distance is within
+        (1 - similarity) * length of the search string, capped at 2 edits. Matches are ordered by edit distance.
+        '''
+        searchstr = searchstr.lower()
+        max_edits = min(int((1 - self.fuzzy_similarity) * len(searchstr)), 2)
+        prefix = searchstr[:self.fuzzy_prefix_length]
+
+        matches = list()
+        for length in range(len(searchstr) - max_edits, len(searchstr) + max_edits + 1):
+            for name in self._fuzzy_index[search_term].get((prefix, length), list()):
+                distance = _edit_distance(searchstr, name, max_edits)
+                if distance <= max_edits:
+                    matches.append((distance, name))
+
+        tsns = list()
+        for distance, name in sorted(matches):
+            tsns.extend(self._name_index[search_term][name])
+
+        return tsns
+
+    def hierarchy_strings(self, tsn):
+        lineage = list()
+        current_tsn = tsn
+        while current_tsn in self._taxa and current_tsn not in lineage:
+            lineage.append(current_tsn)
+            current_tsn = self._taxa[current_tsn][0]
+        lineage.reverse()
+
+        with_ranks = "$".join(f"{self._taxa[t][1]}:{self._taxa[t][2]}" for t in lineage)
+        without_ranks = "$".join(self._taxa[t][2] for t in lineage)
+
+        return f"{tsn}:${with_ranks}$", f"{tsn}:${without_ranks}$"
+
+    def build_itis_doc(self, tsn):
+        '''
+        Assembles a document for a TSN from the ITIS database tables in the form returned by the ITIS Solr service,
+        including the "$" delimited strings for list properties.
+
+        :param tsn: ITIS Taxonomic Serial Number
+        :return: Dictionary matching an ITIS Solr document
+        '''
+        self.load_name_index()
+
+        sql = """
+            SELECT tu.*, k.kingdom_name, tut.rank_name, a.taxon_author
+            FROM taxonomic_units tu
+            JOIN kingdoms k ON k.kingdom_id = tu.kingdom_id
+            JOIN taxon_unit_types tut ON tut.kingdom_id = tu.kingdom_id AND tut.rank_id = tu.rank_id
+            LEFT JOIN taxon_authors_lkp a ON a.taxon_author_id = tu.taxon_author_id
+            WHERE tu.tsn = ?
+        """
+        tu = self.con.execute(sql, [tsn]).fetchone()
+
+        hierarchy_w_ranks, hierarchy = self.hierarchy_strings(tsn)
+
+        itis_doc = {
+            "tsn": str(tsn),
+            "nameWInd": " ".join(tu["complete_name"].split()),
+            "nameWOInd": " ".join(
+                n.strip() for n in [tu["unit_name1"], tu["unit_name2"], tu["unit_name3"], tu["unit_name4"]]
+                if n is not None and len(n.strip()) > 0
+            ),
+            "usage": tu["name_usage"].strip(),
+            "unacceptReason": tu["unaccept_reason"],
+            "credibilityRating": tu["credibility_rtng"],
+            "completenessRating": tu["completeness_rtng"],
+            "currencyRating": tu["currency_rating"],
+            "kingdom": tu["kingdom_name"].strip(),
+            "rank": tu["rank_name"].strip(),
+            "rankID": tu["rank_id"],
+            "parentTSN": str(tu["parent_tsn"]),
+            "taxonAuthor": tu["taxon_author"],
+            "createDate": tu["initial_time_stamp"],
+            "updateDate": tu["update_date"],
+            "hierarchySoFarWRanks": [hierarchy_w_ranks],
+            "hierarchySoFar": [hierarchy]
+        }
+
+        for i in range(1, 5):
+            if tu[f"unit_name{i}"] is not None and len(tu[f"unit_name{i}"].strip()) > 0:
+                itis_doc[f"unit{i}"] = tu[f"unit_name{i}"].strip()
+            if tu[f"unit_ind{i}"] is not None and len(tu[f"unit_ind{i}"].strip()) > 0:
+                itis_doc[f"unitInd{i}"] = tu[f"unit_ind{i}"].strip()
+
+        accepted_tsns = [
+            str(r["tsn_accepted"]) for r in
+            self.con.execute("SELECT tsn_accepted FROM synonym_links WHERE tsn = ?", [tsn])
+        ]
+        if len(accepted_tsns) > 0:
+            itis_doc["acceptedTSN"] = accepted_tsns
+
+        # Column order in each query matches the position of values in the "$" delimited strings from Solr
+        list_queries = {
+            "vernacular": """
+                SELECT vernacular_name, language, approved_ind, vern_id, update_date FROM vernaculars WHERE tsn = ?
+            """,
+            "jurisdiction": """
+                SELECT jurisdiction_value, origin, update_date FROM jurisdiction WHERE tsn = ?
+            """,
+            "geographicDivision": """
+                SELECT geographic_value, update_date FROM geographic_div WHERE tsn = ?
+            """,
+            "expert": """
+                SELECT e.expert_id_prefix, e.expert_id, e.expert, e.exp_comment, rl.update_date, e.update_date
+                FROM reference_links rl
+                JOIN experts e ON e.expert_id_prefix = rl.doc_id_prefix AND e.expert_id = rl.documentation_id
+                WHERE rl.tsn = ?
+            """,
+            "publication": """
+                SELECT p.pub_id_prefix, p.publication_id, p.reference_author, p.actual_pub_date, p.title,
+                p.publication_name, p.listed_pub_date, p.publisher, p.pub_place, p.isbn, p.issn, p.pages,
+                p.pub_comment, p.update_date
+                FROM reference_links rl
+                JOIN publications p ON p.pub_id_prefix = rl.doc_id_prefix AND p.publication_id = rl.documentation_id
+                WHERE rl.tsn = ?
+            """,
+            "otherSource": """
+                SELECT o.source_id_prefix, o.source_id, o.source_type, o.source, o.version, o.acquisition_date,
+                o.source_comment, rl.update_date, o.update_date
+                FROM reference_links rl
+                JOIN other_sources o ON o.source_id_prefix = rl.doc_id_prefix AND o.source_id = rl.documentation_id
+                WHERE rl.tsn = ?
+            """,
+            "comment": """
+                SELECT c.comment_id, c.commentator, c.comment_detail, c.comment_time_stamp, c.update_date
+                FROM tu_comment_links tcl
+                JOIN comments c ON c.comment_id = tcl.comment_id
+                WHERE tcl.tsn = ?
+            """
+        }
+
+        for field, sql in list_queries.items():
+            values = [
+                "$" + "$".join("" if v is None else str(v).strip() for v in r) + "$"
+                for r in self.con.execute(sql, [tsn])
+            ]
+            if len(values) > 0:
+                itis_doc[field] = values
+
+        return {k: v for k, v in itis_doc.items() if v is not None}
+
+
+def _edit_distance(a, b, max_distance):
+    '''
+    Levenshtein distance between two strings that gives up as soon as every path exceeds max_distance.
+
+    :return: The edit distance, or max_distance + 1 if it is larger than max_distance
+    '''
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (ca != cb)
+            ))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+
+    return previous[-1]
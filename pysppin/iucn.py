@@ -1,4 +1,3 @@
-import requests
 import os
 import re
 from . import utils
@@ -6,7 +5,9 @@ from . import utils
 common_utils = utils.Utils()
 
 class Iucn:
-    def __init__(self):
+    def __init__(self, transport=None, negative_cache=None):
+        self.transport = transport if transport is not None else utils.default_transport
+        self.negative_cache = negative_cache
         self.iucn_api_base = "http://apiv3.iucnredlist.org/api/v3"
         self.iucn_species_api = f"{self.iucn_api_base}/species"
         self.iucn_threats_api = f"{self.iucn_api_base}/threats/species/id"
@@ -33,6 +34,11 @@ class Iucn:
         }
 
     def search_species(self, sppin_key, name_source=None):
+        if self.negative_cache is not None:
+            known_miss = self.negative_cache.get("iucn", sppin_key)
+            if known_miss is not None:
+                return known_miss
+
         sppin_key_parts = sppin_key.split(":")
         scientificname = sppin_key_parts[1]
 
@@ -50,7 +56,7 @@ class Iucn:
             result["processing_metadata"]["status_message"] = "API token not present to run IUCN Red List query"
             return result
 
-        iucn_response = requests.get(
+        iucn_response = self.transport.get(
             f'{result["processing_metadata"]["api"]}?token={os.environ["token_iucn"]}'
         )
 
@@ -71,6 +77,8 @@ class Iucn:
         if "result" not in iucn_species_data.keys() or len(iucn_species_data["result"]) == 0:
             result["processing_metadata"]["status"] = "failure"
             result["processing_metadata"]["status_message"] = "Species Name Not Found"
+            if self.negative_cache is not None:
+                self.negative_cache.put("iucn", result)
             return result
 
         result["processing_metadata"]["status"] = "success"
@@ -84,7 +92,7 @@ class Iucn:
             "iucn_population_trend": iucn_species_data['result'][0]['population_trend'],
         }
 
-        iucn_citation_response = requests.get(
+        iucn_citation_response = self.transport.get(
             f"{self.iucn_citation_api}/{result['data']['iucn_taxonid']}?token={os.environ['token_iucn']}"
         ).json()
 
@@ -1,4 +1,3 @@
-import requests
 import xmltodict
 from . import utils
 
@@ -6,8 +5,10 @@ common_utils = utils.Utils()
 
 
 class Natureserve:
-    def __init__(self):
+    def __init__(self, transport=None, negative_cache=None):
         self.description = "Set of functions for working with the NatureServe APIs"
+        self.transport = transport if transport is not None else utils.default_transport
+        self.negative_cache = negative_cache
         self.ns_api_base = "https://services.natureserve.org/idd/rest/v1"
         self.us_name_search_api = "nationalSpecies/summary/nameSearch?nationCode=US"
 
@@ -21,6 +22,11 @@ class Natureserve:
         :return: Dictionary structure containing the results of the name search and the information from the API
         transformed to a dictionary from XML
         '''
+        if self.negative_cache is not None:
+            known_miss = self.negative_cache.get("natureserve", sppin_key)
+            if known_miss is not None:
+                return known_miss
+
         sppin_key_parts = sppin_key.split(":")
         scientificname = sppin_key_parts[1]
 
@@ -37,16 +43,14 @@ class Natureserve:
             "Name Source": name_source
         }
 
-        ns_api_result = requests.get(result["processing_metadata"]["api"])
+        ns_api_result = self.transport.get(result["processing_metadata"]["api"])
 
         if ns_api_result.status_code != 200:
             return None
         else:
             ns_dict = xmltodict.parse(ns_api_result.text, dict_constructor=dict)
 
-            if "species" not in ns_dict["speciesList"].keys():
-                return result
-            else:
+            if "species" in ns_dict["speciesList"].keys():
                 if isinstance(ns_dict["speciesList"]["species"], list):
                     ns_species = next(
                         (
@@ -64,6 +68,9 @@ class Natureserve:
                     result["processing_metadata"]["status"] = "success"
                     result["processing_metadata"]["status_message"] = "Single Match"
 
+        if result["processing_metadata"]["status"] == "failure" and self.negative_cache is not None:
+            self.negative_cache.put("natureserve", result)
+
         return result
 
 
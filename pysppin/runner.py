@@ -0,0 +1,226 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from . import utils
+from . import aio
+
+# Remote host each source searches against, used to share one rate limit between sources on the same host
+source_hosts = {
+    "itis": "services.itis.gov",
+    "worms": "www.marinespecies.org",
+    "gbif": "api.gbif.org",
+    "iucn": "apiv3.iucnredlist.org",
+    "natureserve": "services.natureserve.org",
+    "sgcn": "api.sciencebase.gov",
+    "tess": "ecos.fws.gov"
+}
+
+# Searches per second allowed against hosts that throttle us
+default_rate_limits = {
+    "apiv3.iucnredlist.org": 2,
+    "www.marinespecies.org": 5
+}
+
+
+def run_search(source, sppin_key, name_source=None, transport=None, negative_cache=None):
+    '''
+    Module level entry point for a single search so that it can be sent to a process pool.
+    '''
+    return aio.source_searches[source](transport, sppin_key, name_source, negative_cache)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        '''
+        Thread safe token bucket allowing rate events per second on average, with bursts up to capacity.
+
+        :param rate: Tokens added per second
+        :param capacity: Maximum tokens held; defaults to rate (one second of burst)
+        '''
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class Runner:
+    def __init__(self, cache_location, db_name="sppin", max_workers=8, executor="thread", rate_limits=None,
+                 transport=None, negative_cache_ttls=None, use_negative_cache=True):
+        '''
+        Drains message queue lists built with Utils.spp_queue_assembler or Utils.tsn_queue_assembler by running the
+        matching source search in a bounded worker pool and upserting each result to the Sql cache as it completes.
+
+        :param cache_location: Folder holding the Sql cache databases
+        :param db_name: Sql cache database name
+        :param max_workers: Number of searches run at the same time
+        :param executor: "thread" or "process"; process pools use the default transport in each worker
+        :param rate_limits: Dictionary of host to searches per second, updating default_rate_limits
+        :param transport: utils.Transport shared by thread workers
+        :param negative_cache_ttls: Dictionary of source to days a known miss is trusted, updating
+        utils.default_negative_cache_ttls
+        :param use_negative_cache: Skip names a source recently failed to resolve (thread executor only)
+        '''
+        self.description = "Bulk processor for source search message queues"
+        self.sql = utils.Sql(cache_location=cache_location)
+        self.negative_cache = utils.NegativeCache(db_name=db_name, ttls=negative_cache_ttls, sql=self.sql) \
+            if use_negative_cache else None
+        self.db_name = db_name
+        self.max_workers = max_workers
+        self.executor = executor
+        self.transport = transport
+        self.rate_limits = dict(default_rate_limits)
+        if rate_limits is not None:
+            self.rate_limits.update(rate_limits)
+        self.buckets = dict()
+
+    def bucket(self, source):
+        host = source_hosts.get(source, source)
+        if host not in self.rate_limits or self.rate_limits[host] is None:
+            return None
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.rate_limits[host])
+        return self.buckets[host]
+
+    def finished_keys(self, table_name, currency_threshold=None):
+        '''
+        Lists the sppin_key values that already have a record in a source table so that an interrupted run can pick
+        up where it left off. Records with an error status do not count as finished, so those names are searched
+        again.
+
+        :param table_name: Source table in the Sql cache
+        :param currency_threshold: If provided, only records processed within this many days count as finished
+        :return: Set of sppin_key values
+        '''
+        db = self.sql.get_db(self.db_name)
+
+        if not db[table_name].exists():
+            return set()
+
+        conditions = list()
+        values = list()
+        if "processing_metadata" in db[table_name].columns_dict:
+            conditions.append("ifnull(json_extract(processing_metadata, '$.status'), '') != 'error'")
+        if currency_threshold is not None:
+            conditions.append("date_processed > ?")
+            values.append(utils.currency_date(currency_threshold))
+
+        sql = f"SELECT sppin_key FROM [{table_name}]"
+        if len(conditions) > 0:
+            sql = f"{sql} WHERE {' AND '.join(conditions)}"
+
+        return set(r[0] for r in db.execute(sql, values).fetchall())
+
+    def run(self, mq_list, source, name_source=None, table_name=None, resume=True, currency_threshold=None,
+            report_every=100, progress=None):
+        '''
+        Runs the search for source on every item in a message queue list.
+
+        :param mq_list: List of message queue items with a search_key in the form "Scientific Name:<name>" or
+        "TSN:<tsn>"
+        :param source: Key from aio.source_searches
+        :param name_source: String indicating where the names were sourced for tracking purposes
+        :param table_name: Sql cache table to write results to; defaults to the source name
+        :param resume: Skip items whose search_key already has a record in the table
+        :param currency_threshold: Passed to finished_keys when resuming
+        :param report_every: Call progress after this many completed searches
+        :param progress: Optional function called as progress(source, completed, pending, names_per_second) to
+        report throughput during the run, e.g. to log or print it
+        :return: Dictionary summarizing the run; errors counts searches that failed and results that could not be
+        written, neither of which stops the run
+        '''
+        if table_name is None:
+            table_name = source
+
+        run_report = {
+            "source": source,
+            "submitted": 0,
+            "completed": 0,
+            "skipped": 0,
+            "errors": 0
+        }
+
+        if resume:
+            done = self.finished_keys(table_name, currency_threshold=currency_threshold)
+            pending = [i for i in mq_list if i["search_key"] not in done]
+            run_report["skipped"] = len(mq_list) - len(pending)
+        else:
+            pending = list(mq_list)
+
+        if self.executor == "process":
+            pool = ProcessPoolExecutor(max_workers=self.max_workers)
+            transport = None
+            negative_cache = None
+        else:
+            pool = ThreadPoolExecutor(max_workers=self.max_workers)
+            transport = self.transport
+            negative_cache = self.negative_cache
+
+        bucket = self.bucket(source)
+        start_time = time.monotonic()
+        in_flight = dict()
+        queue = iter(pending)
+
+        with pool:
+            while True:
+                # Keep the pool busy without queuing up every item in the list at once
+                while len(in_flight) < self.max_workers * 2:
+                    item = next(queue, None)
+                    if item is None:
+                        break
+                    if bucket is not None:
+                        bucket.acquire()
+                    future = pool.submit(run_search, source, item["search_key"], name_source, transport, negative_cache)
+                    in_flight[future] = item
+                    run_report["submitted"] += 1
+
+                if len(in_flight) == 0:
+                    break
+
+                completed, _ = wait(in_flight.keys(), return_when=FIRST_COMPLETED)
+                for future in completed:
+                    item = in_flight.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception:
+                        result = None
+
+                    if result is None:
+                        run_report["errors"] += 1
+                        continue
+
+                    result.setdefault("sppin_key", item["search_key"])
+                    result.setdefault("date_processed", result["processing_metadata"]["date_processed"])
+                    if result["processing_metadata"]["status"] == "error":
+                        run_report["errors"] += 1
+
+                    try:
+                        self.sql.upsert_record(self.db_name, table_name, result)
+                    except Exception:
+                        # One result that cannot be written should not stop the rest of the run
+                        run_report["errors"] += 1
+                        continue
+                    run_report["completed"] += 1
+
+                    if progress is not None and report_every and run_report["completed"] % report_every == 0:
+                        elapsed = time.monotonic() - start_time
+                        progress(source, run_report["completed"], len(pending),
+                                 run_report["completed"] / elapsed if elapsed > 0 else None)
+
+        run_report["elapsed_seconds"] = time.monotonic() - start_time
+        run_report["names_per_second"] = run_report["completed"] / run_report["elapsed_seconds"] \
+            if run_report["elapsed_seconds"] > 0 else None
+
+        return run_report
@@ -1,12 +1,12 @@
-import requests
 from . import utils
 
 common_utils = utils.Utils()
 
 
 class Search:
-    def __init__(self):
+    def __init__(self, transport=None):
         self.description = "Set of functions for searching the Species of Greatest Conservation Need API"
+        self.transport = transport if transport is not None else utils.default_transport
         self.sgcn_spp_search_api = "https://api.sciencebase.gov/bis-api/api/v1/swap/nationallist"
 
     def search(self, scientificname, name_source=None):
@@ -20,7 +20,7 @@ class Search:
             "Name Source": name_source
         }
 
-        r_search = requests.get(result["processing_metadata"]["api"]).json()
+        r_search = self.transport.get(result["processing_metadata"]["api"]).json()
         sgcn_species = next((i["_source"]["properties"] for i in r_search["hits"]["hits"]
                                        if i["_source"]["properties"]["scientificname"] == scientificname), None)
 
@@ -1,4 +1,5 @@
 import datetime
+import copy
 from collections import Counter
 import random
 import os
@@ -11,8 +12,199 @@ import re
 from ftfy import fix_text
 import pandas as pd
 import sqlite3
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from functools import lru_cache, wraps
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import Mapping
+from multiprocessing import Pool
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from sqlite_utils import Database
-from pandas.io.json import json_normalize
+
+
+class Transport:
+    def __init__(self, pool_size=10, timeout=60, retries=3, backoff_factor=0.5,
+                 retry_status=(429, 500, 502, 503, 504)):
+        '''
+        Shared HTTP transport for the source modules. Keeps one keep-alive requests.Session per host so that
+        connections are reused across queries, and retries connection errors and transient server errors with
+        exponential backoff. After the last retry the response is returned as is so that callers can keep checking
+        status codes the way they always have.
+
+        :param pool_size: Maximum number of pooled connections kept open per host
+        :param timeout: Default timeout in seconds (connect and read) for each request
+        :param retries: Number of retries on connection errors and retry_status responses
+        :param backoff_factor: Sleep between retries is backoff_factor * (2 ** (retry number - 1)) seconds
+        :param retry_status: HTTP status codes that will be retried
+        '''
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.retry_status = retry_status
+        self.sessions = dict()
+        self._lock = threading.Lock()
+
+    def session(self, url):
+        '''
+        Returns the pooled session for the host of a URL, creating it on first use.
+
+        :param url: Any URL on the host
+        :return: requests.Session
+        '''
+        parsed_url = urlparse(url)
+        host = f"{parsed_url.scheme}://{parsed_url.netloc}"
+
+        with self._lock:
+            if host not in self.sessions:
+                retry = Retry(
+                    total=self.retries,
+                    backoff_factor=self.backoff_factor,
+                    status_forcelist=self.retry_status,
+                    raise_on_status=False
+                )
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+                session = requests.Session()
+                session.mount(f"{parsed_url.scheme}://", adapter)
+                self.sessions[host] = session
+
+            return self.sessions[host]
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session(url).get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session(url).post(url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = dict()
+
+
+default_transport = Transport()
+
+
+# Patterns used by compiled_clean_scientific_name, compiled once for bulk name cleaning
+
+# Particular words are used to describe variations or nuances in taxonomy but are not able to be used in matching
+# names at this time; names are cut off at the first of these
+after_chars = ["(", " AND ", "/", " & ", " vs ", " undescribed ", ",", " formerly ", " near ", "Columbia Basin",
+               "Puget Trough", " n.sp. ", " n. ", " sp. ", " sp ", " pop. ", " spp. ", " cf. ", " ] "]
+re_after_chars = re.compile(r'|'.join(map(re.escape, after_chars)))
+# Remove digits, we can't work with these right now
+re_digits = re.compile(r'\d+')
+# Get rid of strings in parentheses and brackets (these might need to be revisited eventually, but we can often find
+# a match without this information)
+re_bracketed = re.compile(r'[\(\[\"].*?[\)\]\"]')
+# Remove some specific substrings
+re_remove = re.compile(r'|'.join(map(re.escape, ["?", "Family "])))
+# Printable ASCII without "&" (HTML entities) is left unchanged by fix_text
+re_fix_text_safe = re.compile(r'[\x20-\x25\x27-\x7e]*\Z')
+
+
+def compiled_clean_scientific_name(scientificname):
+    '''
+    Cleans up a raw scientific name for matching: fixes text encoding, drops digits and bracketed or quoted text,
+    truncates at words that describe taxonomic nuances we cannot match on (afterChars), and normalizes subspecies,
+    variety and hybrid indicators. Patterns are precompiled, fix_text is skipped where it cannot change anything,
+    and the afterChars truncation takes one regex search per cut. Defined at module level so it can be sent to
+    worker processes; Utils.clean_scientific_name puts it behind the name cache.
+    '''
+    if isinstance(scientificname, float):
+        return None
+
+    nameString = str(scientificname)
+
+    # Fix encoding translation issues
+    if re_fix_text_safe.match(nameString) is None:
+        nameString = fix_text(nameString)
+
+    nameString = re_digits.sub('', nameString)
+    nameString = re_bracketed.sub("", nameString)
+    nameString = ' '.join(nameString.split())
+    nameString = re_remove.sub('', nameString)
+
+    # Change uses of "subsp." to "ssp." for ITIS
+    nameString = nameString.replace("subsp.", "ssp.")
+
+    # Cutting at a match and appending a space can expose a new match at the end of the string (e.g. " sp "), so
+    # keep cutting at the leftmost match until there are none
+    nameString = nameString + " "
+    match = re_after_chars.search(nameString)
+    while match is not None:
+        nameString = nameString[:match.start()] + " "
+        match = re_after_chars.search(nameString)
+
+    nameString = nameString.strip()
+
+    # Deal with cases where an "_" was used
+    if nameString.find("_") != -1:
+        nameString = ' '.join(nameString.split("_"))
+
+    # Check to make sure there is actually a subspecies or variety name supplied
+    if len(nameString) > 0:
+        namesList = nameString.split(" ")
+        if namesList[-1] in ["ssp.", "var."]:
+            nameString = ' '.join(namesList[:-1])
+
+    # Take care of capitalizing final cross indicator
+    nameString = nameString.replace(" x ", " X ")
+
+    return nameString.capitalize()
+
+
+common_properties = None
+
+
+def currency_date(days):
+    '''
+    Cutoff for how old a cached record can be and still count as current. Records are stamped with UTC
+    processing dates, so the cutoff is UTC as well.
+
+    :param days: Age limit in days; the sign is ignored so that negative thresholds work the same way
+    :return: ISO date string to compare against date_processed
+    '''
+    return (datetime.datetime.utcnow() - datetime.timedelta(abs(days))).isoformat()
+
+
+def load_common_properties():
+    '''
+    Reads the common_properties JSON Schema definitions from the package resources the first time they are needed and
+    keeps them for the life of the process.
+    '''
+    global common_properties
+
+    if common_properties is None:
+        filepath = pkg_resources.resource_filename(__name__, 'resources/common_properties.json')
+        with open(filepath, 'r') as f:
+            common_properties = json.loads(f.read())
+
+    return common_properties
+
+
+@lru_cache(maxsize=None)
+def common_property_mappings(target_properties=None):
+    '''
+    Builds the alias to preferred property name mappings from common_properties, optionally limited to a tuple of
+    target properties. Memoized so each set of target properties is only worked out once.
+    '''
+    definitions = load_common_properties()["definitions"]
+
+    mappings = dict()
+    for k, v in definitions.items():
+        if "aliases" in v and (target_properties is None or k in target_properties):
+            for alias in v["aliases"]:
+                mappings[alias] = k
+
+    return mappings
 
 
 class Sciencebase:
@@ -42,9 +234,328 @@ class Sciencebase:
         return item_list
 
 
+class RecordCache:
+    extension = ".sqlite"
+
+    def __init__(self, file_location):
+        '''
+        Append-only record cache used behind the Utils cache functions. Records are stored flattened (the same column
+        names json_normalize produces for the DataFrame caches) as JSON in a Sqlite table indexed on the search key, so
+        appends and single key lookups do not depend on the size of the cache. A pickled DataFrame cache found at
+        file_location is imported the first time the cache is opened.
+
+        :param file_location: Location of the cache; the Sqlite store is written alongside it with a .sqlite extension
+        '''
+        self.file_location = file_location
+        self.store_location = f"{file_location}{self.extension}"
+        self._lock = threading.Lock()
+
+        import_legacy = not os.path.exists(self.store_location) and os.path.isfile(file_location)
+
+        self.con = sqlite3.connect(self.store_location, check_same_thread=False)
+        self.con.execute(
+            "CREATE TABLE IF NOT EXISTS records "
+            "(id INTEGER PRIMARY KEY, search_key TEXT, date_processed TEXT, record TEXT)"
+        )
+        self.con.execute("CREATE INDEX IF NOT EXISTS idx_records_search_key ON records (search_key, date_processed)")
+        self.con.commit()
+
+        if import_legacy:
+            self.append_many(pd.read_pickle(file_location).to_dict("records"), normalized=True)
+
+    def append_many(self, records, normalized=False):
+        rows = list()
+        for record in records:
+            if not normalized:
+                record = normalize_dict(record)
+            rows.append((
+                record.get("processing_metadata.search_key"),
+                record.get("processing_metadata.date_processed"),
+                json.dumps(record, default=str)
+            ))
+
+        with self._lock:
+            self.con.executemany("INSERT INTO records (search_key, date_processed, record) VALUES (?, ?, ?)", rows)
+            self.con.commit()
+
+        return len(rows)
+
+    def append(self, record):
+        return self.append_many([record])
+
+    def get(self, search_key):
+        with self._lock:
+            rows = self.con.execute(
+                "SELECT record FROM records WHERE search_key = ? ORDER BY id", [search_key]
+            ).fetchall()
+
+        return [json.loads(r[0]) for r in rows]
+
+    def records(self):
+        with self._lock:
+            rows = self.con.execute("SELECT record FROM records ORDER BY id").fetchall()
+
+        return [json.loads(r[0]) for r in rows]
+
+    def keys_in_cache(self, search_keys, processed_after=None):
+        '''
+        Returns the subset of search_keys that have at least one record in the cache.
+
+        :param search_keys: List of search keys
+        :param processed_after: ISO date string; only count records processed after this date
+        :return: Set of search keys
+        '''
+        search_keys = list(search_keys)
+        found = set()
+
+        with self._lock:
+            # Stay under the Sqlite limit on bound parameters
+            for i in range(0, len(search_keys), 500):
+                chunk = search_keys[i:i + 500]
+                sql = f"SELECT DISTINCT search_key FROM records WHERE search_key IN ({','.join('?' * len(chunk))})"
+                if processed_after is not None:
+                    sql = f"{sql} AND date_processed > ?"
+                    chunk = chunk + [processed_after]
+                found.update(r[0] for r in self.con.execute(sql, chunk))
+
+        return found
+
+
+def normalize_dict(d, parent_key=None):
+    '''
+    Flattens nested dictionaries into dot separated keys the way pandas json_normalize does for a single record.
+    Lists are left as values.
+    '''
+    flat = dict()
+    for k, v in d.items():
+        key = k if parent_key is None else f"{parent_key}.{k}"
+        if isinstance(v, dict) and len(v) > 0:
+            flat.update(normalize_dict(v, key))
+        else:
+            flat[key] = v
+
+    return flat
+
+
+class NameCache:
+    def __init__(self, maxsize=100000, cache_file=None):
+        '''
+        Bounded least recently used cache of raw scientific name strings to cleaned names, with counters for sizing
+        it. Optionally loaded from and saved to a JSON file so that it carries over between runs.
+
+        :param maxsize: Maximum number of names held
+        :param cache_file: JSON file to load the cache from if it exists, and the default location for save
+        '''
+        self.maxsize = maxsize
+        self.cache_file = cache_file
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._names = OrderedDict()
+        self._lock = threading.Lock()
+
+        if cache_file is not None and os.path.isfile(cache_file):
+            self.load(cache_file)
+
+    def get(self, raw_name):
+        with self._lock:
+            if raw_name in self._names:
+                self._names.move_to_end(raw_name)
+                self.hits += 1
+                return self._names[raw_name]
+
+            self.misses += 1
+            return None
+
+    def put(self, raw_name, cleaned_name):
+        with self._lock:
+            self._names[raw_name] = cleaned_name
+            self._names.move_to_end(raw_name)
+            while len(self._names) > self.maxsize:
+                self._names.popitem(last=False)
+                self.evictions += 1
+
+    def count_hits(self, hits):
+        '''
+        Adds lookups answered without calling get, e.g. repeats of a name within one bulk cleaning call.
+        '''
+        with self._lock:
+            self.hits += hits
+
+    def clear(self):
+        with self._lock:
+            self._names = OrderedDict()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self._names),
+            "maxsize": self.maxsize,
+            "hit_rate": self.hits / lookups if lookups > 0 else None
+        }
+
+    def load(self, cache_file=None):
+        cache_file = self.cache_file if cache_file is None else cache_file
+
+        with open(cache_file, "r") as f:
+            pairs = json.loads(f.read())
+
+        for raw_name, cleaned_name in pairs:
+            self.put(raw_name, cleaned_name)
+
+        return len(pairs)
+
+    def save(self, cache_file=None):
+        cache_file = self.cache_file if cache_file is None else cache_file
+
+        if cache_file is None:
+            raise ValueError("A cache file must be provided to save the name cache")
+
+        with self._lock:
+            pairs = list(self._names.items())
+
+        with open(f"{cache_file}.tmp", "w") as f:
+            f.write(json.dumps(pairs))
+        os.replace(f"{cache_file}.tmp", cache_file)
+
+        return cache_file
+
+
+# Days a cached source result is served before the source is searched again
+default_cache_ttls = {
+    "itis": 30,
+    "itis_local": 30,
+    "worms": 30,
+    "gbif": 30,
+    "iucn": 30,
+    "natureserve": 30,
+    "sgcn": 30,
+    "tess": 30
+}
+
+
+class IdentifierCache:
+    def __init__(self, maxsize=10000, sql=None, db_name="sppin", ttls=None):
+        '''
+        Bounded least recently used cache of source records keyed by source and identifier (TSN, AphiaID), so that an
+        accepted record many names resolve to is only fetched once. Records are copied in and out, so callers can
+        modify what they get back. Records are only returned while they are newer than the source's TTL, in memory as
+        well as from the identifier_records table that an Sql object backs the cache with to carry records over
+        between runs.
+
+        :param maxsize: Maximum number of records held in memory
+        :param sql: Sql object backing the cache
+        :param db_name: Sql cache database name
+        :param ttls: Dictionary of source to days a record is current, updating default_cache_ttls
+        '''
+        self.maxsize = maxsize
+        self.sql = sql
+        self.db_name = db_name
+        self.table_name = "identifier_records"
+        self.ttls = dict(default_cache_ttls)
+        if ttls is not None:
+            self.ttls.update(ttls)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+        self._table_ready = False
+
+    def ensure_table(self):
+        if self._table_ready:
+            return
+
+        self.sql.get_db(self.db_name).execute(
+            f"CREATE TABLE IF NOT EXISTS [{self.table_name}] ("
+            "source TEXT NOT NULL, identifier TEXT NOT NULL, date_processed TEXT NOT NULL, record TEXT NOT NULL, "
+            "PRIMARY KEY (source, identifier))"
+        )
+        self._table_ready = True
+
+    def get(self, source, identifier):
+        key = (source, str(identifier))
+
+        current_date = currency_date(self.ttls.get(source, 30))
+
+        with self._lock:
+            if key in self._records:
+                date_processed, record = self._records[key]
+                if date_processed > current_date:
+                    self._records.move_to_end(key)
+                    self.hits += 1
+                    return copy.deepcopy(record)
+                del self._records[key]
+
+        if self.sql is not None:
+            self.ensure_table()
+            row = self.sql.get_db(self.db_name).execute(
+                f"SELECT record, date_processed FROM [{self.table_name}] "
+                "WHERE source = ? AND identifier = ? AND date_processed > ?",
+                [source, key[1], current_date]
+            ).fetchone()
+            if row is not None:
+                record = json.loads(row[0])
+                self.remember(key, record, row[1])
+                with self._lock:
+                    self.hits += 1
+                return copy.deepcopy(record)
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, source, identifier, record):
+        key = (source, str(identifier))
+        record = copy.deepcopy(record)
+        date_processed = datetime.datetime.utcnow().isoformat()
+        self.remember(key, record, date_processed)
+
+        if self.sql is not None:
+            self.ensure_table()
+            with self.sql.transaction(self.db_name) as db:
+                db.execute(
+                    f"INSERT OR REPLACE INTO [{self.table_name}] (source, identifier, date_processed, record) "
+                    "VALUES (?, ?, ?, ?)",
+                    [source, key[1], date_processed, json.dumps(record, default=str)]
+                )
+
+    def remember(self, key, record, date_processed):
+        with self._lock:
+            self._records[key] = (date_processed, record)
+            self._records.move_to_end(key)
+            while len(self._records) > self.maxsize:
+                self._records.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._records = OrderedDict()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self._records),
+            "maxsize": self.maxsize,
+            "hit_rate": self.hits / lookups if lookups > 0 else None
+        }
+
+
+# Shared by source classes that are not given their own, so records are reused across calls within a run
+default_identifier_cache = IdentifierCache()
+
+
 class Utils:
-    def __init__(self):
+    def __init__(self, name_cache_size=100000, name_cache_file=None):
         self.data = {}
+        self.record_caches = dict()
+        self.name_cache = NameCache(maxsize=name_cache_size, cache_file=name_cache_file)
 
     def processing_metadata(self, default_status="error"):
         packaged_stub = {
@@ -55,13 +566,19 @@ class Utils:
         }
         return packaged_stub
 
-    def get_cache(self, cache_name, cache_location):
+    def record_cache(self, cache_name, cache_location, create=False):
         file_location = f"{cache_location}/{cache_name}"
 
-        if not os.path.exists(file_location):
-            raise ValueError(f'The cache file does not exist in the specified location: {file_location}')
+        if file_location not in self.record_caches:
+            if not create and not os.path.exists(file_location) \
+                    and not os.path.exists(f"{file_location}{RecordCache.extension}"):
+                raise ValueError(f'The cache file does not exist in the specified location: {file_location}')
+            self.record_caches[file_location] = RecordCache(file_location)
 
-        return pd.read_pickle(file_location)
+        return self.record_caches[file_location]
+
+    def get_cache(self, cache_name, cache_location):
+        return pd.DataFrame.from_records(self.record_cache(cache_name, cache_location).records())
 
     def cache_df(self, df, file_name, cache_location, file_type="pickle", ):
         cache_location = f"{cache_location}{cache_path}"
@@ -78,51 +595,42 @@ class Utils:
 
         return file_location
 
-    def key_in_cache(self, cache_name, cache_location, search_key, return_record=False):
-        cache_data = self.get_cache(cache_name, cache_location)
+    def key_in_cache(self, cache_name, cache_location, search_key, return_record=False, create=False):
+        existing_records = self.record_cache(cache_name, cache_location, create=create).get(search_key)
 
-        existing_record = cache_data[cache_data["processing_metadata.search_key"] == search_key]
-
-        if existing_record.empty:
+        if len(existing_records) == 0:
             return False
 
         if return_record:
-            return True, existing_record.to_dict("records")
+            return True, existing_records
 
         return True
 
-    def append_to_cache(self, cache_name, cache_location, new_record, return_cache=False):
-        current_cache = self.get_cache(cache_name, cache_location)
-        df_new_record = json_normalize(new_record)
-        new_cache = pd.concat([current_cache, df_new_record], ignore_index=True, sort=False)
-
-        self.cache_df(new_cache, cache_name, cache_location)
+    def append_to_cache(self, cache_name, cache_location, new_record, return_cache=False, create=False):
+        self.record_cache(cache_name, cache_location, create=create).append(new_record)
 
         if return_cache:
-            return new_cache
+            return self.get_cache(cache_name, cache_location)
         else:
             return True
 
-    def filter_mq_list(self, mq_list, cache_name, operation="processable", cache_threshold=30):
-        df_cache = self.get_cache(cache_name)
+    def filter_mq_list(self, mq_list, cache_name, operation="processable", cache_threshold=30,
+                       cache_location=os.getenv("DATA_CACHE"), create=False):
+        record_cache = self.record_cache(cache_name, cache_location, create=create)
 
         search_key_list = [i["search_key"] for i in mq_list]
-        start_date = datetime.datetime.now() + datetime.timedelta(-cache_threshold)
 
         if operation == "processable":
-            not_processable = df_cache[
-                (df_cache["processing_metadata.search_key"].isin(search_key_list))
-                &
-                (pd.to_datetime(df_cache["processing_metadata.date_processed"]) > pd.to_datetime(start_date))
-                ]["processing_metadata.search_key"].tolist()
+            not_processable = record_cache.keys_in_cache(
+                search_key_list, processed_after=currency_date(cache_threshold)
+            )
 
             new_list = [i for i in mq_list if i["search_key"] not in not_processable]
 
             return new_list
 
         elif operation == "flagged":
-            in_cache_list = df_cache[df_cache["processing_metadata.search_key"].isin(search_key_list)][
-                "processing_metadata.search_key"].tolist()
+            in_cache_list = record_cache.keys_in_cache(search_key_list)
             flagged_list = [dict(item, **{'in_cache': False}) for item in mq_list]
             flagged_list = [dict(item, **{'in_cache': True}) for item in flagged_list if
                            item["search_key"] in in_cache_list]
@@ -261,17 +769,73 @@ class Utils:
         return record_report
 
     def alter_keys(self, item, mappings, layer=None, key=None):
-        if layer is None:
-            layer = item
-        if isinstance(item, dict):
-            for k, v in item.items():
-                self.alter_keys(v, mappings, item, k)
-        if isinstance(key, str):
-            for orig, new in mappings.items():
-                if orig in layer.keys():
-                    layer[new] = layer.pop(orig)
-
-        return layer
+        '''
+        Renames keys in place at every level of a nested structure. Kept for existing callers; see remap_keys.
+        '''
+        return self.remap_keys(item, mappings, inplace=True)
+
+    def remap_keys(self, item, mappings, inplace=False):
+        '''
+        Renames keys found in mappings at every level of a nested structure of dictionaries and lists. The structure
+        is walked with an explicit stack, and each key is checked once with a dictionary lookup. Renamed keys keep
+        their position; if a record has both an alias and its preferred name, the value from the alias wins.
+
+        :param item: Dictionary, list, or any nesting of the two
+        :param mappings: Dictionary of original key to new key
+        :param inplace: Modify item itself rather than building a new structure
+        :return: The remapped structure (item itself if inplace)
+        '''
+        if not isinstance(item, (dict, list)):
+            return item
+
+        if inplace:
+            root = item
+        else:
+            root = dict() if isinstance(item, dict) else list()
+
+        stack = [(item, root)]
+        while stack:
+            source, target = stack.pop()
+
+            if isinstance(source, dict):
+                entries = list(source.items()) if inplace else source.items()
+                if inplace:
+                    target.clear()
+
+                renamed = set()
+                for k, v in entries:
+                    new_k = mappings.get(k, k)
+                    if new_k != k:
+                        renamed.add(new_k)
+                    elif k in renamed:
+                        continue
+
+                    if isinstance(v, (dict, list)):
+                        child = v if inplace else (dict() if isinstance(v, dict) else list())
+                        stack.append((v, child))
+                    else:
+                        child = v
+                    target[new_k] = child
+
+            else:
+                for v in source:
+                    if isinstance(v, (dict, list)):
+                        child = v if inplace else (dict() if isinstance(v, dict) else list())
+                        stack.append((v, child))
+                    else:
+                        child = v
+                    if not inplace:
+                        target.append(child)
+
+        return root
+
+    def remap_keys_batch(self, records, mappings, inplace=False):
+        '''
+        Runs remap_keys over a list of records, e.g. a full ITIS or ECOS result set.
+
+        :return: List of remapped records
+        '''
+        return [self.remap_keys(record, mappings, inplace=inplace) for record in records]
 
     def integrate_recordset(self, recordset, target_properties=None):
         '''
@@ -286,84 +850,78 @@ class Utils:
         :return: recordset with applicable property names registered as aliases mapped to target/preferred names
         '''
 
-        path = 'resources/common_properties.json'
-        filepath = pkg_resources.resource_filename(__name__, path)
-        with open(filepath, 'r') as f:
-            common_properties = json.loads(f.read())
-            f.close()
-
-        # This is completely stupid, but I can't get my head around a combination of list and dict
-        # comprehension to do this more elegantly right now
-        mappings = dict()
-        for k, v in common_properties["definitions"].items():
-            if target_properties is None:
-                if "aliases" in common_properties["definitions"][k]:
-                    for alias in common_properties["definitions"][k]["aliases"]:
-                        mappings[alias] = k
-            else:
-                if "aliases" in common_properties["definitions"][k] and k in target_properties:
-                    for alias in common_properties["definitions"][k]["aliases"]:
-                        mappings[alias] = k
+        if target_properties is not None:
+            target_properties = tuple(target_properties)
+
+        mappings = common_property_mappings(target_properties)
 
         if isinstance(recordset, dict):
             recordset = [recordset]
 
-        new_recordset = list()
-        for record in recordset:
-            new_recordset.append(self.alter_keys(record, mappings))
-
-        return recordset
+        return self.remap_keys_batch(recordset, mappings)
 
     def clean_scientific_name(self, scientificname):
-        if isinstance(scientificname, float):
-            return None
-
-        nameString = str(scientificname)
+        if not isinstance(scientificname, str):
+            return compiled_clean_scientific_name(scientificname)
 
-        # Fix encoding translation issues
-        nameString = fix_text(nameString)
-
-        # Remove digits, we can't work with these right now
-        nameString = re.sub(r'\d+', '', nameString)
+        cleaned = self.name_cache.get(scientificname)
 
-        # Get rid of strings in parentheses and brackets (these might need to be revisited eventually, but we can
-        # often find a match without this information)
-        nameString = re.sub('[\(\[\"].*?[\)\]\"]', "", nameString)
-        nameString = ' '.join(nameString.split())
+        if cleaned is None:
+            cleaned = compiled_clean_scientific_name(scientificname)
+            self.name_cache.put(scientificname, cleaned)
 
-        # Remove some specific substrings
-        removeList = ["?", "Family "]
-        nameString = re.sub(r'|'.join(map(re.escape, removeList)), '', nameString)
+        return cleaned
 
-        # Change uses of "subsp." to "ssp." for ITIS
-        nameString = nameString.replace("subsp.", "ssp.")
-
-        # Particular words are used to describe variations or nuances in taxonomy but are not able to be used in
-        # matching names at this time
-        afterChars = ["(", " AND ", "/", " & ", " vs ", " undescribed ", ",", " formerly ", " near ", "Columbia Basin",
-                      "Puget Trough", " n.sp. ", " n. ", " sp. ", " sp ", " pop. ", " spp. ", " cf. ", " ] "]
-        nameString = nameString + " "
-        while any(substring in nameString for substring in afterChars):
-            for substring in afterChars:
-                nameString = nameString.split(substring, 1)[0]
-                nameString = nameString + " "
+    def clean_scientific_names(self, scientificnames, processes=None, chunksize=1000):
+        '''
+        Cleans a whole column of scientific names. Each distinct raw string not already in the name cache is cleaned
+        once with compiled_clean_scientific_name, optionally spread across worker processes, and the results are
+        mapped back onto the input. Output, and the name cache hit and miss counts, are identical to calling
+        clean_scientific_name on every value: repeats of a name count as hits.
+
+        :param scientificnames: pandas Series or any iterable of raw names
+        :param processes: Number of worker processes; None cleans in this process
+        :param chunksize: Number of names sent to a worker process at a time
+        :return: pandas Series with the same index for Series input, otherwise a list
+        '''
+        is_series = isinstance(scientificnames, pd.Series)
+        if not is_series:
+            scientificnames = list(scientificnames)
+
+        name_counts = Counter(n for n in scientificnames if not isinstance(n, float))
+
+        lookup = dict()
+        unique_names = list()
+        repeats = 0
+        for n, count in name_counts.items():
+            cleaned = None
+            if isinstance(n, str):
+                cleaned = self.name_cache.get(n)
+                repeats += count - 1
+            if cleaned is None:
+                unique_names.append(n)
+            else:
+                lookup[n] = cleaned
+        self.name_cache.count_hits(repeats)
 
-        nameString = nameString.strip()
+        if processes is not None and processes > 1:
+            with Pool(processes) as pool:
+                cleaned = pool.map(compiled_clean_scientific_name, unique_names, chunksize=chunksize)
+        else:
+            cleaned = [compiled_clean_scientific_name(n) for n in unique_names]
 
-        # Deal with cases where an "_" was used
-        if nameString.find("_") != -1:
-            nameString = ' '.join(nameString.split("_"))
+        for n, c in zip(unique_names, cleaned):
+            lookup[n] = c
+            if isinstance(n, str):
+                self.name_cache.put(n, c)
 
-        # Check to make sure there is actually a subspecies or variety name supplied
-        if len(nameString) > 0:
-            namesList = nameString.split(" ")
-            if namesList[-1] in ["ssp.", "var."]:
-                nameString = ' '.join(namesList[:-1])
+        def clean(n):
+            return None if isinstance(n, float) else lookup[n]
 
-        # Take care of capitalizing final cross indicator
-        nameString = nameString.replace(" x ", " X ")
+        if is_series:
+            return scientificnames.map(clean)
 
-        return nameString.capitalize()
+        return [clean(n) for n in scientificnames]
 
     def denormalize_dict(self, d):
         new_dict = dict()
@@ -435,17 +993,145 @@ class AttributeValueCount:
         ))
 
 
+class SqlConnection(sqlite3.Connection):
+    '''
+    Sqlite connection that can hold a transaction open across many sqlite_utils operations. sqlite_utils commits
+    after every insert by using the connection as a context manager; while a Sql.transaction block is open, those
+    inner commits are deferred to the end of the block.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.transaction_depth = 0
+
+    def __enter__(self):
+        if self.transaction_depth > 0:
+            return self
+        return super().__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.transaction_depth > 0:
+            return False
+        return super().__exit__(exc_type, exc_value, traceback)
+
+    def commit(self):
+        if self.transaction_depth == 0:
+            super().commit()
+
+
+class LazyJsonRecord(Mapping):
+    '''
+    Read-only record from a Sql table that decodes JSON columns the first time they are accessed. Use dict(record) to
+    get a plain, fully decoded dictionary.
+    '''
+    def __init__(self, row, json_columns):
+        self._row = row
+        self._json_columns = json_columns
+        self._decoded = dict()
+
+    def __getitem__(self, key):
+        if key in self._decoded:
+            return self._decoded[key]
+
+        value = self._row[key]
+        if isinstance(value, str) and (
+                key in self._json_columns if self._json_columns is not None else value[:1] in ("{", "[")):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+
+        self._decoded[key] = value
+        return value
+
+    def __iter__(self):
+        return iter(self._row)
+
+    def __len__(self):
+        return len(self._row)
+
+
 class Sql:
-    def __init__(self, cache_location=None):
+    def __init__(self, cache_location=None, pragmas=None):
+        '''
+        Sqlite caches of source results. Each thread keeps one open connection per database, configured for
+        concurrent readers and writers across worker processes (WAL journal, busy timeout).
+
+        :param cache_location: Folder holding the cache databases
+        :param pragmas: Dictionary of Sqlite pragmas updating the defaults set on each new connection
+        '''
         self.description = "Temporary way to externalize messages from processing"
         self.cache_location = cache_location
+        self.busy_timeout = 30
+        self.pragmas = {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "cache_size": -64000,
+            "mmap_size": 268435456,
+            "temp_store": "MEMORY"
+        }
+        if pragmas is not None:
+            self.pragmas.update(pragmas)
+        self._local = threading.local()
+        self._indexed_tables = set()
+        self._json_columns = dict()
 
     def get_db(self, db_name):
-        return Database(f"{self.cache_location}/{db_name}.db")
+        if not hasattr(self._local, "dbs"):
+            self._local.dbs = dict()
+
+        if db_name not in self._local.dbs:
+            con = sqlite3.connect(
+                f"{self.cache_location}/{db_name}.db",
+                timeout=self.busy_timeout,
+                factory=SqlConnection
+            )
+            for pragma, value in self.pragmas.items():
+                con.execute(f"PRAGMA {pragma} = {value}")
+            self._local.dbs[db_name] = Database(con)
 
-    def insert_record(self, db_name, table_name, record, mq=False):
-        db = Database(sqlite3.connect(f"{self.cache_location}/{db_name}.db", check_same_thread=False))
+        return self._local.dbs[db_name]
+
+    @contextmanager
+    def transaction(self, db_name):
+        '''
+        Groups every write made through this Sql object on the current thread into a single commit, e.g.
+
+            with sql.transaction("sppin"):
+                for record in records:
+                    sql.insert_record("sppin", "itis", record)
+
+        Everything is rolled back if the block raises.
+
+        :param db_name: Cache database name
+        :return: sqlite_utils Database for the open transaction
+        '''
+        db = self.get_db(db_name)
+        con = db.conn
+
+        if con.transaction_depth == 0 and not con.in_transaction:
+            con.execute("BEGIN IMMEDIATE")
+
+        con.transaction_depth += 1
+        try:
+            yield db
+        except BaseException:
+            con.transaction_depth -= 1
+            if con.transaction_depth == 0:
+                con.rollback()
+                # JSON columns registered during the transaction were rolled back with it
+                self._json_columns = {k: v for k, v in self._json_columns.items() if k[0] != db_name}
+            raise
+        else:
+            con.transaction_depth -= 1
+            if con.transaction_depth == 0:
+                con.commit()
 
+    def close(self):
+        for db in getattr(self._local, "dbs", dict()).values():
+            db.conn.close()
+        self._local.dbs = dict()
+
+    def insert_record(self, db_name, table_name, record, mq=False):
         if not isinstance(record, dict):
             raise ValueError("Record must be a dictionary")
 
@@ -455,133 +1141,613 @@ class Sql:
                 "body": record
             }
 
-        return db[table_name].insert(record, hash_id="id").last_pk
+        with self.transaction(db_name) as db:
+            self.register_json_columns(db_name, table_name, [record])
+            last_pk = db[table_name].insert(record, hash_id="id", alter=True).last_pk
+        self.ensure_indexes(db_name, table_name)
 
-    def bulk_insert(self, db_name, table_name, bulk_data):
-        db = Database(f"{self.cache_location}/{db_name}.db")
+        return last_pk
+
+    def upsert_record(self, db_name, table_name, record):
+        '''
+        Replaces whatever is cached for a record's sppin_key with the new record. The delete and insert happen in one
+        write transaction, so parallel workers processing the same name can never leave duplicate records behind.
+
+        :param db_name: Cache database name
+        :param table_name: Source table
+        :param record: Dictionary containing a sppin_key
+        :return: Primary key of the inserted record
+        '''
+        if not isinstance(record, dict):
+            raise ValueError("Record must be a dictionary")
+
+        if "sppin_key" not in record:
+            raise ValueError("Record must contain a sppin_key to upsert")
+
+        with self.transaction(db_name) as db:
+            self.register_json_columns(db_name, table_name, [record])
+            if db[table_name].exists():
+                db.execute(f"DELETE FROM [{table_name}] WHERE sppin_key = ?", [record["sppin_key"]])
+            last_pk = db[table_name].insert(record, hash_id="id", alter=True).last_pk
+
+        self.ensure_indexes(db_name, table_name)
+
+        return last_pk
+
+    def ensure_indexes(self, db_name, table_name):
+        '''
+        Creates the composite (sppin_key, date_processed) index used by sppin_key_current_record on source tables.
+        Each table is only checked once per Sql object.
+        '''
+        if (db_name, table_name) in self._indexed_tables:
+            return
+
+        db = self.get_db(db_name)
+
+        if not db[table_name].exists():
+            return
 
+        columns = db[table_name].columns_dict
+        if "sppin_key" in columns and "date_processed" in columns:
+            db[table_name].create_index(["sppin_key", "date_processed"], if_not_exists=True)
+        elif "sppin_key" in columns:
+            db[table_name].create_index(["sppin_key"], if_not_exists=True)
+
+        self._indexed_tables.add((db_name, table_name))
+
+    def json_columns(self, db_name, table_name):
+        '''
+        Columns of a table that were written from dictionaries or lists and hold JSON text, as recorded in the
+        _sppin_json_columns table when records were written.
+
+        :return: Set of column names, or None for tables written before column types were recorded
+        '''
+        if (db_name, table_name) in self._json_columns:
+            return self._json_columns[(db_name, table_name)]
+
+        db = self.get_db(db_name)
+
+        if db["_sppin_json_columns"].exists():
+            registered = db.execute(
+                "SELECT column_name FROM _sppin_json_columns WHERE table_name = ?", [table_name]
+            ).fetchall()
+            if len(registered) > 0:
+                self._json_columns[(db_name, table_name)] = set(r[0] for r in registered if r[0])
+                return self._json_columns[(db_name, table_name)]
+
+        # A table with rows but no registered columns was written before column types were recorded
+        if db[table_name].exists() and db.execute(f"SELECT 1 FROM [{table_name}] LIMIT 1").fetchone() is not None:
+            self._json_columns[(db_name, table_name)] = None
+
+        return None
+
+    def register_json_columns(self, db_name, table_name, records):
+        '''
+        Records which columns of a table take dictionary or list values so that read paths only decode those columns.
+        An empty column name is registered as a marker for every table so that tables without JSON columns are not
+        mistaken for legacy tables. Called by the write paths inside the same transaction as the write and before it,
+        so a table that already has rows but no registered columns is always a legacy table.
+        '''
+        if (db_name, table_name) in self._json_columns:
+            known_columns = self._json_columns[(db_name, table_name)]
+            if known_columns is None:
+                return
+        else:
+            db = self.get_db(db_name)
+            registered = db["_sppin_json_columns"].exists() and db.execute(
+                "SELECT 1 FROM _sppin_json_columns WHERE table_name = ? LIMIT 1", [table_name]
+            ).fetchone() is not None
+            if not registered and db[table_name].exists() \
+                    and db.execute(f"SELECT 1 FROM [{table_name}] LIMIT 1").fetchone() is not None:
+                self._json_columns[(db_name, table_name)] = None
+                return
+            known_columns = self.json_columns(db_name, table_name) if registered else set()
+
+        new_columns = set(
+            k for record in records for k, v in record.items()
+            if isinstance(v, (dict, list, tuple)) and k not in known_columns
+        )
+
+        if len(new_columns) == 0 and (db_name, table_name) in self._json_columns:
+            return
+
+        with self.transaction(db_name) as db:
+            db["_sppin_json_columns"].insert_all(
+                [{"table_name": table_name, "column_name": c} for c in new_columns | {""}],
+                pk=("table_name", "column_name"),
+                ignore=True
+            )
+
+        self._json_columns[(db_name, table_name)] = known_columns | new_columns
+
+    def decode_record(self, row, json_columns, json_to_dict=True, lazy=False):
+        '''
+        Turns a row into a record, decoding the JSON columns. For legacy tables (json_columns is None) only text
+        values that look like JSON objects or arrays are decoded.
+        '''
+        if not json_to_dict:
+            return row
+
+        if lazy:
+            return LazyJsonRecord(row, json_columns)
+
+        record = dict(row)
+        for k, v in row.items():
+            if isinstance(v, str) and (k in json_columns if json_columns is not None else v[:1] in ("{", "[")):
+                try:
+                    record[k] = json.loads(v)
+                except ValueError:
+                    pass
+
+        return record
+
+    def bulk_insert(self, db_name, table_name, bulk_data):
         if not isinstance(bulk_data, list):
             raise ValueError("Bulk data must be a list")
 
         if not isinstance(bulk_data[0], dict):
             raise ValueError("Bulk data must contain a list of dictionary objects")
 
-        db[table_name].insert_all(bulk_data, hash_id="id")
+        with self.transaction(db_name) as db:
+            self.register_json_columns(db_name, table_name, bulk_data)
+            db[table_name].insert_all(bulk_data, hash_id="id", alter=True)
+        self.ensure_indexes(db_name, table_name)
 
         return len(bulk_data)
 
-    def get_single_record(self, db_name, table_name, json_to_dict=True):
-        db = Database(f"{self.cache_location}/{db_name}.db")
+    def get_single_record(self, db_name, table_name, json_to_dict=True, lazy=False):
+        db = self.get_db(db_name)
+        json_columns = self.json_columns(db_name, table_name)
 
         for row in db[table_name].rows_where("0 = 0"):
-            if json_to_dict:
-                record = dict()
-                for k, v in row.items():
-                    try:
-                        record[k] = json.loads(v)
-                    except:
-                        record[k] = v
-            else:
-                record = row
+            record = self.decode_record(row, json_columns, json_to_dict=json_to_dict, lazy=lazy)
 
             return record
 
-    def get_all_records(self, db_name, table_name, json_to_dict=True):
-        db = Database(f"{self.cache_location}/{db_name}.db")
-
-        result_list = list()
-        for row in db[table_name].rows:
-            if json_to_dict:
-                record = dict()
-                for k, v in row.items():
-                    try:
-                        record[k] = json.loads(v)
-                    except:
-                        record[k] = v
-            else:
-                record = row
-            result_list.append(record)
+    def get_all_records(self, db_name, table_name, json_to_dict=True, lazy=False):
+        result_list = list(self.iter_records(db_name, table_name, json_to_dict=json_to_dict, lazy=lazy))
 
         if len(result_list) == 0:
             return None
 
         return result_list
 
-    def get_select_records(self, db_name, table_name, where, value, json_to_dict=True):
-        db = Database(f"{self.cache_location}/{db_name}.db")
-
-        result_list = list()
-        for row in db[table_name].rows_where(where, [value]):
-            if json_to_dict:
-                record = dict()
-                for k, v in row.items():
-                    try:
-                        record[k] = json.loads(v)
-                    except:
-                        record[k] = v
-            else:
-                record = row
-            result_list.append(record)
+    def get_select_records(self, db_name, table_name, where, value, json_to_dict=True, lazy=False):
+        result_list = list(
+            self.iter_select_records(db_name, table_name, where, value, json_to_dict=json_to_dict, lazy=lazy)
+        )
 
         if len(result_list) == 0:
             return None
 
         return result_list
 
+    def iter_records(self, db_name, table_name, fetch_size=1000, json_to_dict=True, lazy=False, output="records",
+                     schema=None):
+        '''
+        Streams all records from a table without building the whole table in memory.
+
+        :param db_name: Cache database name
+        :param table_name: Table to read
+        :param fetch_size: Number of rows fetched from Sqlite at a time, and the chunk size for pandas/arrow output
+        :param json_to_dict: Decode JSON columns
+        :param lazy: Yield LazyJsonRecord mappings that decode JSON columns on access (records output only)
+        :param output: "records" yields one record at a time, "pandas" yields DataFrames and "arrow" yields
+        pyarrow.RecordBatch objects of up to fetch_size records (requires the pysppin[arrow] extra)
+        :param schema: pyarrow.Schema used for every batch with arrow output. If not provided it is inferred from the
+        first batch and reused for the rest, so pass one if the first batch may not be representative (e.g. a column
+        that is null throughout the first batch).
+        :return: Generator
+        '''
+        return self.iter_select_records(
+            db_name, table_name, None, None,
+            fetch_size=fetch_size, json_to_dict=json_to_dict, lazy=lazy, output=output, schema=schema
+        )
+
+    def iter_select_records(self, db_name, table_name, where, value, fetch_size=1000, json_to_dict=True, lazy=False,
+                            output="records", schema=None):
+        '''
+        Streams the records from a table matching a where clause with one parameter. See iter_records for the
+        remaining parameters.
+        '''
+        if output not in ["records", "pandas", "arrow"]:
+            raise ValueError("output must be one of records, pandas or arrow")
+
+        if output == "arrow":
+            import pyarrow
+
+        db = self.get_db(db_name)
+
+        if not db[table_name].exists():
+            return
+
+        json_columns = self.json_columns(db_name, table_name)
+
+        sql = f"SELECT * FROM [{table_name}]"
+        values = list()
+        if where is not None:
+            sql = f"{sql} WHERE {where}"
+            values.append(value)
+
+        cursor = db.execute(sql, values)
+        columns = [c[0] for c in cursor.description]
+
+        try:
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if len(rows) == 0:
+                    return
+
+                records = [
+                    self.decode_record(
+                        dict(zip(columns, row)),
+                        json_columns,
+                        json_to_dict=json_to_dict,
+                        lazy=lazy and output == "records"
+                    ) for row in rows
+                ]
+
+                if output == "records":
+                    yield from records
+                elif output == "pandas":
+                    yield pd.DataFrame.from_records(records, columns=columns)
+                else:
+                    if schema is None:
+                        schema = pyarrow.RecordBatch.from_pylist(records).schema
+                    yield pyarrow.RecordBatch.from_pylist(records, schema=schema)
+        finally:
+            cursor.close()
+
     def delete_record(self, db_name, table_name, identifier):
-        db = Database(f"{self.cache_location}/{db_name}.db")
+        db = self.get_db(db_name)
 
         db[table_name].delete(identifier)
 
         return identifier
 
     def insert_sppin_props(self, db_name, table_name, props, identifiers):
-        db = Database(f"{self.cache_location}/{db_name}.db")
-
         returns = list()
-        for identifier in identifiers:
-            returns.append(
-                db[table_name].update(
-                    identifier,
-                    props,
-                    alter=True
+        with self.transaction(db_name) as db:
+            self.register_json_columns(db_name, table_name, [props])
+            for identifier in identifiers:
+                returns.append(
+                    db[table_name].update(
+                        identifier,
+                        props,
+                        alter=True
+                    )
                 )
-            )
 
         return returns
 
     def sppin_key_current_record(self, table_name, sppin_key, currency_threshold=-30, db_name="sppin"):
-        db = Database(sqlite3.connect(f"{self.cache_location}/{db_name}.db"))
+        '''
+        Returns the most recent record cached for a sppin_key.
+
+        :param table_name: Source table
+        :param sppin_key: Search key
+        :param currency_threshold: Only return a record processed within this many days; None for any age
+        :param db_name: Cache database name
+        :return: Decoded record or None
+        '''
+        db = self.get_db(db_name)
+        self.ensure_indexes(db_name, table_name)
 
-        currency_date = (datetime.datetime.now() + datetime.timedelta(currency_threshold)).isoformat()
+        where = "sppin_key = ?"
+        values = [sppin_key]
+        if currency_threshold is not None:
+            where = f"{where} and date_processed > ?"
+            values.append(currency_date(currency_threshold))
 
-        where = "sppin_key = ? and date_processed > ?"
-        values = [sppin_key, currency_date]
+        json_columns = self.json_columns(db_name, table_name)
 
         result_list = list()
-        for row in db[table_name].rows_where(where, values):
-            record = dict()
-            for k, v in row.items():
-                try:
-                    record[k] = json.loads(v)
-                except:
-                    record[k] = v
-            result_list.append(record)
+        for row in db[table_name].rows_where(where, values, order_by="date_processed desc"):
+            result_list.append(self.decode_record(row, json_columns))
 
         if len(result_list) == 0:
             return None
 
-        # This takes care of an issue where multiple records were being inserted for a given sppin_key value in
-        # parallel processing
+        # This takes care of multiple records inserted for a given sppin_key value by parallel processing before
+        # upsert_record was available; the most recent record is kept
         if len(result_list) > 1:
-            for result in result_list[1:]:
-                self.delete_record(
-                    db_name,
-                    table_name,
-                    result["id"]
-                )
+            with self.transaction(db_name):
+                for result in result_list[1:]:
+                    self.delete_record(
+                        db_name,
+                        table_name,
+                        result["id"]
+                    )
 
         return result_list[0]
 
 
+# Days a known miss is trusted before the name is searched again, kept well below the 30 day currency used for the
+# source caches so that names added to a source are picked up reasonably soon
+default_negative_cache_ttls = {
+    "itis": 7,
+    "itis_local": 7,
+    "worms": 7,
+    "worms_local": 7,
+    "natureserve": 7,
+    "iucn": 7
+}
+
+
+class NegativeCache:
+    def __init__(self, cache_location=None, db_name="sppin", ttls=None, sql=None):
+        '''
+        Per-source cache of names that a source could not resolve, kept in a negative_results table in the Sql cache
+        database. Source searches check it before making any requests and return the stored failure structure for a
+        name that missed recently.
+
+        :param cache_location: Folder holding the Sql cache databases
+        :param db_name: Sql cache database name
+        :param ttls: Dictionary of source to days a miss is trusted, updating default_negative_cache_ttls
+        :param sql: Existing Sql object to share connections with; built from cache_location if not provided
+        '''
+        self.description = "Cache of names that sources could not resolve"
+        self.sql = sql if sql is not None else Sql(cache_location=cache_location)
+        self.db_name = db_name
+        self.table_name = "negative_results"
+        self.ttls = dict(default_negative_cache_ttls)
+        if ttls is not None:
+            self.ttls.update(ttls)
+        self._table_ready = False
+
+    def ensure_table(self):
+        if self._table_ready:
+            return
+
+        self.sql.get_db(self.db_name).execute(
+            f"CREATE TABLE IF NOT EXISTS [{self.table_name}] ("
+            "source TEXT NOT NULL, sppin_key TEXT NOT NULL, date_processed TEXT NOT NULL, result TEXT NOT NULL, "
+            "PRIMARY KEY (source, sppin_key))"
+        )
+        self._table_ready = True
+
+    def get(self, source, sppin_key):
+        '''
+        Looks up a recent miss for a name.
+
+        :param source: Source name, e.g. "itis"
+        :param sppin_key: Search key the miss was recorded under
+        :return: The failure result the source returned, flagged with from_cache, or None if there is no current miss
+        '''
+        self.ensure_table()
+
+        ttl = self.ttls.get(source)
+        if ttl is None:
+            return None
+
+        row = self.sql.get_db(self.db_name).execute(
+            f"SELECT result FROM [{self.table_name}] WHERE source = ? AND sppin_key = ? AND date_processed > ?",
+            [source, sppin_key, currency_date(ttl)]
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        result = json.loads(row[0])
+        result["processing_metadata"]["from_cache"] = True
+
+        return result
+
+    def put(self, source, result):
+        '''
+        Records a source result that did not resolve the name, replacing any earlier miss for the same key.
+
+        :param source: Source name, e.g. "itis"
+        :param result: Failure result containing sppin_key and date_processed
+        '''
+        self.ensure_table()
+
+        with self.sql.transaction(self.db_name) as db:
+            db.execute(
+                f"INSERT OR REPLACE INTO [{self.table_name}] (source, sppin_key, date_processed, result) "
+                "VALUES (?, ?, ?, ?)",
+                [source, result["sppin_key"], result["date_processed"], json.dumps(result, default=str)]
+            )
+
+    def remove(self, source, sppin_key):
+        self.ensure_table()
+
+        with self.sql.transaction(self.db_name) as db:
+            db.execute(
+                f"DELETE FROM [{self.table_name}] WHERE source = ? AND sppin_key = ?", [source, sppin_key]
+            )
+
+    def purge(self):
+        '''
+        Deletes misses older than their source's TTL.
+
+        :return: Number of records deleted
+        '''
+        self.ensure_table()
+
+        deleted = 0
+        with self.sql.transaction(self.db_name) as db:
+            for source, ttl in self.ttls.items():
+                if ttl is None:
+                    continue
+                deleted += db.execute(
+                    f"DELETE FROM [{self.table_name}] WHERE source = ? AND date_processed <= ?",
+                    [source, currency_date(ttl)]
+                ).rowcount
+
+        return deleted
+
+
+class SourceCache:
+    def __init__(self, cache_location=None, db_name="sppin", ttls=None, sql=None, revalidate_workers=2):
+        '''
+        Cache-first access to source searches backed by the Sql cache. Results are stored in a table named for the
+        source and served from there while they are newer than the source's TTL; older results are replaced by a new
+        search. With stale_while_revalidate, an expired result is returned immediately and refreshed in the
+        background, so interactive callers are never held up by the source.
+
+        Any search taking a sppin_key as its first argument can be wrapped, e.g.
+
+            source_cache = utils.SourceCache(cache_location)
+            search = source_cache.cached("worms")(worms.Worms().search)
+            result = search("Scientific Name:Balaena mysticetus")
+
+        :param cache_location: Folder holding the Sql cache databases
+        :param db_name: Sql cache database name
+        :param ttls: Dictionary of source to days a result is current, updating default_cache_ttls
+        :param sql: Existing Sql object to share connections with; built from cache_location if not provided
+        :param revalidate_workers: Number of background threads refreshing stale results
+        '''
+        self.description = "Cache-first wrapper for source searches"
+        self.sql = sql if sql is not None else Sql(cache_location=cache_location)
+        self.db_name = db_name
+        self.ttls = dict(default_cache_ttls)
+        if ttls is not None:
+            self.ttls.update(ttls)
+        self.revalidate_workers = revalidate_workers
+        self._revalidate_pool = None
+        self._revalidating = set()
+        self._lock = threading.Lock()
+
+    def ttl(self, source):
+        return self.ttls.get(source, 30)
+
+    def is_current(self, source, record):
+        return record["date_processed"] > currency_date(self.ttl(source))
+
+    def cached_record(self, source, sppin_key):
+        '''
+        Returns the latest cached result for a sppin_key regardless of age, in the structure the source search
+        returned.
+        '''
+        record = self.sql.sppin_key_current_record(source, sppin_key, currency_threshold=None, db_name=self.db_name)
+
+        if record is None:
+            return None
+
+        # Drop the row id the Sql cache adds; None values are kept as the source returned them
+        record = {k: v for k, v in record.items() if k != "id"}
+        record["processing_metadata"]["from_cache"] = True
+
+        return record
+
+    def store(self, source, sppin_key, result):
+        '''
+        Writes a fresh search result to the cache. Errors are not cached so that the next request searches again.
+
+        :return: The result, flagged as not from cache
+        '''
+        if not isinstance(result, dict) or "processing_metadata" not in result:
+            return result
+
+        result.setdefault("sppin_key", sppin_key)
+        result.setdefault("date_processed", result["processing_metadata"]["date_processed"])
+
+        if result["processing_metadata"]["status"] != "error":
+            self.sql.upsert_record(self.db_name, source, result)
+
+        result["processing_metadata"]["from_cache"] = False
+
+        return result
+
+    def search(self, source, sppin_key, search_function, *args, refresh=False, stale_while_revalidate=False,
+               **kwargs):
+        '''
+        Returns the cached result for sppin_key if it is current, otherwise runs search_function(*args, **kwargs),
+        stores and returns the new result.
+
+        :param source: Source name, also the cache table name
+        :param sppin_key: Key the result is cached under
+        :param search_function: Source search to run on a cache miss
+        :param refresh: Ignore the cache and search the source
+        :param stale_while_revalidate: Return an expired result straight away and refresh it in the background
+        :return: Source result with processing_metadata.from_cache set; expired results served under
+        stale_while_revalidate also have processing_metadata.stale set
+        '''
+        if not refresh:
+            record = self.cached_record(source, sppin_key)
+            if record is not None:
+                if self.is_current(source, record):
+                    return record
+                if stale_while_revalidate:
+                    record["processing_metadata"]["stale"] = True
+                    self.revalidate(source, sppin_key, search_function, *args, **kwargs)
+                    return record
+
+        return self.store(source, sppin_key, search_function(*args, **kwargs))
+
+    def revalidate(self, source, sppin_key, search_function, *args, **kwargs):
+        '''
+        Refreshes a cached result in a background thread, once per sppin_key at a time.
+        '''
+        with self._lock:
+            if (source, sppin_key) in self._revalidating:
+                return
+            self._revalidating.add((source, sppin_key))
+            if self._revalidate_pool is None:
+                self._revalidate_pool = ThreadPoolExecutor(max_workers=self.revalidate_workers)
+
+        def refresh():
+            try:
+                self.store(source, sppin_key, search_function(*args, **kwargs))
+            finally:
+                with self._lock:
+                    self._revalidating.discard((source, sppin_key))
+
+        self._revalidate_pool.submit(refresh)
+
+    def cached(self, source, key_builder=None, stale_while_revalidate=False):
+        '''
+        Decorator applying search to a source search function. The sppin_key is the first argument to the function,
+        or key_builder(first argument) for searches that take something else (e.g. sgcn takes a bare name). Callers
+        can pass refresh=True to the wrapped function to bypass the cache.
+        '''
+        def decorator(search_function):
+            @wraps(search_function)
+            def wrapper(*args, refresh=False, **kwargs):
+                sppin_key = args[0] if key_builder is None else key_builder(args[0])
+                return self.search(
+                    source,
+                    sppin_key,
+                    search_function,
+                    *args,
+                    refresh=refresh,
+                    stale_while_revalidate=stale_while_revalidate,
+                    **kwargs
+                )
+            return wrapper
+        return decorator
+
+    def filter_mq_list(self, mq_list, source, operation="processable"):
+        '''
+        Checks a message queue list against the cache for a source.
+
+        :param mq_list: List of message queue items with a search_key
+        :param source: Source name
+        :param operation: "processable" drops items with a current cached result; "flagged" sets in_cache on every
+        item that has a cached result of any age
+        :return: Filtered or flagged list
+        '''
+        db = self.sql.get_db(self.db_name)
+        search_keys = [i["search_key"] for i in mq_list]
+
+        cached_keys = set()
+        if db[source].exists():
+            for i in range(0, len(search_keys), 500):
+                chunk = search_keys[i:i + 500]
+                sql = f"SELECT DISTINCT sppin_key FROM [{source}] WHERE sppin_key IN ({','.join('?' * len(chunk))})"
+                if operation == "processable":
+                    sql = f"{sql} AND date_processed > ?"
+                    chunk = chunk + [currency_date(self.ttl(source))]
+                cached_keys.update(r[0] for r in db.execute(sql, chunk))
+
+        if operation == "processable":
+            return [i for i in mq_list if i["search_key"] not in cached_keys]
+
+        elif operation == "flagged":
+            return [dict(item, **{"in_cache": item["search_key"] in cached_keys}) for item in mq_list]
 
+    def close(self, wait=True):
+        if self._revalidate_pool is not None:
+            self._revalidate_pool.shutdown(wait=wait)
+            self._revalidate_pool = None
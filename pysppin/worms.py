@@ -1,11 +1,26 @@
-import requests
 from . import utils
+import os
+import re
+import csv
+import io
+import json
+import sqlite3
+import tempfile
+from zipfile import ZipFile
+import xml.etree.ElementTree as ET
+import copy
+from urllib.parse import urlencode
 
 common_utils = utils.Utils()
 
 class Worms:
-    def __init__(self):
+    def __init__(self, transport=None, negative_cache=None, identifier_cache=None):
         self.description = 'Set of functions for working with the World Register of Marine Species'
+        self.transport = transport if transport is not None else utils.default_transport
+        self.negative_cache = negative_cache
+        self.identifier_cache = identifier_cache if identifier_cache is not None else utils.default_identifier_cache
+        # Source that misses are cached under, kept apart per backend since a local snapshot can be out of date
+        self.negative_source = "worms"
         self.filter_ranks = ["kingdom", "phylum", "class", "order", "family", "genus"]
         self.worms_url_base = "http://www.marinespecies.org/aphia.php?p=taxdetails&id="
 
@@ -18,6 +33,12 @@ class Worms:
             return f"http://www.marinespecies.org/rest/AphiaRecordByAphiaID/{str(target)}"
         elif searchType == "searchAphiaID":
             return f"http://www.marinespecies.org/rest/AphiaIDByName/{str(target)}?marine_only=false"
+        elif searchType == "MatchNames":
+            names = urlencode([("scientificnames[]", n) for n in target])
+            return f"http://www.marinespecies.org/rest/AphiaRecordsByMatchNames?{names}&marine_only=false"
+        elif searchType == "AphiaIDs":
+            aphia_ids = urlencode([("aphiaids[]", i) for i in target])
+            return f"http://www.marinespecies.org/rest/AphiaRecordsByAphiaIDs?{aphia_ids}"
 
     def build_worms_taxonomy(self, wormsData):
         taxonomy = []
@@ -33,28 +54,22 @@ class Worms:
         return taxonomy
 
     def search(self, sppin_key, name_source=None, source_date=None):
+        if self.negative_cache is not None:
+            known_miss = self.negative_cache.get(self.negative_source, sppin_key)
+            if known_miss is not None:
+                return known_miss
 
         sppin_key_parts = sppin_key.split(":")
 
         headers = {'content-type': 'application/json'}
 
-        worms_result = common_utils.processing_metadata()
-        worms_result["sppin_key"] = sppin_key
-        worms_result["date_processed"] = worms_result["processing_metadata"]["date_processed"]
-        worms_result["processing_metadata"]["status"] = None
-        worms_result["processing_metadata"]["status_message"] = "Not Matched"
-
-        if name_source is not None:
-            worms_result["processing_metadata"]["name_source"] = name_source
-
-        if source_date is not None:
-            worms_result["processing_metadata"]["source_date"] = source_date
+        worms_result = self.search_result_stub(sppin_key, name_source=name_source, source_date=source_date)
 
         worms_data = list()
         aphia_ids = list()
 
         url_exact_match = self.get_worms_search_url("ExactName", sppin_key_parts[1])
-        name_results_exact = requests.get(url_exact_match, headers=headers)
+        name_results_exact = self.transport.get(url_exact_match, headers=headers)
 
         if name_results_exact.status_code == 200:
             worms_doc = name_results_exact.json()[0]
@@ -68,7 +83,11 @@ class Worms:
         else:
             url_fuzzy_match = self.get_worms_search_url("FuzzyName", sppin_key_parts[1])
             worms_result["processing_metadata"]["api"] = url_fuzzy_match
-            name_results_fuzzy = requests.get(url_fuzzy_match, headers=headers)
+            name_results_fuzzy = self.transport.get(url_fuzzy_match, headers=headers)
+            # WoRMS answers 204 No Content when it has no record for a name; anything else may be transient
+            if name_results_exact.status_code == 204 and name_results_fuzzy.status_code == 204 \
+                    and self.negative_cache is not None:
+                self.negative_cache.put(self.negative_source, worms_result)
             if name_results_fuzzy.status_code == 200:
                 worms_doc = name_results_fuzzy.json()[0]
                 worms_doc["biological_taxonomy"] = self.build_worms_taxonomy(worms_doc)
@@ -78,31 +97,207 @@ class Worms:
                 if worms_doc["AphiaID"] not in aphia_ids:
                     aphia_ids.append(worms_doc["AphiaID"])
 
-        if len(worms_data) > 0 and "valid_AphiaID" in worms_data[0].keys():
-            valid_aphiaid = worms_data[0]["valid_AphiaID"]
-            while valid_aphiaid is not None:
-                if valid_aphiaid not in aphia_ids:
-                    url_aphiaid = self.get_worms_search_url("AphiaID", valid_aphiaid)
-                    aphiaid_results = requests.get(url_aphiaid, headers=headers)
-                    if aphiaid_results.status_code == 200:
-                        worms_doc = aphiaid_results.json()
-                        # Build common biological_taxonomy structure
-                        worms_doc["biological_taxonomy"] = self.build_worms_taxonomy(worms_doc)
-                        worms_result["processing_metadata"]["api"] = url_aphiaid
-                        worms_result["processing_metadata"]["status"] = "success"
-                        worms_result["processing_metadata"]["status_message"] = "Followed Valid AphiaID"
-                        worms_data.append(worms_doc)
-                        if worms_doc["AphiaID"] not in aphia_ids:
-                            aphia_ids.append(worms_doc["AphiaID"])
-                        if "valid_AphiaID" in worms_doc.keys():
-                            valid_aphiaid = worms_doc["valid_AphiaID"]
-                        else:
-                            valid_aphiaid = None
-                    else:
-                        valid_aphiaid = None
+        self.follow_valid_aphiaids(worms_result, worms_data, aphia_ids, self.fetch_aphia_record)
+
+        return self.package_worms_result(worms_result, worms_data)
+
+    def search_batch(self, sppin_keys, batch_size=50, name_source=None, source_date=None):
+        '''
+        Runs the search process for a list of names with batched requests. Exact matches come from
+        AphiaRecordsByMatchNames, batch_size names per call; only names without an exact match go on to the same
+        individual fuzzy name query search uses. The valid AphiaID chains of every name are then retrieved together
+        with AphiaRecordsByAphiaIDs, one round of calls per hop rather than one call per hop per name.
+
+        :param sppin_keys: List of search keys in the form "Scientific Name:<name>"
+        :param batch_size: Number of names per match call; the service accepts up to 50
+        :param name_source: String indicating where the scientific names were sourced for tracking purposes
+        :param source_date: Date of the name source
+        :return: List of WoRMS results in the order of sppin_keys, each the same as search returns for that key
+        '''
+        headers = {'content-type': 'application/json'}
+
+        known_misses = dict()
+        if self.negative_cache is not None:
+            for sppin_key in sppin_keys:
+                known_miss = self.negative_cache.get(self.negative_source, sppin_key)
+                if known_miss is not None:
+                    known_misses[sppin_key] = known_miss
+
+        search_keys = list(dict.fromkeys(k for k in sppin_keys if k not in known_misses))
+
+        # Matched record, the query it came from and the match method for each key
+        matches = dict()
+        definite_misses = set()
+        for i in range(0, len(search_keys), batch_size):
+            batch = search_keys[i:i + batch_size]
+            url_match_names = self.get_worms_search_url("MatchNames", [k.split(":")[1] for k in batch])
+            match_results = self.transport.get(url_match_names, headers=headers)
+
+            for sppin_key, exact_match in zip(batch, self.batch_exact_matches(batch, match_results, headers)):
+                worms_doc, exact_status_code = exact_match
+                if worms_doc is not None:
+                    matches[sppin_key] = (
+                        worms_doc, self.get_worms_search_url("ExactName", sppin_key.split(":")[1]), "Exact Match"
+                    )
+                    continue
+
+                url_fuzzy_match = self.get_worms_search_url("FuzzyName", sppin_key.split(":")[1])
+                name_results_fuzzy = self.transport.get(url_fuzzy_match, headers=headers)
+                if name_results_fuzzy.status_code == 200:
+                    matches[sppin_key] = (name_results_fuzzy.json()[0], url_fuzzy_match, "Fuzzy Match")
                 else:
-                    valid_aphiaid = None
+                    matches[sppin_key] = (None, url_fuzzy_match, None)
+                    if name_results_fuzzy.status_code == 204 and exact_status_code == 204:
+                        definite_misses.add(sppin_key)
+
+        # Retrieve every record the valid AphiaID chains pass through, one hop for all names at a time
+        records = dict()
+        pending = set(d["valid_AphiaID"] for d, _, _ in matches.values() if d is not None and
+                      d.get("valid_AphiaID") is not None and d["valid_AphiaID"] != d["AphiaID"])
+        while len(pending) > 0:
+            for aphia_id in list(pending):
+                worms_doc = self.identifier_cache.get("worms", aphia_id)
+                if worms_doc is not None:
+                    records[aphia_id] = worms_doc
+                    pending.discard(aphia_id)
+            pending = sorted(pending)
+            for i in range(0, len(pending), 50):
+                chunk = pending[i:i + 50]
+                # AphiaIDs that cannot be retrieved stay None so that they end the chain and are not asked for again
+                records.update((aphia_id, None) for aphia_id in chunk)
+                aphiaid_results = self.transport.get(self.get_worms_search_url("AphiaIDs", chunk), headers=headers)
+                if aphiaid_results.status_code == 200:
+                    for worms_doc in aphiaid_results.json():
+                        if worms_doc is not None:
+                            records[worms_doc["AphiaID"]] = worms_doc
+                            self.identifier_cache.put("worms", worms_doc["AphiaID"], worms_doc)
+            pending = set(
+                d["valid_AphiaID"] for d in records.values() if d is not None and
+                d.get("valid_AphiaID") is not None and d["valid_AphiaID"] not in records
+            )
+
+        worms_results = list()
+        for sppin_key in sppin_keys:
+            if sppin_key in known_misses:
+                worms_results.append(known_misses[sppin_key])
+                continue
+
+            worms_result = self.search_result_stub(sppin_key, name_source=name_source, source_date=source_date)
+            worms_doc, url_match, status_message = matches[sppin_key]
+            worms_result["processing_metadata"]["api"] = url_match
+
+            worms_data = list()
+            aphia_ids = list()
+            if worms_doc is not None:
+                worms_doc = copy.deepcopy(worms_doc)
+                worms_doc["biological_taxonomy"] = self.build_worms_taxonomy(worms_doc)
+                worms_result["processing_metadata"]["status"] = "success"
+                worms_result["processing_metadata"]["status_message"] = status_message
+                worms_data.append(worms_doc)
+                aphia_ids.append(worms_doc["AphiaID"])
+
+            self.follow_valid_aphiaids(
+                worms_result, worms_data, aphia_ids, lambda aphia_id: copy.deepcopy(records.get(aphia_id))
+            )
+
+            if sppin_key in definite_misses and self.negative_cache is not None:
+                self.negative_cache.put(self.negative_source, worms_result)
+
+            worms_results.append(self.package_worms_result(worms_result, worms_data))
+
+        return worms_results
+
+    def batch_exact_matches(self, batch, match_results, headers):
+        '''
+        Exact match for each key in a batch from an AphiaRecordsByMatchNames response. If the match call failed, each
+        name falls back to the individual exact name query search uses, so that a failed batch does not send names
+        with an exact match to the fuzzy query.
+
+        :return: List of (Aphia record or None, status code) in the order of batch, with 204 meaning a confirmed miss
+        '''
+        if match_results.status_code == 200:
+            exact_matches = list()
+            for match_list in match_results.json():
+                worms_doc = next((d for d in match_list or list() if d.get("match_type") == "exact"), None)
+                exact_matches.append((worms_doc, 204 if worms_doc is None else 200))
+            return exact_matches
+
+        if match_results.status_code == 204:
+            return [(None, 204)] * len(batch)
+
+        exact_matches = list()
+        for sppin_key in batch:
+            name_results_exact = self.transport.get(
+                self.get_worms_search_url("ExactName", sppin_key.split(":")[1]), headers=headers
+            )
+            if name_results_exact.status_code == 200:
+                exact_matches.append((name_results_exact.json()[0], 200))
+            else:
+                exact_matches.append((None, name_results_exact.status_code))
+
+        return exact_matches
+
+    def fetch_aphia_record(self, aphia_id):
+        worms_doc = self.identifier_cache.get("worms", aphia_id)
+        if worms_doc is not None:
+            return worms_doc
+
+        aphiaid_results = self.transport.get(
+            self.get_worms_search_url("AphiaID", aphia_id), headers={'content-type': 'application/json'}
+        )
+        if aphiaid_results.status_code != 200:
+            return None
+
+        worms_doc = aphiaid_results.json()
+        self.identifier_cache.put("worms", aphia_id, worms_doc)
+
+        return worms_doc
+
+    def follow_valid_aphiaids(self, worms_result, worms_data, aphia_ids, fetch_record):
+        '''
+        Follows valid_AphiaID from the matched record until it repeats, is missing or cannot be retrieved, adding each
+        record to worms_data.
+
+        :param fetch_record: Function returning the Aphia record for an AphiaID, or None if it cannot be retrieved
+        '''
+        if len(worms_data) == 0 or "valid_AphiaID" not in worms_data[0].keys():
+            return
+
+        valid_aphiaid = worms_data[0]["valid_AphiaID"]
+        while valid_aphiaid is not None and valid_aphiaid not in aphia_ids:
+            worms_doc = fetch_record(valid_aphiaid)
+            if worms_doc is None:
+                return
+            # Build common biological_taxonomy structure
+            worms_doc["biological_taxonomy"] = self.build_worms_taxonomy(worms_doc)
+            worms_result["processing_metadata"]["api"] = self.get_worms_search_url("AphiaID", valid_aphiaid)
+            worms_result["processing_metadata"]["status"] = "success"
+            worms_result["processing_metadata"]["status_message"] = "Followed Valid AphiaID"
+            worms_data.append(worms_doc)
+            if worms_doc["AphiaID"] not in aphia_ids:
+                aphia_ids.append(worms_doc["AphiaID"])
+            valid_aphiaid = worms_doc.get("valid_AphiaID")
+
+    def search_result_stub(self, sppin_key, name_source=None, source_date=None):
+        worms_result = common_utils.processing_metadata()
+        worms_result["sppin_key"] = sppin_key
+        worms_result["date_processed"] = worms_result["processing_metadata"]["date_processed"]
+        worms_result["processing_metadata"]["status"] = None
+        worms_result["processing_metadata"]["status_message"] = "Not Matched"
+
+        if name_source is not None:
+            worms_result["processing_metadata"]["name_source"] = name_source
+
+        if source_date is not None:
+            worms_result["processing_metadata"]["source_date"] = source_date
 
+        return worms_result
+
+    def package_worms_result(self, worms_result, worms_data):
+        '''
+        Finishes a WoRMS result from the Aphia records gathered for a name: the matched record first, followed by the
+        records for each valid AphiaID hop.
+        '''
         if len(worms_data) > 0:
             # Convert to common property names for resolvable_identifier, citation_string, and date_modified
             # from source properties
@@ -126,3 +321,326 @@ class Worms:
 
         return worms_result
 
+
+class WormsDb:
+    def __init__(self, cache_location=os.getenv("DATA_CACHE")):
+        '''
+        Local copy of WoRMS built from a Darwin Core Archive export. The Sqlite database holds the Aphia record for
+        every taxon, an index of normalized names to AphiaIDs, and the valid AphiaID chain of every taxon collapsed
+        ahead of time, so that a name and everything Worms.search follows from it come out of indexed lookups.
+
+        :param cache_location: Folder to build WoRMS.sqlite in. Defaults to 'DATA_CACHE' environment variable.
+        '''
+        self.description = "Set of functions for building and reading a local WoRMS snapshot"
+        self.cache_location = cache_location
+        self.worms_sqlite_filename = "WoRMS.sqlite"
+        self.worms_url_base = "http://www.marinespecies.org/aphia.php?p=taxdetails&id="
+        self.lsid_base = "urn:lsid:marinespecies.org:taxname:"
+        self.record_fields = [
+            "AphiaID", "url", "scientificname", "authority", "status", "unacceptreason", "taxonRankID", "rank",
+            "valid_AphiaID", "valid_name", "valid_authority", "parentNameUsageID", "kingdom", "phylum", "class",
+            "order", "family", "genus", "citation", "lsid", "isMarine", "isBrackish", "isFreshwater",
+            "isTerrestrial", "isExtinct", "match_type", "modified"
+        ]
+        self.profile_fields = ["isMarine", "isBrackish", "isFreshwater", "isTerrestrial", "isExtinct"]
+
+    def worms_db(self):
+        worms_file = f"{self.cache_location}/{self.worms_sqlite_filename}"
+        if not os.path.isfile(worms_file):
+            raise ValueError(f"No WoRMS snapshot found at {worms_file}; build one with WormsDb.load_dwca")
+
+        return sqlite3.connect(worms_file)
+
+    def normalize_name(self, name):
+        return " ".join(str(name).split()).lower()
+
+    def aphia_id(self, value):
+        '''
+        AphiaID from a DwC-A identifier, which may be a bare integer or an LSID.
+        '''
+        if value is None:
+            return None
+        match = re.search(r"(\d+)\s*$", value)
+        return int(match.group(1)) if match is not None else None
+
+    def read_dwca_table(self, dwca, row_type):
+        '''
+        Reads the core or an extension file from a DwC-A, using meta.xml for the file name, delimiter and column terms.
+
+        :param dwca: Open ZipFile or path to an unzipped archive folder
+        :param row_type: Last part of the rowType term, e.g. "Taxon" or "SpeciesProfile"
+        :return: Iterator of dictionaries keyed by the short DwC term names, or an empty iterator if the archive has
+        no such file
+        '''
+        def open_member(name):
+            if isinstance(dwca, ZipFile):
+                return io.TextIOWrapper(dwca.open(name), encoding="utf-8", newline="")
+            return open(os.path.join(dwca, name), encoding="utf-8", newline="")
+
+        with open_member("meta.xml") as f:
+            meta = ET.fromstring(f.read())
+
+        for table in meta:
+            if table.get("rowType", "").split("/")[-1] != row_type:
+                continue
+
+            location = next(e.text for e in table.iter() if e.tag.split("}")[-1] == "location").strip()
+            delimiter = table.get("fieldsTerminatedBy", "\\t").encode().decode("unicode_escape")
+            header_lines = int(table.get("ignoreHeaderLines", "0"))
+            columns = dict()
+            for e in table:
+                tag = e.tag.split("}")[-1]
+                if tag in ["id", "coreid"]:
+                    columns[int(e.get("index"))] = "id"
+                elif tag == "field" and e.get("index") is not None:
+                    columns[int(e.get("index"))] = e.get("term").split("/")[-1]
+
+            with open_member(location) as f:
+                reader = csv.reader(f, delimiter=delimiter, quoting=csv.QUOTE_NONE)
+                for _ in range(header_lines):
+                    next(reader, None)
+                for row in reader:
+                    yield {
+                        name: (row[i] if i < len(row) and len(row[i]) > 0 else None) for i, name in columns.items()
+                    }
+            return
+
+    def aphia_record(self, taxon):
+        '''
+        Builds the Aphia record structure the WoRMS REST service returns from a DwC-A taxon row. Properties that
+        depend on other taxa (valid_authority) or on the species profile extension are filled in afterwards.
+        '''
+        aphia_id = self.aphia_id(taxon.get("taxonID") or taxon.get("id"))
+        status = taxon.get("taxonomicStatus")
+        valid_aphia_id = self.aphia_id(taxon.get("acceptedNameUsageID"))
+        valid_name = taxon.get("acceptedNameUsage")
+        if valid_aphia_id is None and status == "accepted":
+            valid_aphia_id = aphia_id
+            valid_name = taxon.get("scientificName")
+
+        return {
+            "AphiaID": aphia_id,
+            "url": f"{self.worms_url_base}{aphia_id}",
+            "scientificname": taxon.get("scientificName"),
+            "authority": taxon.get("scientificNameAuthorship"),
+            "status": status,
+            "unacceptreason": taxon.get("taxonRemarks"),
+            "taxonRankID": None,
+            "rank": taxon.get("taxonRank"),
+            "valid_AphiaID": valid_aphia_id,
+            "valid_name": valid_name,
+            "valid_authority": None,
+            "parentNameUsageID": self.aphia_id(taxon.get("parentNameUsageID")),
+            "kingdom": taxon.get("kingdom"),
+            "phylum": taxon.get("phylum"),
+            "class": taxon.get("class"),
+            "order": taxon.get("order"),
+            "family": taxon.get("family"),
+            "genus": taxon.get("genus"),
+            "citation": taxon.get("bibliographicCitation"),
+            "lsid": taxon.get("scientificNameID") or f"{self.lsid_base}{aphia_id}",
+            "isMarine": None,
+            "isBrackish": None,
+            "isFreshwater": None,
+            "isTerrestrial": None,
+            "isExtinct": None,
+            "match_type": None,
+            "modified": taxon.get("modified")
+        }
+
+    def valid_chain(self, aphia_id, valid_ids):
+        '''
+        Follows valid AphiaIDs from a taxon the same way Worms.search does against the service: until an AphiaID
+        repeats, has no valid AphiaID, or is not in the snapshot.
+
+        :return: List of the AphiaIDs followed, not including aphia_id itself
+        '''
+        seen = [aphia_id]
+        valid_aphia_id = valid_ids.get(aphia_id)
+        while valid_aphia_id is not None and valid_aphia_id not in seen and valid_aphia_id in valid_ids:
+            seen.append(valid_aphia_id)
+            valid_aphia_id = valid_ids[valid_aphia_id]
+
+        return seen[1:]
+
+    def load_dwca(self, dwca_path):
+        '''
+        Builds WoRMS.sqlite from a WoRMS Darwin Core Archive export, replacing any existing snapshot once the new one
+        is complete.
+
+        :param dwca_path: Path to the DwC-A zip file or an unzipped archive folder
+        :return: Status message
+        '''
+        if self.cache_location is None:
+            return "A cache location must be provided. Defaults to 'DATA_CACHE' environment variable."
+
+        dwca = ZipFile(dwca_path) if os.path.isfile(dwca_path) else dwca_path
+        try:
+            records = dict()
+            for taxon in self.read_dwca_table(dwca, "Taxon"):
+                record = self.aphia_record(taxon)
+                if record["AphiaID"] is not None:
+                    records[record["AphiaID"]] = record
+
+            for profile in self.read_dwca_table(dwca, "SpeciesProfile"):
+                record = records.get(self.aphia_id(profile.get("id")))
+                if record is None:
+                    continue
+                for field in self.profile_fields:
+                    if profile.get(field) is not None:
+                        record[field] = 1 if profile[field].lower() in ["1", "true"] else 0
+        finally:
+            if isinstance(dwca, ZipFile):
+                dwca.close()
+
+        valid_ids = {aphia_id: r["valid_AphiaID"] for aphia_id, r in records.items()}
+        for record in records.values():
+            valid_record = records.get(record["valid_AphiaID"])
+            if valid_record is not None:
+                record["valid_authority"] = valid_record["authority"]
+
+        db_fd, db_path = tempfile.mkstemp(dir=self.cache_location, suffix=".sqlite")
+        os.close(db_fd)
+        try:
+            con = sqlite3.connect(db_path)
+            columns = ", ".join(f"[{f}]" for f in self.record_fields)
+            con.execute(f"CREATE TABLE aphia_records ({columns}, PRIMARY KEY (AphiaID))")
+            con.execute("CREATE TABLE names (name TEXT, AphiaID INTEGER)")
+            con.execute("CREATE TABLE valid_chains (AphiaID INTEGER PRIMARY KEY, accepted_AphiaID INTEGER, chain TEXT)")
+
+            con.executemany(
+                f"INSERT INTO aphia_records VALUES ({','.join('?' * len(self.record_fields))})",
+                ([r[f] for f in self.record_fields] for r in records.values())
+            )
+            con.executemany(
+                "INSERT INTO names VALUES (?, ?)",
+                ((self.normalize_name(r["scientificname"]), r["AphiaID"]) for r in records.values()
+                 if r["scientificname"] is not None)
+            )
+            chains = ((aphia_id, self.valid_chain(aphia_id, valid_ids)) for aphia_id in records)
+            con.executemany(
+                "INSERT INTO valid_chains VALUES (?, ?, ?)",
+                ((aphia_id, chain[-1] if len(chain) > 0 else aphia_id, json.dumps(chain)) for aphia_id, chain in chains)
+            )
+            con.execute("CREATE INDEX idx_names_name ON names (name, AphiaID)")
+            con.commit()
+            con.close()
+
+            os.replace(db_path, f"{self.cache_location}/{self.worms_sqlite_filename}")
+        finally:
+            if os.path.exists(db_path):
+                os.remove(db_path)
+
+        return f"WoRMS snapshot written to {self.cache_location}/{self.worms_sqlite_filename} ({len(records)} taxa)"
+
+
+class WormsLocal(Worms):
+    def __init__(self, cache_location=os.getenv("DATA_CACHE"), negative_cache=None, identifier_cache=None):
+        '''
+        Resolves names against a local WoRMS snapshot built with WormsDb.load_dwca instead of the WoRMS REST service.
+        The matched record and its whole valid AphiaID chain come from one indexed lookup on the name, and the result
+        is packaged exactly as Worms.search packages service records.
+
+        :param cache_location: Folder containing WoRMS.sqlite. Defaults to 'DATA_CACHE' environment variable.
+        :param negative_cache: utils.NegativeCache of names known not to resolve
+        :param identifier_cache: utils.IdentifierCache; unused locally since records come straight from the snapshot
+        '''
+        super().__init__(negative_cache=negative_cache, identifier_cache=identifier_cache)
+        self.description = "Set of functions for resolving names against a local WoRMS snapshot"
+        self.negative_source = "worms_local"
+        self.worms_db = WormsDb(cache_location=cache_location)
+        self._con = None
+
+    def search_batch(self, sppin_keys, batch_size=50, name_source=None, source_date=None):
+        '''
+        Names are resolved one at a time against the local snapshot; there is no round trip to save by batching.
+        batch_size is accepted for compatibility with Worms.search_batch.
+        '''
+        return [self.search(k, name_source=name_source, source_date=source_date) for k in sppin_keys]
+
+    @property
+    def con(self):
+        if self._con is None:
+            self._con = self.worms_db.worms_db()
+            self._con.row_factory = sqlite3.Row
+        return self._con
+
+    def get_worms_search_url(self, searchType, target):
+        '''
+        Local equivalent of the service URL, e.g. "WoRMS.sqlite:ExactName:Balaena mysticetus", recorded in
+        processing_metadata in place of the service URL.
+        '''
+        return f"{self.worms_db.worms_sqlite_filename}:{searchType}:{target}"
+
+    def match_name(self, name, fuzzy=False):
+        '''
+        Finds the AphiaID and valid chain for a name. Exact matches are on the normalized name; fuzzy matches take
+        names starting with the search string, like the service's like=true option.
+
+        :return: (AphiaID, list of AphiaIDs in the valid chain) or None
+        '''
+        name = self.worms_db.normalize_name(name)
+        sql = """
+            SELECT n.AphiaID, c.chain FROM names n
+            JOIN valid_chains c ON c.AphiaID = n.AphiaID
+            JOIN aphia_records r ON r.AphiaID = n.AphiaID
+            WHERE {where}
+            ORDER BY r.status = 'accepted' DESC, n.name, n.AphiaID
+            LIMIT 1
+        """
+        if fuzzy:
+            row = self.con.execute(sql.format(where="n.name >= ? AND n.name < ?"), [name, f"{name}\uffff"]).fetchone()
+        else:
+            row = self.con.execute(sql.format(where="n.name = ?"), [name]).fetchone()
+
+        if row is None:
+            return None
+
+        return row["AphiaID"], json.loads(row["chain"])
+
+    def aphia_records(self, aphia_ids):
+        rows = self.con.execute(
+            f"SELECT * FROM aphia_records WHERE AphiaID IN ({','.join('?' * len(aphia_ids))})", aphia_ids
+        ).fetchall()
+        by_id = {r["AphiaID"]: dict(r) for r in rows}
+
+        return [by_id[i] for i in aphia_ids if i in by_id]
+
+    def search(self, sppin_key, name_source=None, source_date=None):
+        if self.negative_cache is not None:
+            known_miss = self.negative_cache.get(self.negative_source, sppin_key)
+            if known_miss is not None:
+                return known_miss
+
+        name = sppin_key.split(":")[1]
+        worms_result = self.search_result_stub(sppin_key, name_source=name_source, source_date=source_date)
+
+        match_type = "exact"
+        worms_result["processing_metadata"]["api"] = self.get_worms_search_url("ExactName", name)
+        match = self.match_name(name)
+        if match is None:
+            match_type = "like"
+            worms_result["processing_metadata"]["api"] = self.get_worms_search_url("FuzzyName", name)
+            match = self.match_name(name, fuzzy=True)
+
+        if match is None:
+            if self.negative_cache is not None:
+                self.negative_cache.put(self.negative_source, worms_result)
+            return self.package_worms_result(worms_result, list())
+
+        aphia_id, chain = match
+        worms_data = self.aphia_records([aphia_id] + chain)
+        worms_data[0]["match_type"] = match_type
+
+        worms_result["processing_metadata"]["status"] = "success"
+        worms_result["processing_metadata"]["status_message"] = "Exact Match" if match_type == "exact" \
+            else "Fuzzy Match"
+        if len(worms_data) > 1:
+            worms_result["processing_metadata"]["api"] = self.get_worms_search_url("AphiaID", worms_data[-1]["AphiaID"])
+            worms_result["processing_metadata"]["status_message"] = "Followed Valid AphiaID"
+
+        for worms_doc in worms_data:
+            worms_doc["biological_taxonomy"] = self.build_worms_taxonomy(worms_doc)
+
+        return self.package_worms_result(worms_result, worms_data)
+
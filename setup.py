@@ -19,7 +19,11 @@ setup(
         'bs4',
         'sciencebasepy',
         'pandas',
+        'numpy',
         'sqlite_utils'
     ],
+    extras_require={
+        'arrow': ['pyarrow']
+    },
     zip_safe=False
 )
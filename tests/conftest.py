@@ -0,0 +1,317 @@
+import copy
+import json
+import re
+import sqlite3
+import zipfile
+from urllib.parse import parse_qs, unquote, urlparse
+
+import geopandas as gpd
+import pytest
+from shapely.geometry import Polygon
+
+from pysppin import worms
+
+itis_schema = """
+CREATE TABLE taxonomic_units (tsn INTEGER PRIMARY KEY, unit_ind1 TEXT, unit_name1 TEXT, unit_ind2 TEXT,
+    unit_name2 TEXT, unit_ind3 TEXT, unit_name3 TEXT, unit_ind4 TEXT, unit_name4 TEXT, unnamed_taxon_ind TEXT,
+    name_usage TEXT, unaccept_reason TEXT, credibility_rtng TEXT, completeness_rtng TEXT, currency_rating TEXT,
+    phylo_sort_seq INTEGER, initial_time_stamp TEXT, parent_tsn INTEGER, taxon_author_id INTEGER,
+    hybrid_author_id INTEGER, kingdom_id INTEGER, rank_id INTEGER, update_date TEXT, uncertain_prnt_ind TEXT,
+    n_usage TEXT, complete_name TEXT);
+CREATE TABLE kingdoms (kingdom_id INTEGER, kingdom_name TEXT, update_date TEXT);
+CREATE TABLE taxon_unit_types (kingdom_id INTEGER, rank_id INTEGER, rank_name TEXT, dir_parent_rank_id INTEGER,
+    req_parent_rank_id INTEGER, update_date TEXT);
+CREATE TABLE taxon_authors_lkp (taxon_author_id INTEGER, taxon_author TEXT, update_date TEXT, kingdom_id INTEGER,
+    short_author TEXT);
+CREATE TABLE synonym_links (tsn INTEGER, tsn_accepted INTEGER, update_date TEXT);
+CREATE TABLE vernaculars (tsn INTEGER, vernacular_name TEXT, language TEXT, approved_ind TEXT, update_date TEXT,
+    vern_id INTEGER);
+CREATE TABLE jurisdiction (tsn INTEGER, jurisdiction_value TEXT, origin TEXT, update_date TEXT);
+CREATE TABLE geographic_div (tsn INTEGER, geographic_value TEXT, update_date TEXT);
+CREATE TABLE reference_links (tsn INTEGER, doc_id_prefix TEXT, documentation_id INTEGER, original_desc_ind TEXT,
+    init_itis_desc_ind TEXT, change_track_id INTEGER, vernacular_name TEXT, update_date TEXT);
+CREATE TABLE experts (expert_id_prefix TEXT, expert_id INTEGER, expert TEXT, exp_comment TEXT, update_date TEXT);
+CREATE TABLE publications (pub_id_prefix TEXT, publication_id INTEGER, reference_author TEXT, title TEXT,
+    publication_name TEXT, listed_pub_date TEXT, actual_pub_date TEXT, publisher TEXT, pub_place TEXT, isbn TEXT,
+    issn TEXT, pages TEXT, pub_comment TEXT, update_date TEXT);
+CREATE TABLE other_sources (source_id_prefix TEXT, source_id INTEGER, source_type TEXT, source TEXT, version TEXT,
+    acquisition_date TEXT, source_comment TEXT, update_date TEXT);
+CREATE TABLE comments (comment_id INTEGER, commentator TEXT, comment_detail TEXT, comment_time_stamp TEXT,
+    update_date TEXT);
+CREATE TABLE tu_comment_links (tsn INTEGER, comment_id INTEGER, update_date TEXT);
+INSERT INTO kingdoms VALUES (5, 'Animalia', '2000-01-01');
+INSERT INTO taxon_unit_types VALUES (5, 10, 'Kingdom', 0, 0, ''), (5, 140, 'Family', 100, 100, ''),
+    (5, 180, 'Genus', 140, 140, ''), (5, 220, 'Species', 180, 180, ''), (5, 230, 'Subspecies', 220, 220, '');
+INSERT INTO taxon_authors_lkp VALUES (1, 'Linnaeus, 1758', '2000', 5, 'L');
+INSERT INTO synonym_links VALUES (183815, 726821, '2010');
+INSERT INTO vernaculars VALUES (180596, 'gray wolf', 'English', 'N', '2010', 1);
+INSERT INTO jurisdiction VALUES (180596, 'Continental US', 'Native', '2010');
+INSERT INTO reference_links VALUES (180596, 'EXP', 5, 'N', 'N', NULL, NULL, '2001');
+INSERT INTO experts VALUES ('EXP', 5, 'Jane Doe', NULL, '2002');
+INSERT INTO reference_links VALUES (180596, 'PUB', 7, 'N', 'N', NULL, NULL, '2001');
+INSERT INTO publications VALUES ('PUB', 7, 'Smith', 'A Title', 'Journal', NULL, '1999', NULL, NULL, NULL, NULL, '1-2',
+    NULL, '2003');
+INSERT INTO comments VALUES (9, 'Bob', 'a comment', '2004', '2005');
+INSERT INTO tu_comment_links VALUES (180596, 9, '2005');
+"""
+
+# tsn, unit names, usage, parent tsn, rank id, author id
+itis_taxa = [
+    (202423, ["Animalia"], "valid", 0, 10, None),
+    (180599, ["Canidae"], "valid", 202423, 140, None),
+    (180595, ["Canis"], "valid", 180599, 180, None),
+    (180596, ["Canis", "lupus"], "valid", 180595, 220, 1),
+    (726821, ["Canis", "lupus", "familiaris"], "valid", 180596, 230, 1),
+    (183815, ["Canis", "familiaris"], "invalid", 180595, 220, 1),
+]
+
+
+def write_itis_db(file_location):
+    con = sqlite3.connect(file_location)
+    con.executescript(itis_schema)
+    for tsn, unit_names, usage, parent_tsn, rank_id, author_id in itis_taxa:
+        unit_names = unit_names + [None] * (3 - len(unit_names))
+        con.execute(
+            "INSERT INTO taxonomic_units (tsn, unit_name1, unit_name2, unit_name3, name_usage, parent_tsn, "
+            "kingdom_id, rank_id, taxon_author_id, complete_name, initial_time_stamp, update_date, credibility_rtng) "
+            "VALUES (?, ?, ?, ?, ?, ?, 5, ?, ?, ?, '1996-06-13 14:51:08', '2010-01-01', 'TWG standards met')",
+            [tsn] + unit_names + [usage, parent_tsn, rank_id, author_id, " ".join(n for n in unit_names if n)]
+        )
+    con.commit()
+    con.close()
+
+
+@pytest.fixture
+def itis_cache(tmp_path):
+    '''
+    Cache folder holding a small synthetic ITIS.sqlite: Animalia > Canidae > Canis > Canis lupus > Canis lupus
+    familiaris, plus the invalid Canis familiaris pointing at the subspecies.
+    '''
+    write_itis_db(str(tmp_path / "ITIS.sqlite"))
+    return str(tmp_path)
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, json_data=None, content=b"", headers=None):
+        self.status_code = status_code
+        self._json = json_data
+        self.content = content
+        self.headers = headers if headers is not None else dict()
+
+    def json(self):
+        if self._json is None:
+            raise ValueError("No JSON content")
+        return copy.deepcopy(self._json)
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8") if isinstance(self.content, bytes) else json.dumps(self._json)
+
+
+class FakeTransport:
+    '''
+    Stands in for utils.Transport, answering each request with handler(method, url, kwargs) and recording the URLs.
+    '''
+    def __init__(self, handler):
+        self.handler = handler
+        self.calls = list()
+
+    def get(self, url, **kwargs):
+        self.calls.append(url)
+        return self.handler("GET", url, kwargs)
+
+    def post(self, url, **kwargs):
+        self.calls.append(url)
+        return self.handler("POST", url, kwargs)
+
+
+worms_meta = '''<?xml version="1.0" encoding="UTF-8"?>
+<archive xmlns="http://rs.tdwg.org/dwc/text/">
+ <core encoding="UTF-8" fieldsTerminatedBy="\\t" linesTerminatedBy="\\n" fieldsEnclosedBy="" ignoreHeaderLines="1"
+  rowType="http://rs.tdwg.org/dwc/terms/Taxon">
+  <files><location>taxon.txt</location></files>
+  <id index="0"/>
+  <field index="1" term="http://rs.tdwg.org/dwc/terms/scientificNameID"/>
+  <field index="2" term="http://rs.tdwg.org/dwc/terms/acceptedNameUsageID"/>
+  <field index="3" term="http://rs.tdwg.org/dwc/terms/parentNameUsageID"/>
+  <field index="4" term="http://rs.tdwg.org/dwc/terms/scientificName"/>
+  <field index="5" term="http://rs.tdwg.org/dwc/terms/acceptedNameUsage"/>
+  <field index="6" term="http://rs.tdwg.org/dwc/terms/kingdom"/>
+  <field index="7" term="http://rs.tdwg.org/dwc/terms/phylum"/>
+  <field index="8" term="http://rs.tdwg.org/dwc/terms/class"/>
+  <field index="9" term="http://rs.tdwg.org/dwc/terms/order"/>
+  <field index="10" term="http://rs.tdwg.org/dwc/terms/family"/>
+  <field index="11" term="http://rs.tdwg.org/dwc/terms/genus"/>
+  <field index="12" term="http://rs.tdwg.org/dwc/terms/taxonRank"/>
+  <field index="13" term="http://rs.tdwg.org/dwc/terms/scientificNameAuthorship"/>
+  <field index="14" term="http://rs.tdwg.org/dwc/terms/taxonomicStatus"/>
+  <field index="15" term="http://purl.org/dc/terms/modified"/>
+  <field index="16" term="http://purl.org/dc/terms/bibliographicCitation"/>
+ </core>
+ <extension encoding="UTF-8" fieldsTerminatedBy="\\t" linesTerminatedBy="\\n" ignoreHeaderLines="1"
+  rowType="http://rs.gbif.org/terms/1.0/SpeciesProfile">
+  <files><location>speciesprofile.txt</location></files>
+  <coreid index="0"/>
+  <field index="1" term="http://rs.gbif.org/terms/1.0/isMarine"/>
+  <field index="2" term="http://rs.gbif.org/terms/1.0/isFreshwater"/>
+ </extension>
+</archive>'''
+
+# AphiaID, valid AphiaID, name, status, rank: a synonym chain, a synonym loop and a synonym of a missing taxon
+worms_taxa = [
+    (137087, 137087, "Balaena mysticetus", "accepted", "Species"),
+    (500001, 137087, "Balaena borealis", "unaccepted", "Species"),
+    (500002, 500001, "Balaena oldname", "unaccepted", "Species"),
+    (137088, 137088, "Balaena glacialis", "accepted", "Species"),
+    (600001, 600002, "Loopus a", "unaccepted", "Species"),
+    (600002, 600001, "Loopus b", "unaccepted", "Species"),
+    (700001, 999999, "Orphan name", "unaccepted", "Species"),
+    (137000, 137000, "Balaena", "accepted", "Genus"),
+]
+
+
+def write_worms_dwca(file_location):
+    lsid = "urn:lsid:marinespecies.org:taxname:"
+    names = {t[0]: t[2] for t in worms_taxa}
+    taxon_rows = ["taxonID\tscientificNameID\tacceptedNameUsageID\tparentNameUsageID\tscientificName\t"
+                  "acceptedNameUsage\tkingdom\tphylum\tclass\torder\tfamily\tgenus\ttaxonRank\t"
+                  "scientificNameAuthorship\ttaxonomicStatus\tmodified\tbibliographicCitation"]
+    for aphia_id, valid_aphia_id, name, status, rank in worms_taxa:
+        taxon_rows.append("\t".join([
+            f"{lsid}{aphia_id}", f"{lsid}{aphia_id}", f"{lsid}{valid_aphia_id}", f"{lsid}137000", name,
+            names.get(valid_aphia_id, "Missing"), "Animalia", "Chordata", "Mammalia", "Cetartiodactyla",
+            "Balaenidae", "Balaena", rank, "Linnaeus, 1758", status, "2020-01-01T00:00:00Z", f"WoRMS {aphia_id}"
+        ]))
+    profile_rows = ["id\tisMarine\tisFreshwater"] + [f"{lsid}{t[0]}\t1\t0" for t in worms_taxa]
+
+    with zipfile.ZipFile(file_location, "w") as z:
+        z.writestr("meta.xml", worms_meta)
+        z.writestr("taxon.txt", "\n".join(taxon_rows) + "\n")
+        z.writestr("speciesprofile.txt", "\n".join(profile_rows) + "\n")
+
+
+@pytest.fixture
+def worms_cache(tmp_path):
+    '''
+    Cache folder holding a WoRMS.sqlite snapshot loaded from a small DwC-A of worms_taxa.
+    '''
+    write_worms_dwca(str(tmp_path / "worms.zip"))
+    worms.WormsDb(cache_location=str(tmp_path)).load_dwca(str(tmp_path / "worms.zip"))
+    return str(tmp_path)
+
+
+@pytest.fixture
+def worms_service(worms_cache):
+    '''
+    FakeTransport answering the WoRMS REST calls Worms makes from the records in the local snapshot.
+    '''
+    local = worms.WormsLocal(cache_location=worms_cache)
+    records = {r["AphiaID"]: r for r in local.aphia_records([t[0] for t in worms_taxa])}
+
+    def ordered():
+        return sorted(records.values(), key=lambda r: (r["status"] != "accepted", r["scientificname"].lower(),
+                                                       r["AphiaID"]))
+
+    def handler(method, url, kwargs):
+        if "AphiaRecordsByName/" in url:
+            name = unquote(url.split("AphiaRecordsByName/")[1].split("?")[0]).lower()
+            like = "like=true" in url
+            matched = [dict(r, match_type="like" if like else "exact") for r in ordered() if
+                       (r["scientificname"].lower().startswith(name) if like else r["scientificname"].lower() == name)]
+            return FakeResponse(200, matched) if len(matched) > 0 else FakeResponse(204)
+
+        if "AphiaRecordByAphiaID/" in url:
+            aphia_id = int(url.rsplit("/", 1)[1])
+            return FakeResponse(200, records[aphia_id]) if aphia_id in records else FakeResponse(204)
+
+        params = parse_qs(urlparse(url).query)
+        if "AphiaRecordsByMatchNames" in url:
+            match_lists = list()
+            for name in params["scientificnames[]"]:
+                name = name.lower()
+                exact = [dict(r, match_type="exact") for r in ordered() if r["scientificname"].lower() == name]
+                near = [dict(r, match_type="near_2") for r in ordered() if
+                        r["scientificname"].lower()[:6] == name[:6] and r["scientificname"].lower() != name][:1]
+                match_lists.append(near + exact or None)
+            return FakeResponse(200, match_lists) if any(match_lists) else FakeResponse(204)
+
+        if "AphiaRecordsByAphiaIDs" in url:
+            return FakeResponse(200, [records.get(int(i)) for i in params["aphiaids[]"]])
+
+        return FakeResponse(400)
+
+    return FakeTransport(handler)
+
+
+def gap_range_features():
+    '''
+    Range features in the layer's EPSG:5070: several seasons for some species, one for others, 23 in all.
+    '''
+    features = list()
+    for i in range(23):
+        x, y = -2000000 + (i % 9) * 450000 + i * 7000, 300000 + (i % 5) * 500000
+        features.append({
+            "SppCode": f"b{i % 9:05d}",
+            "Season": i % 3,
+            "geometry": Polygon([(x, y), (x + 300000, y + 50000), (x + 250000, y + 400000), (x - 20000, y + 280000)])
+        })
+
+    return gpd.GeoDataFrame(features, crs="EPSG:5070")
+
+
+class GapService:
+    '''
+    Fake ScienceBase GeoServer for the GAP range layer: WFS 2.0 paging, CQL_FILTER and propertyName on GetFeature,
+    DescribeFeatureType, and the gs:Bounds WPS process. wps_status and describe_status set the status codes of those
+    two calls; wps_body replaces the bounding box response.
+    '''
+    def __init__(self):
+        self.features = gap_range_features()
+        self.wps_status = 200
+        self.wps_body = None
+        self.describe_status = 200
+        self.transport = FakeTransport(self.handler)
+
+    def geojson(self, features):
+        doc = json.loads(features.to_json())
+        doc["crs"] = {"type": "name", "properties": {"name": "urn:ogc:def:crs:EPSG::5070"}}
+        return json.dumps(doc).encode()
+
+    def handler(self, method, url, kwargs):
+        if method == "POST":
+            return self.wps_bounds(kwargs["data"])
+
+        params = {k: v[0] for k, v in parse_qs(urlparse(url).query).items()}
+        if params.get("request") == "DescribeFeatureType":
+            return FakeResponse(self.describe_status, {"featureTypes": [{"properties": [
+                {"name": "SppCode", "type": "xsd:string"}, {"name": "Season", "type": "xsd:int"},
+                {"name": "geometry", "type": "gml:MultiPolygon"}
+            ]}]})
+
+        features = self.features
+        if "CQL_FILTER" in params:
+            features = features[features["SppCode"] == params["CQL_FILTER"].split("'")[1]]
+        if "startIndex" in params:
+            start_index = int(params["startIndex"])
+            features = features.iloc[start_index:start_index + int(params["count"])]
+        if "propertyName" in params:
+            features = features[params["propertyName"].split(",")]
+
+        return FakeResponse(content=self.geojson(features))
+
+    def wps_bounds(self, execute):
+        if self.wps_status != 200 or self.wps_body is not None:
+            return FakeResponse(self.wps_status, content=self.wps_body or b"")
+
+        sppcode = re.search(rb"<ogc:Literal>(.*?)</ogc:Literal>", execute).group(1).decode()
+        minx, miny, maxx, maxy = self.features[self.features["SppCode"] == sppcode].total_bounds
+        return FakeResponse(content=(
+            '<ows:BoundingBox xmlns:ows="http://www.opengis.net/ows/1.1" crs="EPSG:5070">'
+            f'<ows:LowerCorner>{minx} {miny}</ows:LowerCorner><ows:UpperCorner>{maxx} {maxy}</ows:UpperCorner>'
+            '</ows:BoundingBox>'
+        ).encode())
+
+
+@pytest.fixture
+def gap_service():
+    return GapService()
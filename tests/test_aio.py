@@ -0,0 +1,67 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from pysppin import aio
+
+
+@pytest.fixture
+def fake_sources(monkeypatch):
+    state = {"running": 0, "max_running": 0, "lock": threading.Lock()}
+
+    def tracked(result):
+        def search(t, key, name_source, nc=None):
+            with state["lock"]:
+                state["running"] += 1
+                state["max_running"] = max(state["max_running"], state["running"])
+            time.sleep(0.05)
+            with state["lock"]:
+                state["running"] -= 1
+            return result(key)
+        return search
+
+    def fail(t, key, name_source, nc=None):
+        raise RuntimeError("service down")
+
+    def slow(t, key, name_source, nc=None):
+        time.sleep(0.5)
+        return {"sppin_key": key}
+
+    monkeypatch.setattr(aio, "source_searches", {
+        "a": tracked(lambda key: {"sppin_key": key, "source": "a"}),
+        "b": tracked(lambda key: {"sppin_key": key, "source": "b"}),
+        "fail": fail,
+        "slow": slow
+    })
+
+    return state
+
+
+def test_gather_species(fake_sources):
+    results = asyncio.run(aio.gather_species("Scientific Name:Canis lupus", sources=["a", "b", "fail"]))
+
+    assert results["a"] == {"sppin_key": "Scientific Name:Canis lupus", "source": "a"}
+    assert results["b"]["source"] == "b"
+    assert results["fail"]["processing_metadata"]["status"] == "error"
+    assert results["fail"]["processing_metadata"]["status_message"] == "Source search failed: service down"
+
+
+def test_timeout(fake_sources):
+    results = asyncio.run(
+        aio.gather_species("Scientific Name:Canis lupus", sources=["slow", "a"], timeouts={"slow": 0.1})
+    )
+
+    assert results["slow"]["processing_metadata"]["status_message"] == "Source search timed out after 0.1 seconds"
+    assert results["a"]["source"] == "a"
+
+
+def test_gather_species_list_limits_threads(fake_sources):
+    sppin_keys = [f"Scientific Name:Name {i}" for i in range(10)]
+
+    results = asyncio.run(aio.gather_species_list(sppin_keys, sources=["a", "b"], max_concurrency=3))
+
+    assert list(results.keys()) == sppin_keys
+    assert all(results[k]["a"]["sppin_key"] == k for k in sppin_keys)
+    assert fake_sources["max_running"] <= 3
@@ -0,0 +1,60 @@
+import pytest
+
+from pysppin import utils
+
+definitions = {
+    "definitions": {
+        "scientificname": {"type": "string", "aliases": ["scientificName", "ScientificName", "sciname"]},
+        "commonname": {"type": "string", "aliases": ["vernacularName", "comname"]},
+        "taxonomicrank": {"type": "string", "aliases": ["rank"]},
+        "date_processed": {"type": "string"}
+    }
+}
+
+
+@pytest.fixture
+def common_properties(monkeypatch):
+    monkeypatch.setattr(utils, "common_properties", definitions)
+    utils.common_property_mappings.cache_clear()
+    yield definitions
+    utils.common_property_mappings.cache_clear()
+
+
+def baseline_mappings(common_properties, target_properties=None):
+    '''
+    How integrate_recordset built its mappings before they were memoized.
+    '''
+    mappings = dict()
+    for k, v in common_properties["definitions"].items():
+        if target_properties is None:
+            if "aliases" in common_properties["definitions"][k]:
+                for alias in common_properties["definitions"][k]["aliases"]:
+                    mappings[alias] = k
+        else:
+            if "aliases" in common_properties["definitions"][k] and k in target_properties:
+                for alias in common_properties["definitions"][k]["aliases"]:
+                    mappings[alias] = k
+    return mappings
+
+
+def test_mappings_match_baseline(common_properties):
+    assert utils.common_property_mappings() == baseline_mappings(common_properties)
+    assert utils.common_property_mappings(("commonname", "date_processed")) == \
+        baseline_mappings(common_properties, ["commonname", "date_processed"])
+
+
+def test_mappings_memoized(common_properties):
+    first = utils.common_property_mappings(("scientificname",))
+
+    assert utils.common_property_mappings(("scientificname",)) is first
+    assert utils.common_property_mappings.cache_info().hits == 1
+
+
+def test_integrate_recordset(common_properties):
+    record = {"scientificName": "Canis lupus", "rank": "Species", "data": [{"vernacularName": "gray wolf"}]}
+
+    integrated = utils.Utils().integrate_recordset(record, target_properties=["scientificname", "commonname"])
+
+    assert integrated == [
+        {"scientificname": "Canis lupus", "rank": "Species", "data": [{"commonname": "gray wolf"}]}
+    ]
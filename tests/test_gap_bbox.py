@@ -0,0 +1,66 @@
+import pytest
+from conftest import gap_range_features
+from shapely.geometry import box
+
+from pysppin import gap
+
+
+@pytest.fixture
+def gap_bbox(gap_service, tmp_path):
+    return gap.Gap(transport=gap_service.transport, cache_location=str(tmp_path))
+
+
+def reprojected_bounds(features, sppcode):
+    return features[features["SppCode"] == sppcode].to_crs(epsg=4326).total_bounds.tolist()
+
+
+def test_build_range_bbox_table(gap_bbox, gap_service):
+    message = gap_bbox.build_range_bbox_table(page_size=5)
+
+    assert message.startswith("Range bounding boxes for 9 species written to")
+    get_feature_calls = [u for u in gap_service.transport.calls if "GetFeature" in u]
+    assert len(get_feature_calls) == 5
+    assert all("propertyName=SppCode%2Cgeometry" in u for u in get_feature_calls)
+
+    for sppcode in sorted(set(gap_service.features["SppCode"])):
+        assert gap_bbox.range_bbox(sppcode) == pytest.approx(reprojected_bounds(gap_service.features, sppcode))
+        hull = gap_bbox.range_hull(sppcode)
+        assert box(*gap_bbox.range_bbox(sppcode)).buffer(0.01).contains(hull)
+
+
+def test_lookup_does_not_call_the_service(gap_bbox, gap_service):
+    gap_bbox.build_range_bbox_table()
+    gap_service.transport.calls.clear()
+
+    gap_bbox.range_bbox("b00003")
+
+    assert gap_service.transport.calls == list()
+
+
+def test_rebuild_replaces_open_table(gap_bbox, gap_service):
+    gap_bbox.build_range_bbox_table()
+    assert gap_bbox.range_bbox_record("b00000") is not None
+
+    gap_service.features = gap_service.features[gap_service.features["SppCode"] != "b00000"]
+    gap_bbox.build_range_bbox_table()
+
+    assert gap_bbox.range_bbox_record("b00000") is None
+    assert gap_bbox.range_bbox_record("b00001") is not None
+
+
+def test_species_missing_from_table_uses_the_service(gap_bbox, gap_service):
+    gap_service.features = gap_service.features[gap_service.features["SppCode"] != "b00004"]
+    gap_bbox.build_range_bbox_table()
+    gap_service.features = gap_range_features()
+    gap_service.transport.calls.clear()
+
+    assert gap_bbox.range_bbox("b00004") == gap_bbox.gap_spp_range_bbox("b00004")
+    assert len(gap_service.transport.calls) > 0
+
+
+def test_no_cache_location(gap_service):
+    gap_bbox = gap.Gap(transport=gap_service.transport, cache_location=None)
+
+    assert gap_bbox.build_range_bbox_table() == \
+        "A cache location must be provided. Defaults to 'DATA_CACHE' environment variable."
+    assert gap_bbox.range_bbox_record("b00000") is None
@@ -0,0 +1,105 @@
+import pytest
+from shapely.geometry import box
+
+from pysppin import gap
+
+exception_report = b'<ows:ExceptionReport xmlns:ows="http://www.opengis.net/ows/1.1" version="1.1.0">' \
+                   b'<ows:Exception exceptionCode="InvalidParameterValue" locator="Identifier"/></ows:ExceptionReport>'
+
+
+@pytest.fixture
+def gap_bbox(gap_service):
+    return gap.Gap(transport=gap_service.transport, cache_location=None)
+
+
+def wps_calls(gap_service):
+    return [u for u in gap_service.transport.calls if "GetFeature" not in u and "DescribeFeatureType" not in u]
+
+
+def test_default_mode_is_bounds(gap_bbox, gap_service):
+    bbox = gap_bbox.range_bbox("b00002")
+
+    assert bbox == pytest.approx(gap_bbox.gap_spp_range_bbox("b00002", mode="bounds"))
+    assert len(wps_calls(gap_service)) == 2
+    assert not any("GetFeature" in u for u in gap_service.transport.calls)
+
+
+def test_features_mode_opt_in(gap_bbox, gap_service):
+    gap_bbox.range_bbox_mode = "features"
+    features = gap_service.features[gap_service.features["SppCode"] == "b00002"]
+
+    assert gap_bbox.range_bbox("b00002") == pytest.approx(features.to_crs(epsg=4326).total_bounds.tolist())
+    assert wps_calls(gap_service) == list()
+
+
+@pytest.mark.parametrize("mode", ["bounds", "paged"])
+def test_modes_enclose_features_bounds(gap_bbox, mode):
+    features_bbox = gap_bbox.gap_spp_range_bbox("b00002", mode="features")
+    bbox = gap_bbox.gap_spp_range_bbox("b00002", mode=mode, page_size=1)
+
+    assert box(*bbox).buffer(1e-9).contains(box(*features_bbox))
+
+
+def test_bounds_matches_paged(gap_bbox, gap_service):
+    bounds_bbox = gap_bbox.gap_spp_range_bbox("b00005", mode="bounds")
+
+    assert len(wps_calls(gap_service)) == 1
+    assert bounds_bbox == pytest.approx(gap_bbox.gap_spp_range_bbox("b00005", mode="paged"))
+
+
+@pytest.mark.parametrize("status_code,body", [(404, b""), (400, b""), (200, exception_report)])
+def test_unsupported_wps_is_not_asked_again(gap_bbox, gap_service, status_code, body):
+    gap_service.wps_status, gap_service.wps_body = status_code, body
+
+    paged_bbox = gap_bbox.gap_spp_range_bbox("b00001", mode="paged")
+    assert gap_bbox.gap_spp_range_bbox("b00001", mode="bounds") == pytest.approx(paged_bbox)
+    gap_bbox.gap_spp_range_bbox("b00002", mode="bounds")
+
+    assert len(wps_calls(gap_service)) == 1
+
+
+@pytest.mark.parametrize("status_code", [429, 500, 503])
+def test_transient_wps_failure_is_retried(gap_bbox, gap_service, status_code):
+    gap_service.wps_status = status_code
+    paged_bbox = gap_bbox.gap_spp_range_bbox("b00001", mode="paged")
+
+    assert gap_bbox.gap_spp_range_bbox("b00001", mode="bounds") == pytest.approx(paged_bbox)
+
+    gap_service.wps_status = 200
+    gap_bbox.gap_spp_range_bbox("b00001", mode="bounds")
+
+    assert len(wps_calls(gap_service)) == 2
+
+
+@pytest.mark.parametrize("crs", ['', ' crs="EPSG:not-a-code"'])
+def test_unusable_wps_crs_falls_back_to_paged(gap_bbox, gap_service, crs):
+    gap_service.wps_body = (
+        f'<ows:BoundingBox xmlns:ows="http://www.opengis.net/ows/1.1"{crs}>'
+        '<ows:LowerCorner>0 0</ows:LowerCorner><ows:UpperCorner>1 1</ows:UpperCorner></ows:BoundingBox>'
+    ).encode()
+
+    assert gap_bbox.gap_spp_range_bbox("b00001", mode="bounds") == \
+        pytest.approx(gap_bbox.gap_spp_range_bbox("b00001", mode="paged"))
+
+
+def test_geometry_property(gap_bbox, gap_service):
+    assert gap_bbox.range_geometry_property() == "geometry"
+    assert gap_bbox.range_geometry_property() == "geometry"
+    assert len([u for u in gap_service.transport.calls if "DescribeFeatureType" in u]) == 1
+
+
+def test_geometry_property_transient_failure(gap_bbox, gap_service):
+    gap_service.describe_status = 503
+    assert gap_bbox.range_geometry_property() is None
+
+    gap_service.describe_status = 200
+    assert gap_bbox.range_geometry_property() == "geometry"
+
+
+def test_geometry_property_not_supported(gap_bbox, gap_service):
+    gap_service.describe_status = 400
+    assert gap_bbox.range_geometry_property() is None
+
+    gap_service.describe_status = 200
+    assert gap_bbox.range_geometry_property() is None
+    assert len([u for u in gap_service.transport.calls if "DescribeFeatureType" in u]) == 1
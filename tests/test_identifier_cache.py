@@ -0,0 +1,55 @@
+from pysppin import itis, utils
+
+
+def test_records_are_copied():
+    cache = utils.IdentifierCache()
+    record = {"tsn": "1", "names": ["a"]}
+    cache.put("itis", 1, record)
+    record["names"].append("b")
+
+    cached = cache.get("itis", "1")
+    cached["names"].append("c")
+
+    assert cache.get("itis", 1) == {"tsn": "1", "names": ["a"]}
+    assert cache.stats()["hits"] == 2
+
+
+def test_lru_eviction():
+    cache = utils.IdentifierCache(maxsize=2)
+    cache.put("worms", 1, {"AphiaID": 1})
+    cache.put("worms", 2, {"AphiaID": 2})
+    cache.get("worms", 1)
+    cache.put("worms", 3, {"AphiaID": 3})
+
+    assert cache.get("worms", 2) is None
+    assert cache.get("worms", 1) == {"AphiaID": 1}
+    assert cache.stats()["evictions"] == 1
+
+
+def test_memory_records_expire():
+    cache = utils.IdentifierCache(ttls={"itis": 7})
+    cache.put("itis", 1, {"tsn": "1"})
+    cache._records[("itis", "1")] = (utils.currency_date(8), {"tsn": "1"})
+
+    assert cache.get("itis", 1) is None
+    assert cache.stats()["size"] == 0
+
+
+def test_backed_records_expire(tmp_path):
+    sql = utils.Sql(cache_location=str(tmp_path))
+    utils.IdentifierCache(sql=sql).put("worms", 1, {"AphiaID": 1})
+
+    assert utils.IdentifierCache(sql=sql).get("worms", 1) == {"AphiaID": 1}
+    assert utils.IdentifierCache(sql=sql, ttls={"worms": 0}).get("worms", 1) is None
+
+
+def test_local_and_service_records_are_kept_apart(itis_cache):
+    cache = utils.IdentifierCache()
+    local = itis.ItisLocal(cache_location=itis_cache, identifier_cache=cache)
+    cache.put("itis", 726821, {"tsn": "726821", "nameWInd": "From the Solr service"})
+
+    result = local.search("Scientific Name:Canis familiaris")
+
+    assert result["data"][0]["nameWInd"] == "Canis lupus familiaris"
+    assert cache.get("itis_local", 726821)["nameWInd"] == "Canis lupus familiaris"
+    assert cache.get("itis", 726821)["nameWInd"] == "From the Solr service"
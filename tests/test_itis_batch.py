@@ -0,0 +1,93 @@
+import copy
+import re
+
+import pytest
+
+from pysppin import itis, utils
+
+
+class SolrOverLocal(itis.ItisApi):
+    '''
+    ItisApi whose Solr queries are answered by ItisLocal, so that search and search_batch can be compared without the
+    ITIS service.
+    '''
+    def __init__(self, local, **kwargs):
+        super().__init__(**kwargs)
+        self.local = local
+        self.queries = list()
+
+    def run_itis_query(self, query):
+        self.queries.append(query)
+        m = re.search(r"rows=(\d+)(?:&start=(\d+))?&q=(.*)$", query)
+        rows, start = int(m.group(1)), int(m.group(2) or 0)
+
+        docs = list()
+        for clause in m.group(3).split("%20OR%20"):
+            clause = clause.replace("\\%20", " ").replace("%20AND%20(usage:accepted%20OR%20usage:valid)",
+                                                           " AND (usage:accepted OR usage:valid)")
+            for doc in self.local.run_itis_query(clause)["response"]["docs"]:
+                # Solr returns a document once however many of the OR clauses it matches
+                if doc["tsn"] not in [d["tsn"] for d in docs]:
+                    docs.append(doc)
+
+        num_found = len(docs)
+
+        return {"response": {"numFound": num_found, "docs": copy.deepcopy(docs[start:start + rows])}}
+
+
+def without_dates(result):
+    result = copy.deepcopy(result)
+    result.pop("date_processed")
+    result["processing_metadata"].pop("date_processed")
+    return result
+
+
+@pytest.fixture
+def solr(itis_cache):
+    local = itis.ItisLocal(cache_location=itis_cache, identifier_cache=utils.IdentifierCache(maxsize=0))
+    return SolrOverLocal(local, identifier_cache=utils.IdentifierCache(maxsize=0))
+
+
+sppin_keys = [
+    "Scientific Name:Canis lupus",
+    "Scientific Name:Canis  lupus",
+    "Scientific Name:Canis lupsu",
+    "Scientific Name:Canis familiaris",
+    "Scientific Name:Felis catus",
+    "TSN:180596",
+]
+
+
+def test_search_batch_matches_search(solr):
+    single = [without_dates(solr.search(k)) for k in sppin_keys]
+    single_queries = len(solr.queries)
+
+    solr.queries.clear()
+    batch = [without_dates(r) for r in solr.search_batch(sppin_keys, batch_size=4)]
+
+    assert batch == single
+    assert len(solr.queries) < single_queries
+
+
+def test_search_batch_hard_fail(solr):
+    def fail(query):
+        raise ConnectionError(query)
+    solr.run_itis_query = fail
+
+    results = solr.search_batch(sppin_keys[:2])
+
+    assert [r["processing_metadata"]["status"] for r in results] == ["error", "error"]
+    assert results[0]["processing_metadata"]["status_message"] == "Hard Fail Query"
+
+
+def test_failed_batch_query_falls_back_to_single_queries(solr):
+    single = [without_dates(solr.search(k)) for k in sppin_keys]
+
+    def fail_batches(searchstrs, rows):
+        raise ValueError("Solr could not parse the combined query")
+    solr.run_itis_batch_query = fail_batches
+    solr.queries.clear()
+
+    batch = [without_dates(r) for r in solr.search_batch(sppin_keys, batch_size=4)]
+
+    assert batch == single
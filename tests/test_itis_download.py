@@ -0,0 +1,107 @@
+import io
+import json
+import os
+import zipfile
+
+import pytest
+
+from pysppin import itis
+
+
+class StreamResponse:
+    def __init__(self, status_code, content=b"", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers if headers is not None else dict()
+        self.closed = False
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(self.status_code)
+
+    def close(self):
+        self.closed = True
+
+
+def zipped_db(db_bytes):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as z:
+        z.writestr("itisSqlite/ITIS.sqlite", db_bytes)
+    return buffer.getvalue()
+
+
+class DownloadServer:
+    def __init__(self, db_bytes, etag="v1"):
+        self.db_bytes = db_bytes
+        self.etag = etag
+        self.requests = list()
+
+    def get(self, url, headers=None, stream=False):
+        self.requests.append(headers)
+        if headers.get("If-None-Match") == self.etag:
+            return StreamResponse(304)
+        return StreamResponse(200, zipped_db(self.db_bytes), {"ETag": self.etag})
+
+
+@pytest.fixture
+def server():
+    return DownloadServer(b"SQLite format 3\x00" + b"x" * 5000)
+
+
+def read_meta(cache_location):
+    with open(f"{cache_location}/ITIS.sqlite.download.json") as f:
+        return json.loads(f.read())
+
+
+def test_first_download(tmp_path, server):
+    message = itis.ItisDb(transport=server).cache_itis_db(cache_location=str(tmp_path))
+
+    assert message.startswith("File written to")
+    assert (tmp_path / "ITIS.sqlite").read_bytes() == server.db_bytes
+    meta = read_meta(str(tmp_path))
+    assert meta["etag"] == "v1"
+    assert meta["md5"] == itis.ItisDb().get_md5(str(tmp_path / "ITIS.sqlite"))
+    assert meta["size"] == len(server.db_bytes)
+    assert sorted(os.listdir(tmp_path)) == ["ITIS.sqlite", "ITIS.sqlite.download.json"]
+
+
+def test_not_modified(tmp_path, server):
+    itis_db = itis.ItisDb(transport=server)
+    itis_db.cache_itis_db(cache_location=str(tmp_path))
+
+    message = itis_db.cache_itis_db(cache_location=str(tmp_path))
+
+    assert server.requests[-1] == {"If-None-Match": "v1"}
+    assert message.startswith("Cached file is current")
+
+
+def test_same_content_not_replaced(tmp_path, server, monkeypatch):
+    itis_db = itis.ItisDb(transport=server)
+    itis_db.cache_itis_db(cache_location=str(tmp_path))
+    inode = os.stat(tmp_path / "ITIS.sqlite").st_ino
+    server.etag = "v2"
+    monkeypatch.setattr(itis_db, "get_md5", lambda fname: pytest.fail("digest should come from the metadata"))
+
+    message = itis_db.cache_itis_db(cache_location=str(tmp_path))
+
+    assert message.startswith("Cached file and online file are equivalent")
+    assert os.stat(tmp_path / "ITIS.sqlite").st_ino == inode
+    assert read_meta(str(tmp_path))["etag"] == "v2"
+
+
+def test_changed_file_rehashed(tmp_path, server):
+    itis_db = itis.ItisDb(transport=server)
+    itis_db.cache_itis_db(cache_location=str(tmp_path))
+    with open(tmp_path / "ITIS.sqlite", "ab") as f:
+        f.write(b"corrupted")
+
+    message = itis_db.cache_itis_db(cache_location=str(tmp_path))
+
+    # The conditional headers belong to the file as downloaded, so they are not sent for a changed file
+    assert server.requests[-1] == dict()
+    assert message.startswith("File written to")
+    assert (tmp_path / "ITIS.sqlite").read_bytes() == server.db_bytes
@@ -0,0 +1,69 @@
+import copy
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+from conftest import FakeResponse, FakeTransport
+from pysppin import itis, utils
+
+valid_query = "hierarchyTSN:180595%20AND%20(usage:accepted%20OR%20usage:valid)"
+
+
+@pytest.fixture
+def itis_local(itis_cache):
+    return itis.ItisLocal(cache_location=itis_cache, identifier_cache=utils.IdentifierCache())
+
+
+@pytest.fixture
+def solr(itis_local):
+    '''
+    ItisApi over a transport that serves cursorMark pages of the local documents under Canis.
+    '''
+    docs = [itis_local.build_itis_doc(t) for t in [180595, 180596, 183815, 726821]]
+
+    def handler(method, url, kwargs):
+        params = {k: v[0] for k, v in parse_qs(urlparse(url).query).items()}
+        matched = [d for d in docs if "usage:valid" not in params["q"] or d["usage"] == "valid"]
+        start = 0 if params["cursorMark"] == "*" else int(params["cursorMark"])
+        page = copy.deepcopy(matched[start:start + int(params["rows"])])
+        if "fl" in params:
+            page = [{k: v for k, v in d.items() if k in params["fl"].split(",")} for d in page]
+        next_cursor_mark = str(start + len(page)) if len(page) > 0 else params["cursorMark"]
+        return FakeResponse(json_data={"response": {"docs": page}, "nextCursorMark": next_cursor_mark})
+
+    return itis.ItisApi(transport=FakeTransport(handler))
+
+
+def test_api_export_pages_with_cursor_mark(solr):
+    docs = list(solr.export(valid_query, fields=["tsn", "nameWInd"], page_size=2))
+
+    assert [d["tsn"] for d in docs] == ["180595", "180596", "726821"]
+    assert docs[0]["hierarchy"] == ["Animalia", "Canidae", "Canis"]
+    assert "usage" not in docs[0]
+    cursor_marks = [parse_qs(urlparse(u).query)["cursorMark"][0] for u in solr.transport.calls]
+    assert cursor_marks == ["*", "2", "3"]
+    assert all("fl=tsn,nameWInd,createDate" in u and "sort=tsn%20asc" in u for u in solr.transport.calls)
+
+
+def test_local_export_matches_api(solr, itis_local):
+    for fields in [None, ["tsn", "nameWInd"]]:
+        api_docs = list(solr.export(valid_query, fields=fields, page_size=2))
+        local_docs = list(itis_local.export(valid_query, fields=fields, page_size=2))
+
+        assert local_docs == api_docs
+
+
+def test_local_export_queries(itis_local):
+    assert [d["tsn"] for d in itis_local.export("hierarchyTSN:180595", package=False)] == \
+        ["180595", "180596", "183815", "726821"]
+    assert [d["tsn"] for d in itis_local.export("*:*", sort="tsn desc")] == \
+        ["726821", "202423", "183815", "180599", "180596", "180595"]
+    assert [d["tsn"] for d in itis_local.export("nameWOInd:Canis\\%20lupus")] == ["180596"]
+    assert list(itis_local.export("hierarchyTSN:1")) == []
+
+
+def test_local_export_unsupported(itis_local):
+    with pytest.raises(ValueError):
+        list(itis_local.export("vernacular:wolf"))
+    with pytest.raises(ValueError):
+        list(itis_local.export("*:*", sort="nameWInd asc"))
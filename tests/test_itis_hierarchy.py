@@ -0,0 +1,74 @@
+import os
+import sqlite3
+
+import numpy as np
+import pytest
+
+from pysppin import itis
+
+
+def test_lineage(itis_cache):
+    index = itis.ItisDb().hierarchy_index(cache_location=itis_cache)
+
+    assert index.lineage(726821) == [
+        {"rank": "Kingdom", "name": "Animalia", "tsn": 202423},
+        {"rank": "Family", "name": "Canidae", "tsn": 180599},
+        {"rank": "Genus", "name": "Canis", "tsn": 180595},
+        {"rank": "Species", "name": "Canis lupus", "tsn": 180596},
+        {"rank": "Subspecies", "name": "Canis lupus familiaris", "tsn": 726821}
+    ]
+    assert index.lineage(1) is None
+
+
+def test_descendants(itis_cache):
+    index = itis.ItisHierarchy(cache_location=itis_cache).load()
+
+    assert list(index.descendants(180595)) == [180596, 726821]
+    assert list(index.descendants(180595, valid_only=False)) == [180596, 183815, 726821]
+    assert list(index.descendants(202423, rank_id=220)) == [180596]
+    assert list(index.descendants(726821)) == []
+
+
+def test_lowest_common_ancestor(itis_cache):
+    index = itis.ItisHierarchy(cache_location=itis_cache).load()
+
+    assert index.lowest_common_ancestor(726821, 183815) == 180595
+    assert index.lowest_common_ancestor(726821, 180596) == 180596
+    assert index.lowest_common_ancestor(726821, 1) is None
+
+
+def test_rebuilds_when_database_changes(itis_cache):
+    index = itis.ItisHierarchy(cache_location=itis_cache).load()
+    assert index.meta["count"] == 6
+
+    con = sqlite3.connect(f"{itis_cache}/ITIS.sqlite")
+    con.execute("INSERT INTO taxonomic_units (tsn, name_usage, parent_tsn, kingdom_id, rank_id, complete_name) "
+                "VALUES (999999, 'valid', 180595, 5, 220, 'Canis latrans')")
+    con.commit()
+    con.close()
+    os.utime(f"{itis_cache}/ITIS.sqlite", ns=(0, 0))
+
+    index = itis.ItisHierarchy(cache_location=itis_cache).load()
+
+    assert index.meta["count"] == 7
+    assert index.lineage(999999)[-1]["name"] == "Canis latrans"
+    assert sorted(os.listdir(itis_cache)) == ["ITIS.sqlite", "ITIS_hierarchy"]
+
+
+def test_interrupted_build_keeps_previous_index(itis_cache, monkeypatch):
+    itis.ItisHierarchy(cache_location=itis_cache).build()
+    saved = list()
+
+    def failing_save(file, array):
+        if len(saved) == 3:
+            raise KeyboardInterrupt
+        saved.append(file)
+
+    monkeypatch.setattr(np, "save", failing_save)
+
+    with pytest.raises(KeyboardInterrupt):
+        itis.ItisHierarchy(cache_location=itis_cache).build()
+
+    monkeypatch.undo()
+    assert sorted(os.listdir(itis_cache)) == ["ITIS.sqlite", "ITIS_hierarchy"]
+    assert itis.ItisHierarchy(cache_location=itis_cache).load().meta["count"] == 6
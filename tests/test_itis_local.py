@@ -0,0 +1,62 @@
+import pytest
+
+from pysppin import itis, utils
+
+
+@pytest.fixture
+def itis_local(itis_cache):
+    return itis.ItisLocal(cache_location=itis_cache, identifier_cache=utils.IdentifierCache())
+
+
+def test_exact_match(itis_local):
+    result = itis_local.search("Scientific Name:Canis lupus")
+
+    assert result["processing_metadata"]["status"] == "success"
+    assert result["processing_metadata"]["status_message"] == "Exact Match"
+    assert result["processing_metadata"]["details"] == [{"Exact Match": "nameWOInd:Canis lupus"}]
+    doc = result["data"][0]
+    assert doc["tsn"] == "180596"
+    assert doc["hierarchy"] == ["Animalia", "Canidae", "Canis", "Canis lupus"]
+    assert doc["biological_taxonomy"][-1] == {"rank": "Species", "name": "Canis lupus"}
+    assert doc["commonnames"] == [{"name": "gray wolf", "language": "English"}]
+    assert result["summary"]["commonname"] == "gray wolf"
+
+
+def test_tsn_search(itis_local):
+    result = itis_local.search("TSN:180596")
+
+    assert result["processing_metadata"]["details"] == [{"Exact Match": "tsn:180596"}]
+    assert result["data"][0]["nameWInd"] == "Canis lupus"
+
+
+def test_fuzzy_match(itis_local):
+    result = itis_local.search("Scientific Name:Canis lupsu")
+
+    assert result["processing_metadata"]["status_message"] == "Fuzzy Match"
+    assert result["processing_metadata"]["details"] == [
+        {"Exact Match Fail": "nameWOInd:Canis lupsu"},
+        {"Fuzzy Match": "nameWOInd:Canis lupsu~0.8"}
+    ]
+    assert result["data"][0]["tsn"] == "180596"
+
+
+def test_follows_accepted_tsn(itis_local):
+    result = itis_local.search("Scientific Name:Canis familiaris")
+
+    assert result["processing_metadata"]["status_message"] == "Followed Accepted TSN"
+    assert [d["tsn"] for d in result["data"]] == ["726821", "183815"]
+    assert result["summary"]["scientificname"] == "Canis lupus familiaris"
+
+
+def test_not_matched(itis_local):
+    result = itis_local.search("Scientific Name:Felis catus")
+
+    assert result["processing_metadata"]["status"] == "failure"
+    assert result["processing_metadata"]["status_message"] == "Not Matched"
+    assert "data" not in result
+
+
+def test_valid_accepted_filter(itis_local):
+    r = itis_local.run_itis_query(itis_local.get_itis_search_url("Canis familiaris", validAccepted=True))
+
+    assert r["response"]["numFound"] == 0
@@ -0,0 +1,78 @@
+import pytest
+
+from pysppin import itis
+
+
+@pytest.fixture
+def itis_api():
+    return itis.ItisApi()
+
+
+def itis_doc(**list_properties):
+    doc = {
+        "tsn": "180596",
+        "createDate": "1996-06-13 14:51:08",
+        "updateDate": "2010-01-01",
+        "hierarchicalSort": "x",
+        "hierarchyTSN": ["$202423$180596$"],
+        "hierarchySoFar": ["180596:$Animalia$Canis lupus$"],
+        "hierarchySoFarWRanks": ["180596:$Kingdom:Animalia$Species:Canis lupus$"],
+        "vernacular": ["$gray wolf$English$N$1$2010$"]
+    }
+    doc.update(list_properties)
+    return doc
+
+
+def test_package_itis_json(itis_api):
+    packaged = itis_api.package_itis_json(itis_doc())
+
+    assert packaged == {
+        "tsn": "180596",
+        "date_created": "1996-06-13 14:51:08",
+        "date_modified": "2010-01-01",
+        "biological_taxonomy": [{"rank": "Kingdom", "name": "Animalia"}, {"rank": "Species", "name": "Canis lupus"}],
+        "hierarchy": ["Animalia", "Canis lupus"],
+        "commonnames": [{"name": "gray wolf", "language": "English"}]
+    }
+
+
+def test_list_properties(itis_api):
+    packaged = itis_api.package_itis_json(itis_doc(
+        geographicDivision=["$North America$2004$"],
+        jurisdiction=["$Continental US$Native$2010$"],
+        expert=["$EXP$5$Jane Doe$$2001$2002$"],
+        publication=["$PUB$7$Smith$1999$A Title$Journal$$1-2$"],
+        otherSource=["$SRC$3$database$NatureServe$1.0$2004$$2004$2005$"],
+        comment=["$9$Bob$a comment$2004$2005$"]
+    ))
+
+    assert packaged["geographicDivision"] == [{"geographic_value": "North America", "update_date": "2004"}]
+    assert packaged["jurisdiction"] == [{"jurisdiction_value": "Continental US", "origin": "Native",
+                                         "update_date": "2010"}]
+    assert packaged["expert"] == [{"reference_type": "EXP", "expert_id": "5", "expert_name": "Jane Doe",
+                                   "expert_comment": "", "create_date": "2001", "update_date": "2002"}]
+    # The fourth publication value is skipped and values after the title are numbered from the title
+    assert packaged["publication"] == [{"reference_type": "PUB", "reference_id": "7", "author": "Smith",
+                                        "title": "A Title", "other_variable_0": "Journal",
+                                        "other_variable_2": "1-2"}]
+    assert packaged["otherSource"] == [{"reference_type": "SRC", "source_id": "3", "source_type": "database",
+                                        "source_name": "NatureServe", "version": "1.0",
+                                        "acquisition_date": "2004", "source_comment": "", "create_date": "2004",
+                                        "update_date": "2005"}]
+    assert packaged["comment"] == [{"comment_id": "9", "commentator": "Bob", "comment_text": "a comment",
+                                    "create_date": "2004", "update_date": "2005"}]
+
+
+@pytest.mark.parametrize("list_property, value", [
+    ("publication", "$PUB$7$Smith$1999"),
+    ("otherSource", "$SRC$3$database$"),
+    ("comment", "$9$Bob$a comment$2004"),
+])
+def test_short_values_kept_as_raw_text(itis_api, list_property, value):
+    parsed = itis_api.parse_itis_list_value(list_property, itis_api.itis_list_fields[list_property], value)
+
+    assert parsed == {"raw_text": value}
+
+
+def test_package_itis_docs(itis_api):
+    assert itis_api.package_itis_docs([itis_doc(), itis_doc(tsn="1")])[1]["tsn"] == "1"
@@ -0,0 +1,163 @@
+import random
+import re
+
+import pandas as pd
+import pytest
+from ftfy import fix_text
+
+from pysppin import utils
+
+
+def baseline_clean_scientific_name(scientificname):
+    '''
+    Utils.clean_scientific_name as it was before the patterns were precompiled, kept as the reference the compiled
+    cleaner must match.
+    '''
+    if isinstance(scientificname, float):
+        return None
+
+    nameString = str(scientificname)
+    nameString = fix_text(nameString)
+    nameString = re.sub(r'\d+', '', nameString)
+    nameString = re.sub(r'[\(\[\"].*?[\)\]\"]', "", nameString)
+    nameString = ' '.join(nameString.split())
+
+    removeList = ["?", "Family "]
+    nameString = re.sub(r'|'.join(map(re.escape, removeList)), '', nameString)
+    nameString = nameString.replace("subsp.", "ssp.")
+
+    afterChars = ["(", " AND ", "/", " & ", " vs ", " undescribed ", ",", " formerly ", " near ", "Columbia Basin",
+                  "Puget Trough", " n.sp. ", " n. ", " sp. ", " sp ", " pop. ", " spp. ", " cf. ", " ] "]
+    nameString = nameString + " "
+    while any(substring in nameString for substring in afterChars):
+        for substring in afterChars:
+            nameString = nameString.split(substring, 1)[0]
+            nameString = nameString + " "
+
+    nameString = nameString.strip()
+
+    if nameString.find("_") != -1:
+        nameString = ' '.join(nameString.split("_"))
+
+    if len(nameString) > 0:
+        namesList = nameString.split(" ")
+        if namesList[-1] in ["ssp.", "var."]:
+            nameString = ' '.join(namesList[:-1])
+
+    nameString = nameString.replace(" x ", " X ")
+
+    return nameString.capitalize()
+
+
+known_names = [
+    "Canis lupus",
+    "canis lupus baileyi",
+    "Canis lupus (gray wolf)",
+    "Ursus arctos horribilis [grizzly]",
+    "Rana \"sp. 1\" pipiens",
+    "Family Canidae",
+    "Bufo? boreas",
+    "Castilleja levisecta subsp. levisecta",
+    "Castilleja ssp.",
+    "Quercus alba var.",
+    "Quercus x bebbiana",
+    "Oncorhynchus mykiss pop. 12",
+    "Oncorhynchus mykiss Columbia Basin",
+    "Sorex sp. near vagrans",
+    "Sorex sp",
+    "Myotis lucifugus/yumanensis",
+    "Myotis lucifugus & M. yumanensis",
+    "Lasiurus cinereus formerly L. borealis",
+    "Plethodon_vehiculum",
+    "Ambystoma cf. gracile",
+    "Anaxyrus n. sp.",
+    "  Picoides   albolarvatus  ",
+    "Ã©lan vital",
+    "Lepus &amp; Sylvilagus",
+    "Gila orcuttii vs Gila bicolor",
+    "Spea undescribed species",
+    "Sorex sp sp sp",
+    "",
+    12345,
+    float("nan"),
+]
+
+fuzz_tokens = ["Canis", "lupus", "sp", "sp.", "(", ")", "[", "]", "\"", "?", "Family", "ssp.", "subsp.", "var.",
+               "x", "_", "/", "&", "vs", ",", "n.", "cf.", "pop.", "spp.", "AND", "near", "1", "2b", "Ã©", "é",
+               "Columbia", "Basin", "Puget", "Trough", "&amp;", "n.sp."]
+
+
+def fuzz_names(count, seed=11):
+    rng = random.Random(seed)
+    for i in range(count):
+        tokens = [rng.choice(fuzz_tokens) for t in range(rng.randint(1, 7))]
+        yield "".join(t + rng.choice([" ", " ", "  ", ""]) for t in tokens)
+
+
+@pytest.mark.parametrize("name", known_names)
+def test_compiled_matches_baseline(name):
+    assert utils.compiled_clean_scientific_name(name) == baseline_clean_scientific_name(name)
+
+
+def test_compiled_matches_baseline_fuzzed():
+    for name in fuzz_names(5000):
+        assert utils.compiled_clean_scientific_name(name) == baseline_clean_scientific_name(name), name
+
+
+def test_clean_scientific_names_matches_single():
+    names = known_names + list(fuzz_names(200)) + known_names
+    u = utils.Utils()
+
+    expected = [baseline_clean_scientific_name(n) for n in names]
+
+    assert utils.Utils().clean_scientific_names(names) == expected
+    assert u.clean_scientific_names(names, processes=2, chunksize=50) == expected
+    assert [u.clean_scientific_name(n) for n in names] == expected
+
+
+def test_clean_scientific_names_series():
+    names = pd.Series(["Canis lupus (wolf)", float("nan"), "Canis lupus (wolf)"], index=[10, 20, 30])
+
+    cleaned = utils.Utils().clean_scientific_names(names)
+
+    assert list(cleaned.index) == [10, 20, 30]
+    assert cleaned[10] == "Canis lupus"
+    assert cleaned[20] is None
+
+
+def test_name_cache_lru():
+    cache = utils.NameCache(maxsize=2)
+    cache.put("a", "A")
+    cache.put("b", "B")
+    cache.get("a")
+    cache.put("c", "C")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "A"
+    assert cache.stats() == {"hits": 2, "misses": 1, "evictions": 1, "size": 2, "maxsize": 2, "hit_rate": 2 / 3}
+
+
+def test_name_cache_save_and_load(tmp_path):
+    cache_file = str(tmp_path / "names.json")
+    u = utils.Utils(name_cache_file=cache_file)
+    u.clean_scientific_name("Canis lupus (wolf)")
+    u.name_cache.save()
+
+    loaded = utils.Utils(name_cache_file=cache_file)
+
+    assert loaded.name_cache.get("Canis lupus (wolf)") == "Canis lupus"
+
+
+def test_bulk_stats_count_every_input():
+    names = ["Canis lupus", "Canis lupus", "Felis catus", 7, float("nan"), "Canis lupus"]
+    single = utils.Utils()
+    bulk = utils.Utils()
+    single.clean_scientific_name("Felis catus")
+    bulk.clean_scientific_name("Felis catus")
+
+    for n in names:
+        single.clean_scientific_name(n)
+    bulk.clean_scientific_names(names)
+
+    assert bulk.name_cache.stats() == single.name_cache.stats()
+    assert bulk.name_cache.stats()["hits"] == 3
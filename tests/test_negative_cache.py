@@ -0,0 +1,78 @@
+import datetime
+
+import pytest
+
+from pysppin import itis, utils
+
+
+@pytest.fixture
+def negative_cache(tmp_path):
+    return utils.NegativeCache(cache_location=str(tmp_path), ttls={"itis": 7, "gbif": None})
+
+
+def miss(sppin_key, days_ago=0):
+    date_processed = (datetime.datetime.utcnow() - datetime.timedelta(days=days_ago)).isoformat()
+    return {
+        "sppin_key": sppin_key,
+        "date_processed": date_processed,
+        "processing_metadata": {"status": "failure", "status_message": "Not Matched", "from_cache": False}
+    }
+
+
+def test_get_and_put(negative_cache):
+    assert negative_cache.get("itis", "Scientific Name:Felis catus") is None
+
+    negative_cache.put("itis", miss("Scientific Name:Felis catus"))
+    cached = negative_cache.get("itis", "Scientific Name:Felis catus")
+
+    assert cached["processing_metadata"]["status_message"] == "Not Matched"
+    assert cached["processing_metadata"]["from_cache"] is True
+    assert negative_cache.get("worms", "Scientific Name:Felis catus") is None
+
+
+def test_expired_and_untracked_sources(negative_cache):
+    negative_cache.put("itis", miss("Scientific Name:Old name", days_ago=8))
+    negative_cache.put("gbif", miss("Scientific Name:Felis catus"))
+
+    assert negative_cache.get("itis", "Scientific Name:Old name") is None
+    assert negative_cache.get("gbif", "Scientific Name:Felis catus") is None
+    assert negative_cache.purge() == 1
+
+
+def test_put_replaces_and_remove(negative_cache):
+    negative_cache.put("itis", miss("Scientific Name:Felis catus", days_ago=8))
+    negative_cache.put("itis", miss("Scientific Name:Felis catus"))
+
+    assert negative_cache.get("itis", "Scientific Name:Felis catus") is not None
+
+    negative_cache.remove("itis", "Scientific Name:Felis catus")
+
+    assert negative_cache.get("itis", "Scientific Name:Felis catus") is None
+
+
+def test_itis_search_uses_negative_cache(itis_cache, negative_cache):
+    itis_local = itis.ItisLocal(cache_location=itis_cache, negative_cache=negative_cache,
+                                identifier_cache=utils.IdentifierCache())
+    queries = list()
+    run_itis_query = itis_local.run_itis_query
+    itis_local.run_itis_query = lambda query: queries.append(query) or run_itis_query(query)
+
+    first = itis_local.search("Scientific Name:Felis catus")
+    second = itis_local.search("Scientific Name:Felis catus")
+    batch = itis_local.search_batch(["Scientific Name:Felis catus", "Scientific Name:Canis lupus"])
+
+    assert first["processing_metadata"]["from_cache"] is False
+    assert second["processing_metadata"]["from_cache"] is True
+    assert batch[0]["processing_metadata"]["from_cache"] is True
+    assert batch[1]["processing_metadata"]["status"] == "success"
+    assert queries == ["nameWOInd:Felis catus", "nameWOInd:Felis catus~0.8", "nameWOInd:Canis lupus"]
+
+
+def test_itis_local_misses_kept_apart(itis_cache, negative_cache):
+    itis_local = itis.ItisLocal(cache_location=itis_cache, negative_cache=negative_cache,
+                                identifier_cache=utils.IdentifierCache())
+
+    itis_local.search("Scientific Name:Felis catus")
+
+    assert negative_cache.get("itis_local", "Scientific Name:Felis catus") is not None
+    assert negative_cache.get("itis", "Scientific Name:Felis catus") is None
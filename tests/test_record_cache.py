@@ -0,0 +1,69 @@
+import datetime
+
+import pandas as pd
+import pytest
+
+from pysppin import utils
+
+
+def record(search_key, days_ago=0, status="success"):
+    date_processed = (datetime.datetime.utcnow() - datetime.timedelta(days=days_ago)).isoformat()
+    return {
+        "processing_metadata": {"search_key": search_key, "date_processed": date_processed, "status": status},
+        "data": {"name": search_key.split(":")[1]}
+    }
+
+
+def test_missing_cache_raises(tmp_path):
+    u = utils.Utils()
+
+    with pytest.raises(ValueError):
+        u.key_in_cache("missing", str(tmp_path), "Scientific Name:Canis lupus")
+    with pytest.raises(ValueError):
+        u.append_to_cache("missing", str(tmp_path), record("Scientific Name:Canis lupus"))
+    with pytest.raises(ValueError):
+        u.filter_mq_list([], "missing", cache_location=str(tmp_path))
+    with pytest.raises(ValueError):
+        u.get_cache("missing", str(tmp_path))
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_append_and_lookup(tmp_path):
+    u = utils.Utils()
+
+    u.append_to_cache("spp", str(tmp_path), record("Scientific Name:Canis lupus"), create=True)
+    u.append_to_cache("spp", str(tmp_path), record("Scientific Name:Canis lupus", days_ago=40))
+
+    assert u.key_in_cache("spp", str(tmp_path), "Scientific Name:Felis catus") is False
+    found, records = u.key_in_cache("spp", str(tmp_path), "Scientific Name:Canis lupus", return_record=True)
+    assert found is True
+    assert len(records) == 2
+    assert records[0]["data.name"] == "Canis lupus"
+
+    df = u.get_cache("spp", str(tmp_path))
+    assert len(df) == 2
+    assert "processing_metadata.search_key" in df.columns
+
+
+def test_filter_mq_list(tmp_path):
+    u = utils.Utils()
+    u.append_to_cache("spp", str(tmp_path), record("Scientific Name:Canis lupus"), create=True)
+    u.append_to_cache("spp", str(tmp_path), record("Scientific Name:Felis catus", days_ago=40))
+    mq_list = [{"search_key": k} for k in
+               ["Scientific Name:Canis lupus", "Scientific Name:Felis catus", "Scientific Name:Ursus arctos"]]
+
+    processable = u.filter_mq_list(mq_list, "spp", cache_location=str(tmp_path))
+    flagged = u.filter_mq_list(mq_list, "spp", operation="flagged", cache_location=str(tmp_path))
+
+    assert [i["search_key"] for i in processable] == ["Scientific Name:Felis catus", "Scientific Name:Ursus arctos"]
+    assert [i["search_key"] for i in flagged] == ["Scientific Name:Canis lupus", "Scientific Name:Felis catus"]
+
+
+def test_imports_legacy_pickle(tmp_path):
+    pd.json_normalize([record("Scientific Name:Canis lupus")]).to_pickle(str(tmp_path / "legacy"))
+
+    u = utils.Utils()
+
+    assert u.key_in_cache("legacy", str(tmp_path), "Scientific Name:Canis lupus") is True
+    assert (tmp_path / "legacy.sqlite").exists()
@@ -0,0 +1,79 @@
+import copy
+import random
+
+from pysppin import utils
+
+mappings = {"scientificName": "scientificname", "vernacularName": "commonname", "rank": "taxonomicrank",
+            "tsn": "itis_tsn"}
+keys = list(mappings.keys()) + list(mappings.values()) + ["data", "name", "other"]
+
+
+def baseline_alter_keys(item, mappings, layer=None, key=None):
+    '''
+    The recursive Utils.alter_keys that remap_keys replaced. The original iterated item.items() while renaming keys,
+    which raises "dictionary keys changed during iteration" on Python 3.8+, so this reference iterates over a snapshot
+    of the items; otherwise it is unchanged.
+    '''
+    if layer is None:
+        layer = item
+    if isinstance(item, dict):
+        for k, v in list(item.items()):
+            baseline_alter_keys(v, mappings, item, k)
+    if isinstance(key, str):
+        for orig, new in mappings.items():
+            if orig in layer.keys():
+                layer[new] = layer.pop(orig)
+    return layer
+
+
+def random_record(rng, depth=0):
+    record = dict()
+    for i in range(rng.randint(0, 5)):
+        choice = rng.random()
+        if choice < 0.25 and depth < 4:
+            value = random_record(rng, depth + 1)
+        elif choice < 0.35:
+            value = [rng.randint(0, 9) for n in range(3)]
+        else:
+            value = rng.choice(["Canis lupus", 180596, None, 1.5])
+        record[rng.choice(keys)] = value
+    return record
+
+
+def test_remap_keys_matches_baseline():
+    rng = random.Random(14)
+    u = utils.Utils()
+
+    for i in range(3000):
+        record = random_record(rng)
+        expected = baseline_alter_keys(copy.deepcopy(record), mappings)
+
+        assert u.remap_keys(record, mappings) == expected, record
+        assert u.remap_keys(copy.deepcopy(record), mappings, inplace=True) == expected, record
+        assert u.alter_keys(copy.deepcopy(record), mappings) == expected, record
+
+
+def test_remap_keys_copy_leaves_input():
+    record = {"rank": "Species", "data": {"tsn": 180596}}
+
+    remapped = utils.Utils().remap_keys(record, mappings)
+
+    assert record == {"rank": "Species", "data": {"tsn": 180596}}
+    assert remapped == {"taxonomicrank": "Species", "data": {"itis_tsn": 180596}}
+
+
+def test_remap_keys_keeps_position_and_alias_wins():
+    remapped = utils.Utils().remap_keys({"a": 1, "rank": "Species", "taxonomicrank": "old", "z": 2}, mappings)
+
+    assert list(remapped.items()) == [("a", 1), ("taxonomicrank", "Species"), ("z", 2)]
+
+
+def test_remap_keys_inside_lists():
+    records = [{"data": [{"tsn": 1}, {"tsn": 2, "other": [[{"rank": "Genus"}]]}]}, {"vernacularName": "wolf"}]
+
+    remapped = utils.Utils().remap_keys_batch(records, mappings)
+
+    assert remapped == [
+        {"data": [{"itis_tsn": 1}, {"itis_tsn": 2, "other": [[{"taxonomicrank": "Genus"}]]}]},
+        {"commonname": "wolf"}
+    ]
@@ -0,0 +1,98 @@
+import pytest
+
+from pysppin import aio, runner, utils
+
+common_utils = utils.Utils()
+
+
+def fake_search(t, key, name_source, nc=None):
+    result = common_utils.processing_metadata(default_status="error" if "broken" in key else "success")
+    result["sppin_key"] = key
+    return result
+
+
+@pytest.fixture
+def fake_runner(tmp_path, monkeypatch):
+    monkeypatch.setitem(aio.source_searches, "fake", fake_search)
+    return runner.Runner(cache_location=str(tmp_path), max_workers=2, use_negative_cache=False)
+
+
+mq_list = [{"search_key": f"Scientific Name:Name {i}"} for i in range(5)] + \
+          [{"search_key": "Scientific Name:broken name"}]
+
+
+def test_run_and_resume(fake_runner):
+    report = fake_runner.run(mq_list, "fake")
+
+    assert report["submitted"] == 6
+    assert report["completed"] == 6
+    assert report["errors"] == 1
+
+    # The error row is not finished, so resuming searches that name again
+    assert fake_runner.finished_keys("fake") == {i["search_key"] for i in mq_list[:5]}
+    report = fake_runner.run(mq_list, "fake")
+
+    assert report["skipped"] == 5
+    assert report["submitted"] == 1
+
+
+def shaped_search(t, key, name_source, nc=None):
+    result = fake_search(t, key, name_source, nc)
+    if "miss" in key:
+        result["processing_metadata"]["status_message"] = "Not Matched"
+    else:
+        result["data"] = [{"name": key}]
+        result["summary"] = {"name": key}
+    return result
+
+
+def test_results_with_different_shapes(tmp_path, monkeypatch):
+    monkeypatch.setitem(aio.source_searches, "shaped", shaped_search)
+    shaped_runner = runner.Runner(cache_location=str(tmp_path), max_workers=1, use_negative_cache=False)
+    shaped_list = [{"search_key": "Scientific Name:miss one"}, {"search_key": "Scientific Name:Name 1"},
+                   {"search_key": "Scientific Name:miss two"}, {"search_key": "Scientific Name:Name 2"}]
+
+    report = shaped_runner.run(shaped_list, "shaped")
+
+    assert report["completed"] == 4
+    assert report["errors"] == 0
+    record = shaped_runner.sql.sppin_key_current_record("shaped", "Scientific Name:Name 2", currency_threshold=None)
+    assert record["summary"] == {"name": "Scientific Name:Name 2"}
+
+
+def test_write_errors_are_counted(fake_runner, monkeypatch):
+    upsert_record = fake_runner.sql.upsert_record
+
+    def failing_upsert(db_name, table_name, record):
+        if record["sppin_key"] == "Scientific Name:Name 2":
+            raise RuntimeError("disk I/O error")
+        return upsert_record(db_name, table_name, record)
+
+    monkeypatch.setattr(fake_runner.sql, "upsert_record", failing_upsert)
+    report = fake_runner.run(mq_list, "fake")
+
+    assert report["completed"] == 5
+    assert report["errors"] == 2
+    assert "Scientific Name:Name 2" not in fake_runner.finished_keys("fake")
+
+
+def test_finished_keys_missing_table(fake_runner):
+    assert fake_runner.finished_keys("nothing") == set()
+
+
+def test_progress_callback(fake_runner, capsys):
+    reports = list()
+
+    fake_runner.run(mq_list, "fake", report_every=2, progress=lambda *args: reports.append(args))
+
+    assert [r[1:3] for r in reports] == [(2, 6), (4, 6), (6, 6)]
+    assert capsys.readouterr().out == ""
+
+
+def test_token_bucket_rate():
+    bucket = runner.TokenBucket(rate=1000, capacity=1)
+
+    for i in range(5):
+        bucket.acquire()
+
+    assert bucket.tokens < 1
@@ -0,0 +1,150 @@
+import datetime
+import threading
+
+import pytest
+
+from pysppin import utils
+
+common_utils = utils.Utils()
+
+
+class CountingSearch:
+    def __init__(self, status="success", days_ago=0, sets_sppin_key=True, matched=True):
+        self.status = status
+        self.matched = matched
+        self.sets_sppin_key = sets_sppin_key
+        self.days_ago = days_ago
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, sppin_key):
+        with self.lock:
+            self.calls += 1
+            calls = self.calls
+        result = common_utils.processing_metadata(default_status=self.status)
+        result["processing_metadata"]["date_processed"] = \
+            (datetime.datetime.utcnow() - datetime.timedelta(days=self.days_ago)).isoformat()
+        if self.sets_sppin_key:
+            result["sppin_key"] = sppin_key
+        if self.matched:
+            result["data"] = {"call": calls}
+            result["summary"] = None
+        else:
+            # Like an ITIS or WoRMS miss, which has no data or summary
+            result["processing_metadata"]["status_message"] = "Not Matched"
+        return result
+
+
+@pytest.fixture
+def source_cache(tmp_path):
+    source_cache = utils.SourceCache(cache_location=str(tmp_path), ttls={"itis": 30})
+    yield source_cache
+    source_cache.close()
+
+
+def test_cache_hit(source_cache):
+    search = CountingSearch()
+
+    first = source_cache.search("itis", "Scientific Name:Canis lupus", search, "Scientific Name:Canis lupus")
+    second = source_cache.search("itis", "Scientific Name:Canis lupus", search, "Scientific Name:Canis lupus")
+
+    assert search.calls == 1
+    assert first["processing_metadata"]["from_cache"] is False
+    assert second["processing_metadata"]["from_cache"] is True
+    assert second["data"] == {"call": 1}
+    assert "id" not in second
+    assert "summary" in second and second["summary"] is None
+
+
+def test_refresh_and_errors(source_cache):
+    search = CountingSearch(status="error")
+
+    source_cache.search("itis", "Scientific Name:Canis lupus", search, "Scientific Name:Canis lupus")
+    source_cache.search("itis", "Scientific Name:Canis lupus", search, "Scientific Name:Canis lupus")
+    assert search.calls == 2
+
+    search.status = "success"
+    source_cache.search("itis", "Scientific Name:Canis lupus", search, "Scientific Name:Canis lupus")
+    result = source_cache.search("itis", "Scientific Name:Canis lupus", search, "Scientific Name:Canis lupus",
+                                 refresh=True)
+    assert search.calls == 4
+    assert result["data"] == {"call": 4}
+
+
+def test_expired_result_searched_again(source_cache):
+    search = CountingSearch(days_ago=40)
+
+    source_cache.search("itis", "Scientific Name:Canis lupus", search, "Scientific Name:Canis lupus")
+    result = source_cache.search("itis", "Scientific Name:Canis lupus", search, "Scientific Name:Canis lupus")
+
+    assert search.calls == 2
+    assert result["processing_metadata"]["from_cache"] is False
+
+
+def test_stale_while_revalidate(source_cache):
+    search = CountingSearch(days_ago=40)
+    cached_search = source_cache.cached("itis", stale_while_revalidate=True)(search)
+    cached_search("Scientific Name:Canis lupus")
+    search.days_ago = 0
+
+    stale = cached_search("Scientific Name:Canis lupus")
+    source_cache.close()
+    fresh = cached_search("Scientific Name:Canis lupus")
+
+    assert stale["processing_metadata"]["stale"] is True
+    assert stale["data"] == {"call": 1}
+    assert fresh["data"] == {"call": 2}
+    assert fresh["processing_metadata"]["from_cache"] is True
+    assert "stale" not in fresh["processing_metadata"]
+    assert search.calls == 2
+
+
+def test_hit_cached_after_miss(source_cache):
+    miss = CountingSearch(status="failure", matched=False)
+    source_cache.search("itis", "Scientific Name:Canis lupsu", miss, "Scientific Name:Canis lupsu")
+
+    result = source_cache.search("itis", "Scientific Name:Canis lupus", CountingSearch(), "Scientific Name:Canis lupus")
+    cached = source_cache.cached_record("itis", "Scientific Name:Canis lupus")
+
+    assert result["data"] == {"call": 1}
+    assert cached["data"] == {"call": 1}
+    assert source_cache.cached_record("itis", "Scientific Name:Canis lupsu")["data"] is None
+
+
+def test_stale_miss_revalidated_to_hit(source_cache):
+    search = CountingSearch(status="failure", days_ago=40, matched=False)
+    cached_search = source_cache.cached("itis", stale_while_revalidate=True)(search)
+    cached_search("Scientific Name:Canis lupus")
+    search.status, search.days_ago, search.matched = "success", 0, True
+
+    stale = cached_search("Scientific Name:Canis lupus")
+    source_cache.close()
+    fresh = cached_search("Scientific Name:Canis lupus")
+
+    assert stale["processing_metadata"]["stale"] is True
+    assert fresh["data"] == {"call": 2}
+    assert fresh["processing_metadata"]["from_cache"] is True
+
+
+def test_key_builder(source_cache):
+    # Like sgcn, which takes a bare name and does not return a sppin_key
+    search = CountingSearch(sets_sppin_key=False)
+    cached_search = source_cache.cached("sgcn", key_builder=lambda name: f"Scientific Name:{name}")(search)
+
+    cached_search("Canis lupus")
+    cached_search("Canis lupus")
+
+    assert search.calls == 1
+    assert source_cache.cached_record("sgcn", "Scientific Name:Canis lupus") is not None
+
+
+def test_filter_mq_list(source_cache):
+    source_cache.search("itis", "Scientific Name:Canis lupus", CountingSearch(), "Scientific Name:Canis lupus")
+    source_cache.search("itis", "Scientific Name:Old", CountingSearch(days_ago=40), "Scientific Name:Old")
+    mq_list = [{"search_key": k} for k in ["Scientific Name:Canis lupus", "Scientific Name:Old", "Scientific Name:New"]]
+
+    processable = source_cache.filter_mq_list(mq_list, "itis")
+    flagged = source_cache.filter_mq_list(mq_list, "itis", operation="flagged")
+
+    assert [i["search_key"] for i in processable] == ["Scientific Name:Old", "Scientific Name:New"]
+    assert [i["in_cache"] for i in flagged] == [True, True, False]
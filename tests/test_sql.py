@@ -0,0 +1,120 @@
+import threading
+
+import pytest
+
+from pysppin import utils
+
+
+@pytest.fixture
+def sql(tmp_path):
+    sql = utils.Sql(cache_location=str(tmp_path))
+    yield sql
+    sql.close()
+
+
+def test_wal_connection_reused(sql):
+    db = sql.get_db("sppin")
+
+    assert sql.get_db("sppin") is db
+    assert db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
+def test_connection_per_thread(sql):
+    dbs = list()
+    thread = threading.Thread(target=lambda: dbs.append(sql.get_db("sppin")))
+    thread.start()
+    thread.join()
+
+    assert dbs[0] is not sql.get_db("sppin")
+
+
+def test_transaction_commits_once(sql):
+    with sql.transaction("sppin"):
+        for i in range(3):
+            sql.insert_record("sppin", "things", {"n": i})
+        assert sql.get_db("sppin").conn.in_transaction
+
+    assert not sql.get_db("sppin").conn.in_transaction
+    assert sql.get_db("sppin")["things"].count == 3
+
+
+def test_transaction_rolls_back(sql):
+    sql.insert_record("sppin", "things", {"n": 0})
+
+    with pytest.raises(RuntimeError):
+        with sql.transaction("sppin"):
+            sql.insert_record("sppin", "things", {"n": 1})
+            with sql.transaction("sppin"):
+                sql.insert_record("sppin", "things", {"n": 2})
+            raise RuntimeError("abort")
+
+    assert [r["n"] for r in sql.get_all_records("sppin", "things")] == [0]
+
+
+def result(sppin_key, date_processed, status="success"):
+    return {
+        "sppin_key": sppin_key,
+        "date_processed": date_processed,
+        "processing_metadata": {"status": status, "date_processed": date_processed}
+    }
+
+
+def test_upsert_replaces_record(sql):
+    sql.upsert_record("sppin", "itis", result("Scientific Name:Canis lupus", "2020-01-01"))
+    sql.upsert_record("sppin", "itis", result("Scientific Name:Canis lupus", "2021-01-01"))
+    sql.upsert_record("sppin", "itis", result("Scientific Name:Felis catus", "2021-01-01"))
+
+    records = sql.get_select_records("sppin", "itis", "sppin_key = ?", "Scientific Name:Canis lupus")
+
+    assert len(records) == 1
+    assert records[0]["date_processed"] == "2021-01-01"
+    assert sql.get_db("sppin")["itis"].count == 2
+
+
+def test_upsert_adds_columns(sql):
+    miss = result("Scientific Name:Canis lupus", "2020-01-01", status="failure")
+    hit = dict(result("Scientific Name:Canis lupus", "2021-01-01"), data=[{"tsn": "180596"}], summary={"tsn": 180596})
+    sql.upsert_record("sppin", "itis", miss)
+    sql.upsert_record("sppin", "itis", hit)
+
+    record = sql.sppin_key_current_record("itis", "Scientific Name:Canis lupus", currency_threshold=None)
+
+    assert record["data"] == [{"tsn": "180596"}]
+    assert record["summary"] == {"tsn": 180596}
+
+
+def test_inserts_add_columns(sql):
+    sql.insert_record("sppin", "itis", result("Scientific Name:Canis lupus", "2020-01-01"))
+    sql.insert_record("sppin", "itis", dict(result("Scientific Name:Felis catus", "2020-01-01"), data=[1]))
+    sql.bulk_insert("sppin", "itis", [
+        result("Scientific Name:Ursus arctos", "2020-01-01"),
+        dict(result("Scientific Name:Ursus maritimus", "2020-01-01"), summary={"tsn": 180542})
+    ])
+
+    assert {"data", "summary"} <= set(sql.get_db("sppin")["itis"].columns_dict)
+    assert sql.get_db("sppin")["itis"].count == 4
+
+
+def test_upsert_requires_sppin_key(sql):
+    with pytest.raises(ValueError):
+        sql.upsert_record("sppin", "itis", {"date_processed": "2021-01-01"})
+
+
+def test_sppin_key_index(sql):
+    sql.insert_record("sppin", "itis", result("Scientific Name:Canis lupus", "2020-01-01"))
+
+    indexes = [i.columns for i in sql.get_db("sppin")["itis"].indexes]
+
+    assert ["sppin_key", "date_processed"] in indexes
+
+
+def test_current_record_drops_duplicates(sql):
+    sql.insert_record("sppin", "itis", result("Scientific Name:Canis lupus", "2020-01-01"))
+    sql.insert_record("sppin", "itis", result("Scientific Name:Canis lupus", "2021-01-01"))
+
+    record = sql.sppin_key_current_record("itis", "Scientific Name:Canis lupus", currency_threshold=None)
+
+    assert record["date_processed"] == "2021-01-01"
+    assert record["processing_metadata"]["status"] == "success"
+    assert sql.get_db("sppin")["itis"].count == 1
+    assert sql.sppin_key_current_record("itis", "Scientific Name:Canis lupus") is None
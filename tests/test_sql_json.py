@@ -0,0 +1,125 @@
+import json
+
+import pytest
+
+from pysppin import utils
+
+
+@pytest.fixture
+def sql(tmp_path):
+    sql = utils.Sql(cache_location=str(tmp_path))
+    yield sql
+    sql.close()
+
+
+def marker_rows(sql, table_name):
+    return sql.get_db("sppin").execute(
+        "SELECT column_name FROM _sppin_json_columns WHERE table_name = ? ORDER BY column_name", [table_name]
+    ).fetchall()
+
+
+def test_only_json_columns_decoded(sql):
+    sql.insert_record("sppin", "itis", {"sppin_key": "k", "data": [{"tsn": 1}], "note": "[not json]"})
+
+    record = sql.get_single_record("sppin", "itis")
+
+    assert sql.json_columns("sppin", "itis") == {"data"}
+    assert record["data"] == [{"tsn": 1}]
+    assert record["note"] == "[not json]"
+
+
+def test_single_marker_row(sql):
+    for i in range(3):
+        sql.insert_record("sppin", "plain", {"sppin_key": f"k{i}"})
+        utils.Sql(cache_location=sql.cache_location).insert_record("sppin", "plain", {"sppin_key": f"j{i}"})
+
+    assert marker_rows(sql, "plain") == [("",)]
+    assert sql.json_columns("sppin", "plain") == set()
+
+
+def test_new_table_registered_in_transaction(sql):
+    with sql.transaction("sppin"):
+        sql.bulk_insert("sppin", "gbif", [{"sppin_key": "a", "data": {"x": 1}}, {"sppin_key": "b", "data": {}}])
+
+    # A fresh Sql object, like another worker, sees the registration made with the first write
+    other = utils.Sql(cache_location=sql.cache_location)
+    other.insert_record("sppin", "gbif", {"sppin_key": "c", "data": {"x": 2}})
+
+    assert other.json_columns("sppin", "gbif") == {"data"}
+    assert marker_rows(sql, "gbif") == [("",), ("data",)]
+
+
+def test_rollback_forgets_registration(sql):
+    with pytest.raises(RuntimeError):
+        with sql.transaction("sppin"):
+            sql.insert_record("sppin", "worms", {"sppin_key": "a", "data": {"x": 1}})
+            raise RuntimeError("abort")
+
+    sql.insert_record("sppin", "worms", {"sppin_key": "b", "data": {"x": 2}})
+
+    assert marker_rows(sql, "worms") == [("",), ("data",)]
+
+
+def test_legacy_table_decodes_json_text(sql):
+    db = sql.get_db("sppin")
+    db["legacy"].insert({"sppin_key": "a", "data": json.dumps({"x": 1}), "note": "plain"}, hash_id="id")
+
+    sql.insert_record("sppin", "legacy", {"sppin_key": "b", "data": {"x": 2}, "note": "plain"})
+
+    assert sql.json_columns("sppin", "legacy") is None
+    assert [r["data"] for r in sql.get_all_records("sppin", "legacy")] == [{"x": 1}, {"x": 2}]
+
+
+def test_lazy_records(sql):
+    sql.insert_record("sppin", "itis", {"sppin_key": "k", "data": [{"tsn": 1}]})
+
+    record = sql.get_single_record("sppin", "itis", lazy=True)
+
+    assert isinstance(record, utils.LazyJsonRecord)
+    assert record._decoded == dict()
+    assert record["sppin_key"] == "k"
+    assert "data" not in record._decoded
+    assert record["data"] == [{"tsn": 1}]
+    assert dict(record)["data"] == [{"tsn": 1}]
+
+
+@pytest.fixture
+def filled(sql):
+    sql.bulk_insert("sppin", "things", [{"sppin_key": f"k{i}", "n": i if i < 3 else None} for i in range(5)])
+    return sql
+
+
+def test_iter_records(filled):
+    records = filled.iter_records("sppin", "things", fetch_size=2)
+
+    assert not isinstance(records, list)
+    assert [r["sppin_key"] for r in records] == ["k0", "k1", "k2", "k3", "k4"]
+    assert [r["n"] for r in filled.iter_select_records("sppin", "things", "n > ?", 0)] == [1, 2]
+    assert list(filled.iter_records("sppin", "missing")) == []
+
+
+def test_iter_records_pandas(filled):
+    frames = list(filled.iter_records("sppin", "things", fetch_size=2, output="pandas"))
+
+    assert [len(f) for f in frames] == [2, 2, 1]
+    assert list(frames[0].columns) == ["id", "sppin_key", "n"]
+
+
+def test_iter_records_arrow_one_schema(filled):
+    pyarrow = pytest.importorskip("pyarrow")
+
+    batches = list(filled.iter_records("sppin", "things", fetch_size=3, output="arrow"))
+
+    assert [b.num_rows for b in batches] == [3, 2]
+    assert batches[1].schema == batches[0].schema
+    assert batches[1].schema.field("n").type == pyarrow.int64()
+    assert pyarrow.Table.from_batches(batches).column("n").to_pylist() == [0, 1, 2, None, None]
+
+
+def test_iter_records_arrow_schema(filled):
+    pyarrow = pytest.importorskip("pyarrow")
+    schema = pyarrow.schema([("id", pyarrow.string()), ("sppin_key", pyarrow.string()), ("n", pyarrow.float64())])
+
+    batches = list(filled.iter_records("sppin", "things", fetch_size=3, output="arrow", schema=schema))
+
+    assert all(b.schema == schema for b in batches)
@@ -0,0 +1,47 @@
+import requests
+
+from pysppin import utils
+
+
+def test_one_session_per_host():
+    transport = utils.Transport()
+
+    a = transport.session("https://services.itis.gov/?wt=json&q=tsn:1")
+    b = transport.session("https://services.itis.gov/other")
+    c = transport.session("https://www.marinespecies.org/rest/AphiaRecordsByName/x")
+
+    assert a is b
+    assert a is not c
+    assert len(transport.sessions) == 2
+
+
+def test_retry_configuration():
+    transport = utils.Transport(pool_size=4, retries=5, backoff_factor=1, retry_status=(503,))
+
+    adapter = transport.session("https://example.org/").get_adapter("https://example.org/")
+
+    assert adapter._pool_maxsize == 4
+    assert adapter.max_retries.total == 5
+    assert adapter.max_retries.backoff_factor == 1
+    assert adapter.max_retries.status_forcelist == (503,)
+    assert adapter.max_retries.raise_on_status is False
+
+
+def test_default_timeout(monkeypatch):
+    sent = list()
+    monkeypatch.setattr(requests.Session, "get", lambda self, url, **kwargs: sent.append(kwargs))
+    transport = utils.Transport(timeout=7)
+
+    transport.get("https://example.org/a")
+    transport.get("https://example.org/b", timeout=1)
+
+    assert [k["timeout"] for k in sent] == [7, 1]
+
+
+def test_close_drops_sessions():
+    transport = utils.Transport()
+    transport.session("https://example.org/")
+
+    transport.close()
+
+    assert transport.sessions == dict()
@@ -0,0 +1,81 @@
+import copy
+
+import pytest
+from conftest import FakeResponse, FakeTransport
+
+from pysppin import utils, worms
+
+names = [
+    "Balaena mysticetus", "Balaena oldname", "Balaena borealis", "Loopus a", "Orphan name", "Balaena glac",
+    "Nothing here", "Balaena", "Loopus b"
+]
+sppin_keys = [f"Scientific Name:{n}" for n in names]
+
+
+def comparable(worms_result):
+    worms_result = copy.deepcopy(worms_result)
+    worms_result.pop("date_processed")
+    worms_result["processing_metadata"].pop("date_processed")
+    return worms_result
+
+
+@pytest.fixture
+def search_results(worms_service):
+    service = worms.Worms(transport=worms_service, identifier_cache=utils.IdentifierCache())
+    return [comparable(service.search(k)) for k in sppin_keys]
+
+
+def test_batch_matches_search(worms_service, search_results):
+    worms_service.calls.clear()
+    service = worms.Worms(transport=worms_service, identifier_cache=utils.IdentifierCache())
+    batch_results = service.search_batch(sppin_keys, batch_size=4)
+
+    assert [comparable(r) for r in batch_results] == search_results
+    assert [r["processing_metadata"]["status_message"] for r in batch_results] == [
+        "Exact Match", "Followed Valid AphiaID", "Followed Valid AphiaID", "Followed Valid AphiaID", "Exact Match",
+        "Fuzzy Match", "Not Matched", "Exact Match", "Followed Valid AphiaID"
+    ]
+    assert len([u for u in worms_service.calls if "AphiaRecordsByMatchNames" in u]) == 3
+    assert not any("AphiaRecordByAphiaID/" in u for u in worms_service.calls)
+
+
+def test_batch_repeated_keys(worms_service, search_results):
+    service = worms.Worms(transport=worms_service, identifier_cache=utils.IdentifierCache())
+    batch_results = service.search_batch(sppin_keys + sppin_keys[:2])
+
+    assert [comparable(r) for r in batch_results] == search_results + search_results[:2]
+
+
+def test_failed_match_call_falls_back_to_exact_name(worms_service, search_results, tmp_path):
+    def handler(method, url, kwargs):
+        if "AphiaRecordsByMatchNames" in url:
+            return FakeResponse(500)
+        return worms_service.handler(method, url, kwargs)
+
+    transport = FakeTransport(handler)
+    service = worms.Worms(
+        transport=transport, identifier_cache=utils.IdentifierCache(),
+        negative_cache=utils.NegativeCache(cache_location=str(tmp_path))
+    )
+    batch_results = service.search_batch(sppin_keys, batch_size=4)
+
+    assert [comparable(r) for r in batch_results] == search_results
+    fuzzy_names = [u.split("AphiaRecordsByName/")[1].split("?")[0] for u in transport.calls if "like=true" in u]
+    assert fuzzy_names == ["Balaena glac", "Nothing here"]
+    assert service.negative_cache.get("worms", "Scientific Name:Nothing here") is not None
+
+
+def test_transient_failure_is_not_a_definite_miss(worms_service, tmp_path):
+    def handler(method, url, kwargs):
+        if "AphiaRecordsByMatchNames" in url or "like=false" in url:
+            return FakeResponse(503)
+        return worms_service.handler(method, url, kwargs)
+
+    service = worms.Worms(
+        transport=FakeTransport(handler), identifier_cache=utils.IdentifierCache(),
+        negative_cache=utils.NegativeCache(cache_location=str(tmp_path))
+    )
+    result = service.search_batch(["Scientific Name:Nothing here"])[0]
+
+    assert result["processing_metadata"]["status_message"] == "Not Matched"
+    assert service.negative_cache.get("worms", "Scientific Name:Nothing here") is None
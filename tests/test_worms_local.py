@@ -0,0 +1,100 @@
+import copy
+
+import pytest
+
+from pysppin import utils, worms
+
+names = [
+    "Balaena mysticetus", "Balaena oldname", "Balaena borealis", "Loopus a", "Orphan name", "Balaena glac",
+    "Nothing here", "Balaena", "Loopus b"
+]
+sppin_keys = [f"Scientific Name:{n}" for n in names]
+
+
+def comparable(worms_result):
+    # The local snapshot records its own query strings in place of the service URLs
+    worms_result = copy.deepcopy(worms_result)
+    worms_result.pop("date_processed")
+    worms_result["processing_metadata"].pop("date_processed")
+    worms_result["processing_metadata"].pop("api")
+    return worms_result
+
+
+@pytest.fixture
+def worms_local(worms_cache):
+    return worms.WormsLocal(cache_location=worms_cache)
+
+
+def test_exact_match(worms_local):
+    result = worms_local.search("Scientific Name:Balaena  Mysticetus")
+
+    assert result["processing_metadata"]["status_message"] == "Exact Match"
+    assert result["processing_metadata"]["api"] == "WoRMS.sqlite:ExactName:Balaena  Mysticetus"
+    assert [d["AphiaID"] for d in result["data"]] == [137087]
+    assert result["data"][0]["resolvable_identifier"] == "http://www.marinespecies.org/aphia.php?p=taxdetails&id=137087"
+    assert result["summary"]["scientificname"] == "Balaena mysticetus"
+
+
+def test_fuzzy_match(worms_local):
+    result = worms_local.search("Scientific Name:Balaena glac")
+
+    assert result["processing_metadata"]["status_message"] == "Fuzzy Match"
+    assert result["data"][0]["match_type"] == "like"
+    assert result["summary"]["scientificname"] == "Balaena glacialis"
+
+
+def test_follows_valid_chain(worms_local):
+    result = worms_local.search("Scientific Name:Balaena oldname")
+
+    assert result["processing_metadata"]["status_message"] == "Followed Valid AphiaID"
+    assert result["processing_metadata"]["api"] == "WoRMS.sqlite:AphiaID:137087"
+    assert [d["AphiaID"] for d in result["data"]] == [500002, 500001, 137087]
+
+
+def test_loop_and_missing_valid_taxon(worms_local):
+    loop = worms_local.search("Scientific Name:Loopus a")
+    orphan = worms_local.search("Scientific Name:Orphan name")
+
+    assert [d["AphiaID"] for d in loop["data"]] == [600001, 600002]
+    assert "summary" not in loop
+    assert [d["AphiaID"] for d in orphan["data"]] == [700001]
+    assert orphan["processing_metadata"]["status_message"] == "Exact Match"
+
+
+def test_not_matched_goes_to_negative_cache(worms_local, tmp_path):
+    worms_local.negative_cache = utils.NegativeCache(cache_location=str(tmp_path))
+    result = worms_local.search("Scientific Name:Nothing here")
+
+    assert result["processing_metadata"]["status_message"] == "Not Matched"
+    assert "data" not in result
+    assert worms_local.negative_cache.get("worms_local", "Scientific Name:Nothing here") is not None
+
+
+def test_local_miss_is_not_served_to_service(worms_cache, worms_service, tmp_path):
+    negative_cache = utils.NegativeCache(cache_location=str(tmp_path))
+    # A snapshot taken before Balaena glacialis was added
+    worms_local = worms.WormsLocal(cache_location=worms_cache, negative_cache=negative_cache)
+    worms_local.con.execute("DELETE FROM names WHERE AphiaID = 137088")
+    service = worms.Worms(transport=worms_service, negative_cache=negative_cache,
+                          identifier_cache=utils.IdentifierCache())
+
+    assert worms_local.search("Scientific Name:Balaena glacialis")["processing_metadata"]["status"] is None
+    result = service.search("Scientific Name:Balaena glacialis")
+
+    assert result["processing_metadata"]["status_message"] == "Exact Match"
+    assert negative_cache.get("worms", "Scientific Name:Balaena glacialis") is None
+
+
+def test_same_results_as_service(worms_local, worms_service):
+    service = worms.Worms(transport=worms_service, identifier_cache=utils.IdentifierCache())
+
+    local_results = [comparable(worms_local.search(k)) for k in sppin_keys]
+    service_results = [comparable(service.search(k)) for k in sppin_keys]
+
+    assert local_results == service_results
+    assert [comparable(r) for r in worms_local.search_batch(sppin_keys)] == local_results
+
+
+def test_missing_snapshot(tmp_path):
+    with pytest.raises(ValueError, match="No WoRMS snapshot"):
+        worms.WormsLocal(cache_location=str(tmp_path)).search("Scientific Name:Balaena mysticetus")